@@ -0,0 +1,617 @@
+"""Benchmark conversions offline, against recorded upstream responses.
+
+Every API the converters call (Spotify, Apple Music, YT Music, MusicBrainz and
+musicfetch) is replaced with a stub that answers from fixtures/, after a set
+delay, so runs are repeatable and need no network or credentials.
+
+Run from the repo root:
+    python bench.py match                    # title/artist matcher, per call
+    python bench.py cached --rows 100000     # conversions answered by songs.db
+    python bench.py replay --latency 0.2     # conversions from recorded responses
+    python bench.py record --urls urls.txt   # capture fixtures (online, needs .env)
+
+Add --json results.json to save a run, and --baseline results.json to fail when
+a run is more than --tolerance slower than a saved one."""
+
+import argparse
+import asyncio
+import copy
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "src", "convert"))
+# pylint: disable=wrong-import-position
+import cache
+import match
+import metrics
+import scheduler
+import services
+import song
+import storage
+
+FIXTURES = os.path.join(HERE, "fixtures")
+SERVICES = ("spotify", "applemusic", "ytmusic")
+# read by services.py; the stubs never send them anywhere
+CREDENTIALS = (
+    "SP_CLIENT_ID",
+    "SP_CLIENT_SCRT",
+    "AP_SECRET_KEY",
+    "AP_KEY_ID",
+    "AP_TEAM_ID",
+)
+UPSTREAMS = ("spotify", "applemusic", "ytmusic", "musicbrainz", "musicfetch")
+# rate limits for stubbed runs: high enough that only our own code is measured
+UNLIMITED = {name: (1_000_000, 1_000_000) for name in UPSTREAMS}
+
+
+class MissingFixtureError(Exception):
+    """Exception for a request that was never recorded."""
+
+
+class Upstreams:
+    """Recorded responses from every API, keyed by request.
+
+    When recording, each request goes out for real and its response (or error) is
+    kept; when replaying, it's answered from what was kept, after a delay."""
+
+    def __init__(
+        self,
+        directory: str = FIXTURES,
+        record: bool = False,
+        latency: dict = None,
+        jitter: float = 0.0,
+    ):
+        """Load the fixtures.
+
+        Args:
+            directory (str, optional): Where the fixtures live. Defaults to FIXTURES.
+            record (bool, optional): Make real requests and keep them, instead of
+                replaying. Defaults to False.
+            latency (dict, optional): Maps upstream to seconds each replayed request
+                takes; "default" covers the rest. Defaults to no delay.
+            jitter (float, optional): Up to this much more, at random. Defaults to 0.
+        """
+        self.directory = directory
+        self.record = record
+        self.latency = latency or {}
+        self.jitter = jitter
+        self.responses = {}
+        for name in UPSTREAMS:
+            path = os.path.join(directory, f"{name}.json")
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as file:
+                    self.responses[name] = json.load(file)
+            else:
+                self.responses[name] = {}
+        self.lock = threading.Lock()
+
+    def call(self, upstream: str, key: str, live, error=None):
+        """Answer a request.
+
+        Args:
+            upstream (str): Which API it's for.
+            key (str): The request, as a stable string.
+            live (Callable): Makes the real request; only called when recording.
+            error (Callable, optional): Rebuilds the exception the API raised from
+                its recorded status and message.
+
+        Raises:
+            MissingFixtureError: Replaying, and this request was never recorded.
+
+        Returns:
+            The response, as the API client would have returned it.
+        """
+        if self.record:
+            try:
+                result = live()
+            except Exception as e:
+                status = getattr(e, "http_status", None) or getattr(
+                    getattr(e, "response", None), "status_code", None
+                )
+                with self.lock:
+                    self.responses[upstream][key] = {
+                        "error": {"status": status, "message": str(e)}
+                    }
+                raise
+            with self.lock:
+                self.responses[upstream][key] = {"result": result}
+            return result
+
+        delay = self.latency.get(upstream, self.latency.get("default", 0.0))
+        time.sleep(delay + random.uniform(0, self.jitter))
+        entry = self.responses[upstream].get(key)
+        if entry is None:
+            raise MissingFixtureError(f"No {upstream} fixture for {key}")
+        if "error" in entry:
+            if error is None:
+                # pylint: disable-next=broad-exception-raised
+                raise Exception(entry["error"]["message"])
+            raise error(entry["error"]["status"], entry["error"]["message"])
+        # callers are free to change what they get back
+        return copy.deepcopy(entry["result"])
+
+    def save(self):
+        """Write everything recorded back to the fixtures."""
+        os.makedirs(self.directory, exist_ok=True)
+        for name, responses in self.responses.items():
+            path = os.path.join(self.directory, f"{name}.json")
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(responses, file, indent=1, sort_keys=True)
+
+
+def install(upstreams: Upstreams):
+    """Route every API client's requests through upstreams. The converters' own
+    overrides (rate limiting, metrics) still run; only the network is swapped."""
+    # the clients are only needed here, so the match benchmark runs without them
+    # pylint: disable=import-outside-toplevel,protected-access
+    import applemusicpy
+    import musicfetch
+    import requests
+    import spotipy
+    import ytmusicapi
+    import sessions
+
+    def spotify_error(status, message):
+        return spotipy.SpotifyException(status, -1, message)
+
+    def apple_error(status, message):
+        response = requests.Response()
+        response.status_code = status
+        return requests.exceptions.HTTPError(message, response=response)
+
+    real_spotify = spotipy.Spotify._internal_call
+    real_apple = applemusicpy.AppleMusic._call
+    real_ytmusic = ytmusicapi.YTMusic._send_request
+    real_musicfetch = musicfetch.fetch_isrc
+    real_musicbrainz = sessions.get("musicbrainz")
+
+    def spotify_call(self, method, url, payload, params):
+        key = f"{method} {url} {json.dumps(params, sort_keys=True, default=str)}"
+        return upstreams.call(
+            "spotify",
+            key,
+            lambda: real_spotify(self, method, url, payload, params),
+            spotify_error,
+        )
+
+    def apple_call(self, method, url, params):
+        key = f"{method} {url} {json.dumps(params, sort_keys=True, default=str)}"
+        return upstreams.call(
+            "applemusic", key, lambda: real_apple(self, method, url, params), apple_error
+        )
+
+    def ytmusic_request(self, endpoint, body, *args, **kwargs):
+        # the client context, and get_song's playback context, change from day to day
+        request = {
+            k: v for k, v in body.items() if k not in ("context", "playbackContext")
+        }
+        key = f"{endpoint} {json.dumps([request, args], sort_keys=True)}"
+        return upstreams.call(
+            "ytmusic", key, lambda: real_ytmusic(self, endpoint, body, *args, **kwargs)
+        )
+
+    def fetch_isrc(url):
+        return upstreams.call("musicfetch", url, lambda: real_musicfetch(url))
+
+    class MusicBrainzSession:
+        """Stands in for the pooled musicbrainz session."""
+
+        def get(self, url, **kwargs):
+            """Answer a GET with a requests.Response rebuilt from the fixture."""
+
+            def live():
+                response = real_musicbrainz.get(url, **kwargs)
+                return {"status": response.status_code, "body": response.text}
+
+            entry = upstreams.call("musicbrainz", url, live)
+            response = requests.Response()
+            response.status_code = entry["status"]
+            response._content = entry["body"].encode()
+            response.url = url
+            return response
+
+    spotipy.Spotify._internal_call = spotify_call
+    applemusicpy.AppleMusic._call = apple_call
+    ytmusicapi.YTMusic._send_request = ytmusic_request
+    musicfetch.fetch_isrc = fetch_isrc
+    sessions._sessions["musicbrainz"] = MusicBrainzSession()
+    if not upstreams.record:
+        # there's no key to sign a token with, and nothing to send it to
+        applemusicpy.AppleMusic.generate_token = lambda self, *args, **kwargs: setattr(
+            self, "token_str", "replay"
+        )
+
+
+def open_db(path: str, limits: dict = None):
+    """Point every converter at a songs.db of our own, and set the rate limits.
+    Must run before the converters are imported; they bind both at import."""
+    # pylint: disable=protected-access
+    storage._shared = storage.Storage(path)
+    scheduler._shared = scheduler.Scheduler(limits)
+    return storage._shared
+
+
+def make_converters(record: bool = False):
+    """Register every service the way the bot does, with stand-in credentials when
+    replaying."""
+    if record:
+        from dotenv import load_dotenv  # pylint: disable=import-outside-toplevel
+
+        load_dotenv(os.path.join(HERE, "src", "convert", ".env"))
+    else:
+        for name in CREDENTIALS:
+            os.environ[name] = "replay"
+    return services.enabled(",".join(SERVICES))
+
+
+def seed(db: storage.Storage, rows: int, batch: int = 10_000):
+    """Fill a songs.db with synthetic songs, each cached on every service and
+    linked by ISRC, until it holds rows of them. Rows already there are kept, so a
+    --db can be reused between runs."""
+    con = db.connection()
+    have = con.execute("SELECT count(*) FROM spotify").fetchone()[0]
+    if have >= rows:
+        return
+    print(f"Seeding {rows - have} songs...")
+    now = time.time()
+    for start in range(have, rows, batch):
+        ids = range(start, min(start + batch, rows))
+        con.execute("BEGIN")
+        con.executemany(
+            "INSERT INTO spotify(uid, isrc, title, first_artist, fetched_at) \
+            VALUES (?, ?, ?, ?, ?)",
+            [(spotify_uid(i), isrc(i), title(i), artist(i), now) for i in ids],
+        )
+        con.executemany(
+            "INSERT INTO ytmusic(uid, isrc, title, first_artist, fetched_at) \
+            VALUES (?, ?, ?, ?, ?)",
+            [(ytmusic_uid(i), isrc(i), title(i), artist(i), now) for i in ids],
+        )
+        con.executemany(
+            "INSERT INTO applemusic(songid, albumid, isrc, title, artist, fetched_at) \
+            VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (str(10**9 + i), str(2 * 10**9 + i), isrc(i), title(i), artist(i), now)
+                for i in ids
+            ],
+        )
+        con.executemany(
+            "INSERT INTO recordings(service, platform_id, isrc, url) \
+            VALUES (?, ?, ?, ?)",
+            [
+                (service, platform_id, isrc(i), url)
+                for i in ids
+                for service, platform_id, url in (
+                    ("spotify", spotify_uid(i), song_url("spotify", i)),
+                    ("ytmusic", ytmusic_uid(i), song_url("ytmusic", i)),
+                    ("applemusic", str(10**9 + i), song_url("applemusic", i)),
+                )
+            ],
+        )
+        con.execute("COMMIT")
+
+
+WORDS = "love night heart fire blue rain dance light home gold wild dream".split()
+
+
+def spotify_uid(i: int) -> str:
+    """Spotify ID of synthetic song i."""
+    return f"bench{i:017d}"
+
+
+def ytmusic_uid(i: int) -> str:
+    """YT Music videoId of synthetic song i."""
+    return f"b{i:010d}"
+
+
+def isrc(i: int) -> str:
+    """ISRC of synthetic song i, lowercased as the db keeps them."""
+    return f"qzbn{i:08d}"
+
+
+def title(i: int) -> str:
+    """Title of synthetic song i; they share words, so searches have near misses."""
+    return f"{WORDS[i % 12]} {WORDS[i // 12 % 12]} {i}"
+
+
+def artist(i: int) -> str:
+    """Artist of synthetic song i."""
+    return f"The {WORDS[i // 144 % 12]} {i % 997}"
+
+
+def song_url(service: str, i: int) -> str:
+    """URL of synthetic song i on a service, as that service formats it."""
+    if service == "spotify":
+        return f"https://open.spotify.com/track/{spotify_uid(i)}"
+    if service == "ytmusic":
+        return f"https://music.youtube.com/watch?v={ytmusic_uid(i)}"
+    return f"https://music.apple.com/us/album/{2 * 10**9 + i}?i={10**9 + i}"
+
+
+async def convert(conversions, source: str, target: str, url: str):
+    """One /song, minus Discord: URL to Song obj to URL."""
+    a_song = await conversions.to_song(source, url)
+    return await conversions.to_url(target, a_song)
+
+
+async def measure(conversions, jobs: list, concurrency: int) -> dict:
+    """Run (source, target, url) conversions, at most concurrency at once, and time
+    each one."""
+    latencies = []
+    errors = {}
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(source, target, url):
+        async with gate:
+            start = time.perf_counter()
+            try:
+                await convert(conversions, source, target, url)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                name = e.__class__.__name__
+                errors[name] = errors.get(name, 0) + 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(*job) for job in jobs))
+    elapsed = time.perf_counter() - start
+    return summarize(latencies, elapsed, errors)
+
+
+def summarize(
+    latencies: list, elapsed: float, errors: dict = None, caches: bool = True
+) -> dict:
+    """Throughput and latency percentiles of a run, in ms, plus cache hit counts."""
+    cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0] * 99
+    result = {
+        "requests": len(latencies),
+        "per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": cuts[49] * 1000,
+        "p99_ms": cuts[98] * 1000,
+        "max_ms": max(latencies, default=0) * 1000,
+        "errors": errors or {},
+    }
+    if not caches:
+        return result
+    stats = metrics.shared()
+    lookups = {}
+    for (name, labels), value in stats.counters.items():
+        if name == "db_lookups_total":
+            labels = dict(labels)
+            lookups[f"{labels['table']} {labels['result']}"] = value
+    result["memo"] = cache.shared().stats()
+    result["db_lookups"] = lookups
+    return result
+
+
+def report(name: str, result: dict):
+    """Print a summarize() result."""
+    print(
+        f"{name}: {result['requests']} in {result['per_second']:.0f}/s, "
+        f"p50 {result['p50_ms']:.2f}ms, p99 {result['p99_ms']:.2f}ms, "
+        f"max {result['max_ms']:.2f}ms"
+    )
+    if result.get("errors"):
+        print(f"  errors: {result['errors']}")
+    if "memo" in result:
+        memo = result["memo"]
+        print(
+            f"  memo: {memo['hits']} hits, {memo['misses']} misses "
+            f"({memo['hit_ratio']:.1%}), {memo['size']} entries"
+        )
+    for lookup, count in sorted(result.get("db_lookups", {}).items()):
+        print(f"  db {lookup}: {count:g}")
+
+
+def bench_match(args) -> dict:
+    """Time the matcher: normalizing a title and scoring one song against the ten
+    candidates a title search returns."""
+    rng = random.Random(args.seed)
+    noise = ["", " (Remastered 2011)", " - Radio Edit", " (feat. Someone)", " (Live)"]
+    ours = [
+        song.Song("spotify", str(i), None, title(i), artist(i))
+        for i in range(args.requests)
+    ]
+    candidates = [
+        [
+            song.Song(
+                "ytmusic",
+                str(j),
+                None,
+                title(rng.randrange(args.requests)) + rng.choice(noise),
+                artist(rng.randrange(args.requests)),
+            )
+            for j in range(10)
+        ]
+        for _ in range(args.requests)
+    ]
+
+    results = {}
+    latencies = []
+    start = time.perf_counter()
+    for a_song in ours:
+        began = time.perf_counter()
+        match.title_key(a_song.title)
+        latencies.append(time.perf_counter() - began)
+    results["title_key"] = summarize(
+        latencies, time.perf_counter() - start, caches=False
+    )
+
+    latencies = []
+    start = time.perf_counter()
+    for a_song, found in zip(ours, candidates):
+        began = time.perf_counter()
+        match.best(a_song, found)
+        latencies.append(time.perf_counter() - began)
+    results["best_of_10"] = summarize(
+        latencies, time.perf_counter() - start, caches=False
+    )
+    for name, result in results.items():
+        report(name, result)
+    return results
+
+
+def bench_cached(args) -> dict:
+    """Time conversions that songs.db already has, across a db of args.rows songs.
+    Songs are picked with a Zipf skew, so popular ones repeat like they do live."""
+    path = args.db or os.path.join(tempfile.mkdtemp(), "songs.db")
+    db = open_db(path, None if args.real_limits else UNLIMITED)
+    seed(db, args.rows)
+    install(Upstreams(latency=latencies(args), jitter=args.jitter))
+    # pylint: disable=import-outside-toplevel
+    import engine
+
+    conversions = engine.ConversionEngine(make_converters(), max_workers=args.workers)
+    rng = random.Random(args.seed)
+    weights = [1 / rank**args.zipf for rank in range(1, args.rows + 1)]
+    picks = rng.choices(range(args.rows), weights=weights, k=args.requests)
+    jobs = []
+    for i in picks:
+        source, target = rng.sample(SERVICES, 2)
+        jobs.append((source, target, song_url(source, i)))
+    result = asyncio.run(measure(conversions, jobs, args.concurrency))
+    report(f"cached ({args.rows} rows)", result)
+    conversions.shutdown()
+    return {"cached": result}
+
+
+def bench_replay(args) -> dict:
+    """Time the conversions in fixtures/conversions.txt from a cold cache, answered
+    by the recorded responses, and then again now that they're cached."""
+    path = os.path.join(FIXTURES, "conversions.txt")
+    if not os.path.exists(path):
+        sys.exit("No recorded conversions; run `python bench.py record` first.")
+    with open(path, encoding="utf-8") as file:
+        jobs = [tuple(line.split()) for line in file if line.strip()]
+    open_db(os.path.join(tempfile.mkdtemp(), "songs.db"), UNLIMITED)
+    install(Upstreams(latency=latencies(args), jitter=args.jitter))
+    # pylint: disable=import-outside-toplevel
+    import engine
+
+    conversions = engine.ConversionEngine(make_converters(), max_workers=args.workers)
+    results = {}
+    for name in ("cold", "warm"):
+        results[name] = asyncio.run(
+            measure(conversions, jobs * args.repeat, args.concurrency)
+        )
+        storage.shared().flush()  # so the warm pass sees what the cold one cached
+        report(f"replay {name}", results[name])
+    conversions.shutdown()
+    return results
+
+
+def bench_record(args):
+    """Convert every URL in args.urls to every other service against the live APIs,
+    keeping every response in fixtures/."""
+    with open(args.urls, encoding="utf-8") as file:
+        urls = [line.strip() for line in file if line.strip()]
+    open_db(os.path.join(tempfile.mkdtemp(), "songs.db"))
+    upstreams = Upstreams(record=True)
+    install(upstreams)
+    # pylint: disable=import-outside-toplevel
+    import engine
+
+    converters = make_converters(record=True)
+    conversions = engine.ConversionEngine(converters)
+    jobs = []
+    for url in urls:
+        source = converters.detect(url)
+        if source is None:
+            print(f"Skipping {url}: not a URL we convert")
+            continue
+        jobs.extend((source, target, url) for target in SERVICES if target != source)
+    # one at a time, so exactly the requests a cold conversion needs are recorded
+    result = asyncio.run(measure(conversions, jobs, 1))
+    upstreams.save()
+    path = os.path.join(FIXTURES, "conversions.txt")
+    with open(path, "w", encoding="utf-8") as file:
+        file.writelines(f"{' '.join(job)}\n" for job in jobs)
+    report("recorded", result)
+    conversions.shutdown()
+
+
+def latencies(args) -> dict:
+    """Turn the --latency options ("0.2", "musicfetch=2") into Upstreams' dict."""
+    found = {}
+    for option in args.latency:
+        upstream, _, seconds = option.rpartition("=")
+        found[upstream or "default"] = float(seconds)
+    return found
+
+
+def compare(results: dict, baseline_path: str, tolerance: float) -> list:
+    """List every benchmark that's more than tolerance slower than the baseline."""
+    with open(baseline_path, encoding="utf-8") as file:
+        baseline = json.load(file)
+    slower = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            slower.append(
+                f"{name} p99 {before['p99_ms']:.2f}ms -> {result['p99_ms']:.2f}ms"
+            )
+        if result["per_second"] < before["per_second"] / (1 + tolerance):
+            slower.append(
+                f"{name} {before['per_second']:.0f}/s -> {result['per_second']:.0f}/s"
+            )
+    return slower
+
+
+def main():
+    """Run the benchmark named on the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("benchmark", choices=("match", "cached", "replay", "record"))
+    parser.add_argument("--rows", type=int, default=10_000, help="songs in songs.db")
+    parser.add_argument("--requests", type=int, default=10_000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=8, help="engine threads")
+    parser.add_argument("--repeat", type=int, default=1, help="passes over fixtures")
+    parser.add_argument(
+        "--latency",
+        action="append",
+        default=[],
+        help="seconds per stubbed request, for all (0.2) or one upstream "
+        "(musicfetch=2); may be repeated",
+    )
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--zipf", type=float, default=1.1, help="popularity skew")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", help="songs.db to seed and keep between runs")
+    parser.add_argument(
+        "--real-limits", action="store_true", help="keep the live rate limits"
+    )
+    parser.add_argument("--urls", help="URLs to record, one per line")
+    parser.add_argument("--json", help="save results here")
+    parser.add_argument("--baseline", help="results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.benchmark == "record":
+        if not args.urls:
+            parser.error("record needs --urls")
+        bench_record(args)
+        return
+    results = {"match": bench_match, "cached": bench_cached, "replay": bench_replay}[
+        args.benchmark
+    ](args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=1)
+    if args.baseline:
+        slower = compare(results, args.baseline, args.tolerance)
+        for line in slower:
+            print(f"Slower than baseline: {line}")
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""Make up the fixtures bench.py replays, from a small catalog of fictional songs.
+
+Recording real fixtures needs credentials for every API. These need none: each
+API client's transport is swapped for one that answers from CATALOG, and bench.py
+records what the converters ask it just as it would the live APIs, so the keys
+are exactly the ones a replay looks up. Rerun this whenever a change alters the
+requests the converters make.
+
+Run from the repo root:
+    python fixtures/synthetic.py"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs, urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+# pylint: disable=wrong-import-position
+import bench
+
+# every song on the services it's on; ytmusic songs without "isrc_known" aren't
+# known to musicfetch, so they can only be found by title
+CATALOG = [
+    {
+        "isrc": "QZFX72600001",
+        "title": "Golden Hour",
+        "artist": "Aster Lane",
+        "spotify": "5GsyntH0ldenH0urTrack1",
+        "applemusic": ("1790000001", "1790000100"),
+        "ytmusic": "synthGH0001",
+        "isrc_known": True,
+    },
+    {
+        "isrc": "QZFX72600002",
+        "title": "Paper Moons",
+        "artist": "The Quiet Hours",
+        "spotify": "6PsyntPaperM00nsTrack2",
+        "applemusic": ("1790000002", "1790000200"),
+        "ytmusic": "synthPM0002",
+        "ytmusic_title": "Paper Moons (Official Audio)",
+        "isrc_known": False,
+    },
+    {
+        "isrc": "QZFX72600003",
+        "title": "Northbound",
+        "artist": "Mira Sol",
+        "spotify": "7NsyntN0rthb0undTrack3",
+        "applemusic": None,
+        "ytmusic": None,
+    },
+    {
+        "isrc": "QZFX72600004",
+        "title": "Static Bloom",
+        "artist": "Vela Park",
+        "spotify": None,
+        "applemusic": ("1790000004", "1790000400"),
+        "ytmusic": "synthSB0004",
+        "isrc_known": True,
+    },
+]
+
+
+def _matches(entry: dict, query: str) -> bool:
+    """Whether a search query names a song, by ISRC, ID or title and artist."""
+    query = query.lower()
+    ids = [entry["isrc"], entry["spotify"], entry["ytmusic"]]
+    if any(value and value.lower() in query for value in ids):
+        return True
+    return entry["title"].lower() in query and entry["artist"].lower() in query
+
+
+# region Spotify
+def _spotify_track(entry: dict) -> dict:
+    return {
+        "id": entry["spotify"],
+        "name": entry["title"],
+        "artists": [{"name": entry["artist"]}],
+        "external_ids": {"isrc": entry["isrc"]},
+        "external_urls": {
+            "spotify": f"https://open.spotify.com/track/{entry['spotify']}"
+        },
+    }
+
+
+def spotify_call(_client, _method, url, _payload, params):
+    """Stands in for spotipy.Spotify._internal_call."""
+    import spotipy  # pylint: disable=import-outside-toplevel
+
+    on_spotify = [entry for entry in CATALOG if entry["spotify"]]
+    if url.startswith("tracks/"):
+        uid = url.split("/")[1]
+        for entry in on_spotify:
+            if entry["spotify"] == uid:
+                return _spotify_track(entry)
+        raise spotipy.SpotifyException(404, -1, "Not found.")
+    if url == "search":
+        query = params["q"].replace("isrc:", "").replace("track:", "")
+        query = query.replace("artist:", "")
+        items = [
+            _spotify_track(entry) for entry in on_spotify if _matches(entry, query)
+        ]
+        return {"tracks": {"items": items[: params.get("limit", 10)]}}
+    raise spotipy.SpotifyException(400, -1, f"No synthetic answer for {url}")
+
+
+# endregion
+
+
+# region Apple Music
+def _apple_song(entry: dict) -> dict:
+    song_id, album_id = entry["applemusic"]
+    slug = entry["title"].lower().replace(" ", "-")
+    return {
+        "id": song_id,
+        "type": "songs",
+        "attributes": {
+            "url": f"https://music.apple.com/us/album/{slug}/{album_id}?i={song_id}",
+            "isrc": entry["isrc"],
+            "artistName": entry["artist"],
+            "name": entry["title"],
+        },
+    }
+
+
+def apple_call(_client, _method, url, params):
+    """Stands in for applemusicpy.AppleMusic._call."""
+    import requests  # pylint: disable=import-outside-toplevel
+
+    on_apple = [entry for entry in CATALOG if entry["applemusic"]]
+    parts = urlsplit(url)
+    path = parts.path.split("/v1/")[-1]
+    # search sends its terms in the URL rather than in params
+    params = {**{k: v[0] for k, v in parse_qs(parts.query).items()}, **params}
+    if path.startswith("catalog/us/songs/"):
+        song_id = path.split("/")[-1]
+        for entry in on_apple:
+            if entry["applemusic"][0] == song_id:
+                return {"data": [_apple_song(entry)]}
+    elif path == "catalog/us/songs" and "filter[isrc]" in params:
+        isrcs = params["filter[isrc]"].lower().split(",")
+        return {
+            "data": [
+                _apple_song(entry)
+                for entry in on_apple
+                if entry["isrc"].lower() in isrcs
+            ]
+        }
+    elif path == "catalog/us/search":
+        term = params["term"]
+        found = [_apple_song(entry) for entry in on_apple if _matches(entry, term)]
+        return {"results": {"songs": {"data": found}} if found else {}}
+    response = requests.Response()
+    response.status_code = 404
+    raise requests.exceptions.HTTPError("404 Not Found", response=response)
+
+
+# endregion
+
+
+# region YT Music
+def _ytmusic_item(entry: dict) -> dict:
+    """A song as a search results shelf lists it."""
+    title = entry.get("ytmusic_title", entry["title"])
+    watch = {"videoId": entry["ytmusic"]}
+    artist_page = {
+        "browseId": f"UCsynth{entry['isrc'][-4:]}",
+        "browseEndpointContextSupportedConfigs": {
+            "browseEndpointContextMusicConfig": {"pageType": "MUSIC_PAGE_TYPE_ARTIST"}
+        },
+    }
+    return {
+        "musicResponsiveListItemRenderer": {
+            "flexColumns": [
+                {
+                    "musicResponsiveListItemFlexColumnRenderer": {
+                        "text": {
+                            "runs": [
+                                {
+                                    "text": title,
+                                    "navigationEndpoint": {"watchEndpoint": watch},
+                                }
+                            ]
+                        }
+                    }
+                },
+                {
+                    "musicResponsiveListItemFlexColumnRenderer": {
+                        "text": {
+                            "runs": [
+                                {
+                                    "text": entry["artist"],
+                                    "navigationEndpoint": {
+                                        "browseEndpoint": artist_page
+                                    },
+                                },
+                                {"text": " • "},
+                                {"text": "3:30"},
+                            ]
+                        }
+                    }
+                },
+            ],
+            "overlay": {
+                "musicItemThumbnailOverlayRenderer": {
+                    "content": {
+                        "musicPlayButtonRenderer": {
+                            "playNavigationEndpoint": {
+                                "watchEndpoint": {
+                                    **watch,
+                                    "watchEndpointMusicSupportedConfigs": {
+                                        "watchEndpointMusicConfig": {
+                                            "musicVideoType": "MUSIC_VIDEO_TYPE_ATV"
+                                        }
+                                    },
+                                }
+                            }
+                        }
+                    }
+                }
+            },
+        }
+    }
+
+
+def ytmusic_request(_client, endpoint, body, *_args, **_kwargs):
+    """Stands in for ytmusicapi.YTMusic._send_request."""
+    on_ytmusic = [entry for entry in CATALOG if entry["ytmusic"]]
+    if endpoint == "player":
+        known = any(entry["ytmusic"] == body["video_id"] for entry in on_ytmusic)
+        return {
+            "playabilityStatus": {"status": "OK" if known else "ERROR"},
+            "videoDetails": {"videoId": body["video_id"]},
+        }
+    if endpoint == "search":
+        items = [
+            _ytmusic_item(entry)
+            for entry in on_ytmusic
+            if _matches(entry, body["query"])
+        ]
+        songs = {"title": {"runs": [{"text": "Songs"}]}, "contents": items}
+        shelf = (
+            {"musicShelfRenderer": songs}
+            if items
+            else {"itemSectionRenderer": {"contents": [{"messageRenderer": {}}]}}
+        )
+        return {
+            "contents": {
+                "tabbedSearchResultsRenderer": {
+                    "tabs": [
+                        {
+                            "tabRenderer": {
+                                "content": {
+                                    "sectionListRenderer": {"contents": [shelf]}
+                                }
+                            }
+                        }
+                    ]
+                }
+            }
+        }
+    return {}
+
+
+def fetch_isrc(url: str) -> str | None:
+    """Stands in for musicfetch.fetch_isrc."""
+    video_id = url.split("v=")[-1]
+    for entry in CATALOG:
+        if entry["ytmusic"] == video_id and entry.get("isrc_known"):
+            return entry["isrc"]
+    return None
+
+
+# endregion
+
+
+def conversions() -> list[tuple[str, str, str]]:
+    """Every catalog song converted from each service it's on to each of the others,
+    whether or not the other service has it."""
+    jobs = []
+    for entry in CATALOG:
+        for source in bench.SERVICES:
+            if not entry[source]:
+                continue
+            if source == "applemusic":
+                song_id, album_id = entry["applemusic"]
+                url = f"https://music.apple.com/us/album/{album_id}?i={song_id}"
+            elif source == "spotify":
+                url = f"https://open.spotify.com/track/{entry['spotify']}"
+            else:
+                url = f"https://music.youtube.com/watch?v={entry['ytmusic']}"
+            jobs.extend(
+                (source, target, url) for target in bench.SERVICES if target != source
+            )
+    return jobs
+
+
+def main():
+    """Record every conversion against the catalog into fixtures/."""
+    # pylint: disable=import-outside-toplevel,protected-access
+    import applemusicpy
+    import musicfetch
+    import spotipy
+    import ytmusicapi
+
+    # swapped in before bench.install() takes these as the "real" clients
+    spotipy.Spotify._internal_call = spotify_call
+    applemusicpy.AppleMusic._call = apple_call
+    applemusicpy.AppleMusic.generate_token = lambda self, *args, **kwargs: setattr(
+        self, "token_str", "synthetic"
+    )
+    ytmusicapi.YTMusic._send_request = ytmusic_request
+    musicfetch.fetch_isrc = fetch_isrc
+
+    bench.open_db(os.path.join(tempfile.mkdtemp(), "songs.db"), bench.UNLIMITED)
+    upstreams = bench.Upstreams(directory=HERE, record=True)
+    upstreams.responses = {name: {} for name in bench.UPSTREAMS}
+    bench.install(upstreams)
+    import engine  # pylint: disable=import-outside-toplevel
+    import freshness  # pylint: disable=import-outside-toplevel
+
+    conversions_engine = engine.ConversionEngine(bench.make_converters())
+    jobs = conversions()
+    # one at a time, so exactly the requests a cold conversion needs are recorded
+    result = bench.asyncio.run(bench.measure(conversions_engine, jobs, 1))
+    # and the re-checks those queued in the background, which a replay makes too
+    bench.storage.shared().flush()
+    while freshness.shared().pending:
+        time.sleep(0.05)
+    bench.storage.shared().flush()
+    conversions_engine.shutdown()
+
+    upstreams.save()
+    with open(os.path.join(HERE, "conversions.txt"), "w", encoding="utf-8") as file:
+        file.writelines(f"{' '.join(job)}\n" for job in jobs)
+    bench.report("synthesized", result)
+    counts = {name: len(responses) for name, responses in upstreams.responses.items()}
+    print(f"Responses kept: {json.dumps(counts)}")
+
+
+if __name__ == "__main__":
+    main()
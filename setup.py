@@ -1,9 +1,15 @@
-"""Setup the database for the application."""
+"""Setup the database for the application.
+
+Safe to run against an existing db: only migrations newer than the db's
+schema version are applied."""
+import os
 import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src", "convert"))
+import schema  # pylint: disable=wrong-import-position
 
 if __name__ == "__main__":
     con = sqlite3.connect("db/songs.db")
-    cur = con.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS spotify (uid TEXT PRIMARY KEY, isrc TEXT, title TEXT, first_artist TEXT)")
-    cur.execute("CREATE TABLE IF NOT EXISTS ytmusic (uid TEXT PRIMARY KEY, isrc TEXT, title TEXT, first_artist TEXT)")
-    cur.execute("CREATE TABLE IF NOT EXISTS applemusic (songid TEXT, albumid TEXT, isrc TEXT, title TEXT, artist TEXT, PRIMARY KEY (songid, albumid)) ")
+    print(f"songs.db is at schema version {schema.migrate(con)}")
+    con.close()
@@ -0,0 +1,65 @@
+"""Define an album.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import match
+
+
+class Album:
+    """An album (really, a release).
+
+    Albums are equal if their UPCs are equal. YT Music doesn't expose UPCs, so
+    albums from there only have a title and artist to go on."""
+
+    def __init__(
+        self,
+        source: str,
+        uid: str,
+        upc: str,
+        title: str,
+        first_artist: str,
+    ):
+        self.source = source
+        self.uid = uid
+        # spotify pads UPCs to 12 digits and apple sometimes to 13 (EAN), so they're
+        # kept without leading zeros to compare; use padded() to search with one
+        self.upc = (upc.lstrip("0") or "0") if isinstance(upc, str) else upc
+        self.title = title
+        self.first_artist = first_artist
+        self._match_key = None
+
+    def __eq__(self, other):
+        if not isinstance(other, Album) or self.upc is None:
+            return False
+
+        return self.upc == other.upc
+
+    def padded(self, width: int = 12) -> str:
+        """The UPC zero-padded to a width; 12 is a UPC-A, 13 an EAN-13."""
+        return self.upc.zfill(width) if self.upc is not None else None
+
+    @property
+    def match_key(self) -> tuple:
+        """Title tokens, live flag and artist tokens, normalized once per album."""
+        if self._match_key is None:
+            title, live = match.album_title_key(self.title)
+            self._match_key = title, live, match.artist_key(self.first_artist)
+        return self._match_key
+
+    def is_similar(self, other):
+        """Returns true if the albums are similar, ignoring things like
+        (Deluxe Edition), featured artists, case, accents and punctuation."""
+        return match.score(self.match_key, other.match_key) >= match.THRESHOLD
@@ -15,85 +15,164 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>."""
 
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import time
 import applemusicpy
+import requests
+import album
+import cache
+import freshness
+import match
+import metrics
+import misses
+import recordings
+import scheduler
 import song
+import storage
+import strategy
+import titles
 
 
 class AppleMusicConverter(applemusicpy.AppleMusic):
     """Converts between songs and Apple Music URLs"""
 
     # TABLE applemusic(songid, albumid, isrc, title, artist)
-    con = sqlite3.connect("../db/songs.db")  # this is relative to the convert pkg
-    cur = con.cursor()
+    db = storage.shared()
+    memo = cache.shared()
+    limiter = scheduler.shared()
+    revalidator = freshness.shared()
+    ID_BATCH_SIZE = 300  # most IDs the catalog songs endpoint takes at once
+    ISRC_BATCH_SIZE = 25  # most ISRCs one filter[isrc] request takes
+    BATCH_WORKERS = 8  # searches run side by side in a batch
+    MAX_TRIES = 3  # most times a GET is sent, if it's told to slow down or fails
 
     def __init__(self, secret_key, key_id, team_id):
-        super().__init__(secret_key, key_id, team_id)
+        super().__init__(secret_key, key_id, team_id, max_retries=self.MAX_TRIES)
 
     def url_to_song(self, url: str) -> song.Song:
         """Takes in actual URLs"""
         album_id, song_id = self.__trim_url(url).split("?i=")
-        self.cur.execute(
+        result_song = self.memo.get(("song", "applemusic", song_id))
+        if result_song is not None:
+            return result_song
+
+        track = self.db.query_one(
             "SELECT * FROM applemusic WHERE songid=? AND albumid=?", [song_id, album_id]
         )
-        track = self.cur.fetchone()
         if track is not None:
-            return song.Song(
-                source="applemusic",
-                uid=(track[0]),  # we pass only the songid, not albumid
-                isrc=track[2],
-                title=track[3],
-                first_artist=track[4],
-            )
+            self.__check_fresh(song_id, track[5])
+            result_song = self.__row_to_song(track)
+            self.memo.put(("song", "applemusic", song_id), result_song)
+            return result_song
 
         # if db came up empty, query for data on the song_id:
         track = self.song(song_id)
         if track is not None:
             data = self.repack_data(track["data"][0])
             self.__commit_song(data)
-            return song.Song(
-                source="applemusic",
-                uid=data["song_id"],
-                isrc=data["isrc"],
-                title=data["track_name"],
-                first_artist=data["artist_name"],
-            )
+            result_song = self.__data_to_song(data)
+            self.memo.put(("song", "applemusic", song_id), result_song)
+            return result_song
 
         raise song.NoMatchFoundError("No match found for this URL.")
 
-    def song_to_url(self, a_song: song.Song, best_match: bool = False) -> str:
+    def song_to_url(
+        self,
+        a_song: song.Song,
+        best_match: bool = False,
+        refresh: bool = False,
+        deadline: float = None,
+    ) -> str:
         """Converts a song obj to an Apple Music URL.
 
         Args:
             a_song (song.Song): song obj
             best_match (bool, optional): Try and match a best fit? Defaults to False.
+            refresh (bool, optional): Search again even if this song recently came up
+                empty. Defaults to False.
+            deadline (float, optional): time.monotonic() to give up at. Defaults to
+                strategy.LOOKUP_BUDGET from now.
 
         Raises:
             song.NoMatchFoundError: No match found for this song.
+            song.LookupTimeoutError: Ran out of time before finding a match.
 
         Returns:
             str: Apple Music URL of the matching song
         """
 
-        # first, check the database for the isrc if we have an isrc
+        # first, check memory and then the database for the isrc if we have an isrc
         if a_song.isrc is not None:
-            self.cur.execute(
-                "SELECT songid, albumid FROM applemusic WHERE isrc=? limit 1",
+            url = self.memo.get(("url", a_song.isrc, "applemusic"))
+            if url is not None:
+                return url
+
+            track = self.db.query_one(
+                "SELECT songid, albumid, fetched_at FROM applemusic WHERE isrc=? \
+                limit 1",
                 [a_song.isrc],
             )
-            track = self.cur.fetchone()
             if track is not None:
                 songid, albumid = track[0], track[1]
+                self.__check_fresh(songid, track[2])
                 url = f"https://music.apple.com/us/album/{albumid}?i={songid}"
+                self.memo.put(("url", a_song.isrc, "applemusic"), url)
                 return url
 
-            # if nothing was returned from the DB, search apple music by isrc
-            track = self.song_by_isrc(a_song.isrc)
-            if track is not None:
-                self.__commit_song(track)
-                return f"https://music.apple.com/us/album/{track['album_id']}?i={track['song_id']}"
+        # fail fast if we recently came up empty on this one; only now, so a cache
+        # hit never pays for the check. a best match might still turn something up,
+        # so that always searches
+        if not (refresh or best_match) and misses.is_known_miss(
+            self.db, a_song, "applemusic"
+        ):
+            raise song.NoMatchFoundError("No match found for this song.")
+
+        # then go to Apple Music: by isrc first, with the title search started
+        # alongside it if that drags on
+        candidates = []
+        strategies = [functools.partial(self.__search_by_title, a_song, candidates)]
+        if a_song.isrc is not None:
+            strategies.insert(0, functools.partial(self.__search_by_isrc, a_song))
+        try:
+            url = strategy.first(strategies, deadline or strategy.deadline_in())
+        except song.LookupTimeoutError:
+            # out of time, but a best match can make do with what the title search
+            # has found so far
+            if best_match and len(candidates) > 0:
+                return self.__data_to_url(candidates[0])
+            raise
+        if url is not None:
+            return url
+        if best_match and len(candidates) > 0:
+            return self.__data_to_url(candidates[0])
+
+        # we never found a match, so remember that and
+        misses.record(self.db, a_song, "applemusic")
+        raise song.NoMatchFoundError("No match found for this song.")
+
+    def __search_by_isrc(self, a_song: song.Song, _cancel) -> str | None:
+        """Search Apple Music for a song by ISRC."""
+        track = self.song_by_isrc(a_song.isrc)
+        if track is None:
+            return None
+        self.__commit_song(track)
+        url = self.__data_to_url(track)
+        self.memo.put(("url", a_song.isrc, "applemusic"), url)
+        return url
+
+    def __search_by_title(
+        self, a_song: song.Song, candidates: list, cancel
+    ) -> str | None:
+        """Find a song by title and artist, in the cache and then on Apple Music.
+        Every search result is added to candidates, for a best match."""
+        # a title we've cached on any service may already answer it
+        found = titles.find(self.db, a_song, "applemusic")
+        if found is not None:
+            return found[1]
+        if cancel.is_set():
+            return None
 
-        # if we don't have an isrc or failed to match, search by title and artist
         search_result = self.search(
             f"{a_song.title} {a_song.first_artist}",
             types=["songs"],
@@ -102,32 +181,177 @@ class AppleMusicConverter(applemusicpy.AppleMusic):
         )[
             "results"
         ]  # nb: if on windows...
-        tracks: list = search_result.get("songs").get("data")
-        if isinstance(tracks, list):
-            for track in tracks:
-                track_data = self.repack_data(track)
-                if a_song.isrc == track_data["isrc"]:
-                    self.__commit_song(track_data)
-                    return f"https://music.apple.com/us/album/{track_data['album_id']}\
-                    ?i={track_data['song_id']}"
-            else:  # pylint: disable=w0120
-                if best_match and len(tracks) > 0:
-                    track_data = self.repack_data(tracks[0])
-                    return f"https://music.apple.com/us/album/{track_data['album_id']}?\
-                    i={track_data['song_id']}"
-
-        # we never found a match, so
-        raise song.NoMatchFoundError("No match found for this song.")
+        tracks = (search_result.get("songs") or {}).get("data")
+        if not isinstance(tracks, list):
+            return None
+        found = [self.repack_data(track) for track in tracks]
+        candidates.extend(found)
+        for track_data in found:
+            if a_song.isrc is not None and a_song.isrc == track_data["isrc"]:
+                self.__commit_song(track_data)
+                return self.__data_to_url(track_data)
+        # no isrc to go on, so rank every result by title and artist
+        found_song = match.best(
+            a_song, [self.__data_to_song(track_data) for track_data in found]
+        )
+        if found_song is None:
+            return None
+        track_data = next(data for data in found if data["song_id"] == found_song.uid)
+        self.__commit_song(track_data)
+        return self.__data_to_url(track_data)
 
     def song_by_isrc(self, isrc: str):
         """Search Apple Music for a song by its ISRC. Returns None if none found."""
         data = None
-        track = self.songs_by_isrc([isrc]).get("data")[0]
+        tracks = self.songs_by_isrc([isrc]).get("data")
 
-        if track is not None:
-            data = self.repack_data(track)
+        if tracks:
+            data = self.repack_data(tracks[0])
         return data
 
+    def urls_to_songs(self, urls: list[str]) -> list[song.Song | None]:
+        """Generate Song objs for many Apple Music song URLs at once.
+
+        Cached songs come from memory or a single db query; the rest are fetched
+        ID_BATCH_SIZE at a time from the catalog songs endpoint.
+
+        Args:
+            urls (list[str]): Apple Music song URLs.
+
+        Returns:
+            list[song.Song | None]: A Song obj per URL, in order; None for no match.
+        """
+        song_ids = [self.parse_url(url) for url in urls]
+        found = {}
+        for song_id in song_ids:
+            cached = self.memo.get(("song", "applemusic", song_id))
+            if cached is not None:
+                found[song_id] = cached
+
+        missing = list(dict.fromkeys(i for i in song_ids if i not in found))
+        for track in self.db.query_in(
+            "SELECT * FROM applemusic WHERE songid IN ({marks})", missing
+        ):
+            self.__check_fresh(track[0], track[5])
+            found[track[0]] = self.__row_to_song(track)
+            self.memo.put(("song", "applemusic", track[0]), found[track[0]])
+
+        missing = [i for i in missing if i not in found]
+        for start in range(0, len(missing), self.ID_BATCH_SIZE):
+            batch = missing[start : start + self.ID_BATCH_SIZE]
+            for track in self.songs(batch).get("data", []):
+                data = self.repack_data(track)
+                self.__commit_song(data)
+                result_song = self.__data_to_song(data)
+                self.memo.put(("song", "applemusic", data["song_id"]), result_song)
+                found[data["song_id"]] = result_song
+
+        return [found.get(song_id) for song_id in song_ids]
+
+    def songs_to_urls(
+        self,
+        songs: list[song.Song | None],
+        best_match: bool = False,
+        refresh: bool = False,
+    ) -> list[str | None]:
+        """Convert many songs to Apple Music URLs at once.
+
+        Cached ISRCs come from memory or a single db query, and the rest are looked
+        up ISRC_BATCH_SIZE at a time. Songs that still have no match go through
+        song_to_url side by side.
+
+        Args:
+            songs (list[song.Song | None]): Song objs to search for; None is skipped.
+            best_match (bool, optional): Try and match a best fit? Defaults to False.
+            refresh (bool, optional): Search again even if a song recently came up
+                empty. Defaults to False.
+
+        Returns:
+            list[str | None]: URL per song, in order; None for no match.
+        """
+        results = [None] * len(songs)
+        pending = []
+        for i, a_song in enumerate(songs):
+            if a_song is None:
+                continue
+            if a_song.isrc is not None:
+                results[i] = self.memo.get(("url", a_song.isrc, "applemusic"))
+            if results[i] is None:
+                pending.append(i)
+
+        isrcs = list({songs[i].isrc for i in pending if songs[i].isrc is not None})
+        urls = {}
+        for isrc, songid, albumid, fetched_at in self.db.query_in(
+            "SELECT isrc, songid, albumid, fetched_at FROM applemusic \
+            WHERE isrc IN ({marks})",
+            isrcs,
+        ):
+            self.__check_fresh(songid, fetched_at)
+            urls[isrc] = f"https://music.apple.com/us/album/{albumid}?i={songid}"
+        isrcs = [isrc for isrc in isrcs if isrc not in urls]
+        for start in range(0, len(isrcs), self.ISRC_BATCH_SIZE):
+            batch = isrcs[start : start + self.ISRC_BATCH_SIZE]
+            for track in self.songs_by_isrc(batch).get("data", []):
+                data = self.repack_data(track)
+                if data["isrc"] not in urls:
+                    self.__commit_song(data)
+                    urls[data["isrc"]] = self.__data_to_url(data)
+
+        rest = []
+        for i in pending:
+            url = urls.get(songs[i].isrc)
+            if url is None:
+                rest.append(i)
+                continue
+            results[i] = url
+            self.memo.put(("url", songs[i].isrc, "applemusic"), url)
+
+        with ThreadPoolExecutor(self.BATCH_WORKERS) as pool:
+            found = pool.map(
+                scheduler.carry(
+                    lambda a_song: self.__try_song_to_url(a_song, best_match, refresh)
+                ),
+                [songs[i] for i in rest],
+            )
+            for i, result in zip(rest, found):
+                results[i] = result
+        return results
+
+    def playlist_to_songs(self, url: str) -> list[song.Song]:
+        """Generate Song objs for every song on an Apple Music playlist.
+
+        The playlist listing already carries each song's ISRC, so no further
+        lookups are needed; songs we haven't seen before are added to the db.
+
+        Args:
+            url (str): Apple Music playlist URL.
+
+        Returns:
+            list[song.Song]: Songs on the playlist, in order.
+        """
+        playlist_id = url.split("/")[-1].split("?")[0]
+        tracks = self.playlist(playlist_id)["data"][0]["relationships"]["tracks"]
+        data = [self.repack_data(track) for track in tracks["data"]]
+        while tracks.get("next"):
+            # long playlists come back a page at a time
+            tracks = self._get(f"https://api.music.apple.com{tracks['next']}")
+            data.extend(self.repack_data(track) for track in tracks["data"])
+        return self.__data_to_songs(data)
+
+    def trending_songs(self, limit: int = 50) -> list[song.Song]:
+        """Generate Song objs for what's on the Apple Music song charts right now.
+
+        Args:
+            limit (int, optional): Most songs to take from each chart. Defaults to 50.
+
+        Returns:
+            list[song.Song]: Charting songs, in chart order.
+        """
+        charts = self.charts(types=["songs"], limit=limit)["results"].get("songs", [])
+        return self.__data_to_songs(
+            [self.repack_data(track) for chart in charts for track in chart["data"]]
+        )
+
     @staticmethod
     def repack_data(data) -> dict:
         """Pack data section [0 section] of json into a dict."""
@@ -139,18 +363,318 @@ class AppleMusicConverter(applemusicpy.AppleMusic):
             "track_name": data["attributes"]["name"],
         }
 
+    def album_url_to_album(self, url: str) -> album.Album:
+        """Make an Album obj from an Apple Music album URL.
+
+        Args:
+            url (str): Apple Music album URL.
+
+        Raises:
+            song.NoMatchFoundError: No match found for this URL.
+
+        Returns:
+            album.Album: Album obj from the URL.
+        """
+        album_id = self.parse_album_url(url)
+        row = self.db.query_one(
+            "SELECT upc, title, artist FROM albums \
+            WHERE service='applemusic' AND album_id=?",
+            [album_id],
+        )
+        if row is not None and None not in row:
+            return album.Album("applemusic", album_id, row[0], row[1], row[2])
+
+        found = self.album(album_id).get("data")
+        if not found:
+            raise song.NoMatchFoundError("No match found for this URL.")
+        result = self.__album_data_to_album(found[0])
+        self.__commit_album(result)
+        return result
+
+    def album_to_url(self, an_album: album.Album, best_match: bool = False) -> str:
+        """Convert an album obj to an Apple Music URL.
+
+        Args:
+            an_album (album.Album): album obj
+            best_match (bool, optional): Try and match a best fit? Defaults to False.
+
+        Raises:
+            song.NoMatchFoundError: No match found for this album.
+
+        Returns:
+            str: Apple Music URL of the matching album
+        """
+        # first, check the database and then apple music for the upc if we have one
+        if an_album.upc is not None:
+            row = self.db.query_one(
+                "SELECT url FROM albums WHERE service='applemusic' AND upc=? limit 1",
+                [an_album.upc],
+            )
+            if row is not None:
+                return row[0]
+
+            # apple has some albums under a 12 digit upc and some under a 13 digit ean
+            found = self._get(
+                "https://api.music.apple.com/v1/catalog/us/albums",
+                **{"filter[upc]": f"{an_album.padded(12)},{an_album.padded(13)}"},
+            ).get("data")
+            if found:
+                return self.__commit_album(self.__album_data_to_album(found[0]))
+
+        # if we don't have a upc or failed to match, search by title and artist
+        albums = (
+            self.search(
+                f"{an_album.title} {an_album.first_artist}",
+                types=["albums"],
+                limit=5,
+                os="windows",
+            )["results"]
+            .get("albums", {})
+            .get("data", [])
+        )
+        for data in albums:
+            candidate = self.__album_data_to_album(data)
+            if candidate == an_album or an_album.is_similar(candidate):
+                return self.__commit_album(candidate)
+        if best_match and albums:
+            return self.__album_url(albums[0]["id"])
+
+        raise song.NoMatchFoundError("No match found for this album.")
+
+    def linked_album_urls(self, url: str) -> dict[str, str]:
+        """Get every other service's URL we already know for this album, from the db.
+
+        Args:
+            url (str): Apple Music album URL.
+
+        Returns:
+            dict[str, str]: Maps service name to URL; empty if nothing is linked yet.
+        """
+        return recordings.resolve_album(
+            self.db.cursor(), "applemusic", self.parse_album_url(url)
+        )
+
+    @staticmethod
+    def parse_album_url(url: str) -> str:
+        """Strip an album URL down to the albumid."""
+        return url.split("?")[0].rstrip("/").split("/")[-1]
+
+    def _get(self, url, **kwargs):
+        """GET from the API, sending it again after a 429 or a 5xx, up to max_retries
+        times in all.
+
+        This replaces applemusicpy's own loop, which slept the thread between tries
+        (whatever Retry-After said) and gave back None once it ran out. Here each try
+        waits its turn in the scheduler, which a 429 has already pushed back, and
+        the last failure is raised."""
+        tries_left = max(self.max_retries, 1)
+        while True:
+            tries_left -= 1
+            try:
+                return self._call("GET", url, kwargs)
+            except requests.exceptions.HTTPError as e:
+                status = 0 if e.response is None else e.response.status_code
+                if not tries_left or not (status == 429 or 500 <= status < 600):
+                    raise
+
+    def _call(self, method, url, params):
+        """Every applemusicpy request goes through here, one try at a time; wait our
+        turn, and back off everybody if Apple tells us to slow down."""
+        self.limiter.acquire("applemusic")
+        try:
+            with metrics.shared().timer(
+                "upstream_seconds", service="applemusic", call=metrics.endpoint(url)
+            ):
+                return super()._call(method, url, params)
+        except requests.exceptions.HTTPError as e:
+            status = "unknown" if e.response is None else e.response.status_code
+            metrics.shared().inc(
+                "upstream_errors_total", service="applemusic", status=status
+            )
+            if status == 429:
+                self.limiter.back_off(
+                    "applemusic", scheduler.retry_after(e.response.headers)
+                )
+            raise
+
+    def revalidate(self, song_id: str):
+        """Fetch a cached song again, and update or drop its rows.
+
+        Args:
+            song_id (str): Apple Music ID of the song.
+        """
+        try:
+            tracks = self.song(song_id).get("data")
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            tracks = None
+        if not tracks:
+            self.__forget_song(song_id)
+            return
+        data = self.repack_data(tracks[0])
+        self.__commit_song(data)
+        # if the song has moved to another album, the old album's URL is dead
+        self.db.execute(
+            "DELETE FROM applemusic WHERE songid=? AND albumid!=?",
+            [song_id, data["album_id"]],
+        )
+
+    def revalidate_later(self, song_id: str):
+        """Queue a re-check of a cached song on the revalidator's thread, e.g. once
+        it's been served stale from the recordings table."""
+        self.revalidator.submit(("applemusic", song_id), self.revalidate, song_id)
+
+    def __check_fresh(self, song_id: str, fetched_at: float | None):
+        """Queue a re-check of a cached song if it's stale; it's served either way."""
+        if freshness.is_stale(fetched_at):
+            self.revalidate_later(song_id)
+
+    def __try_song_to_url(self, a_song: song.Song, best_match: bool, refresh: bool):
+        """song_to_url, but None instead of raising when there's no match."""
+        try:
+            return self.song_to_url(a_song, best_match=best_match, refresh=refresh)
+        except song.NoMatchFoundError:
+            return None
+
+    @staticmethod
+    def __row_to_song(row) -> song.Song:
+        """Make a Song obj from an applemusic table row."""
+        return song.Song(
+            source="applemusic",
+            uid=(row[0]),  # we pass only the songid, not albumid
+            isrc=row[2],
+            title=row[3],
+            first_artist=row[4],
+        )
+
+    def __data_to_songs(self, data: list[dict]) -> list[song.Song]:
+        """Make Song objs from repacked song data, adding any new ones to the db."""
+        known = {
+            row[0]
+            for row in self.db.query_in(
+                "SELECT songid FROM applemusic WHERE songid IN ({marks})",
+                {track["song_id"] for track in data},
+            )
+        }
+        songs = []
+        for track in data:
+            if track["song_id"] not in known:
+                known.add(track["song_id"])
+                self.__commit_song(track)
+            songs.append(self.__data_to_song(track))
+        return songs
+
+    @staticmethod
+    def __data_to_song(data: dict) -> song.Song:
+        """Make a Song obj from repacked song data."""
+        return song.Song(
+            source="applemusic",
+            uid=data["song_id"],
+            isrc=data["isrc"],
+            title=data["track_name"],
+            first_artist=data["artist_name"],
+        )
+
+    @staticmethod
+    def __data_to_url(data: dict) -> str:
+        """Make an Apple Music URL from repacked song data."""
+        return f"https://music.apple.com/us/album/{data['album_id']}?i={data['song_id']}"
+
+    @staticmethod
+    def __album_url(album_id: str) -> str:
+        """Make an Apple Music URL for an album."""
+        return f"https://music.apple.com/us/album/{album_id}"
+
+    @staticmethod
+    def __album_data_to_album(data: dict) -> album.Album:
+        """Make an Album obj from an album resource."""
+        return album.Album(
+            source="applemusic",
+            uid=data["id"],
+            upc=data["attributes"].get("upc"),
+            title=data["attributes"]["name"],
+            first_artist=data["attributes"]["artistName"],
+        )
+
+    @classmethod
+    def __commit_album(cls, an_album: album.Album) -> str:
+        """Add an album to the database, and return its URL."""
+        print(f"Made an album commit to applemusic: {an_album.upc}")
+        url = cls.__album_url(an_album.uid)
+        cls.db.write(
+            recordings.link_album,
+            "applemusic",
+            an_album.uid,
+            an_album.upc,
+            an_album.title,
+            an_album.first_artist,
+            url,
+        )
+        return url
+
     @classmethod
     def __commit_song(cls, data: dict):
         """Add a song to the database."""
         print(f"Made a commit to applemusic: {data['isrc']}")
-        cls.cur.execute(
-            "INSERT INTO applemusic(songid, albumid, isrc, title, artist) VALUES \
-                        (:song_id, :album_id, :isrc, :track_name, :artist_name) ON CONFLICT\
-                        (songid, albumid) DO UPDATE SET isrc=:isrc, title=:track_name, \
-                        artist=:artist_name",
-            data,
+        misses.forget(cls.db, cls.__data_to_song(data), "applemusic")
+        cls.db.execute(
+            "INSERT INTO applemusic(songid, albumid, isrc, title, artist, fetched_at) \
+                        VALUES (:song_id, :album_id, :isrc, :track_name, :artist_name, \
+                        :fetched_at) ON CONFLICT (songid, albumid) DO UPDATE SET \
+                        isrc=:isrc, title=:track_name, artist=:artist_name, \
+                        fetched_at=:fetched_at",
+            {**data, "fetched_at": time.time()},
+        )
+        cls.db.write(
+            recordings.link,
+            "applemusic",
+            data["song_id"],
+            data["isrc"],
+            cls.__data_to_url(data),
+        )
+        # not before the upsert lands, or a read in between memoizes the old row
+        cls.db.after_commit(
+            cls.memo.invalidate,
+            ("song", "applemusic", data["song_id"]),
+            ("url", data["isrc"], "applemusic"),
         )
-        cls.con.commit()
+
+    @classmethod
+    def __forget_song(cls, song_id: str):
+        """Drop a song that's gone from Apple Music from the database."""
+        print(f"Dropped a pulled song from applemusic: {song_id}")
+        rows = cls.db.query("SELECT isrc FROM applemusic WHERE songid=?", [song_id])
+        cls.db.execute("DELETE FROM applemusic WHERE songid=?", [song_id])
+        cls.db.write(recordings.unlink, "applemusic", song_id)
+        cls.db.after_commit(
+            cls.memo.invalidate,
+            ("song", "applemusic", song_id),
+            *(("url", row[0], "applemusic") for row in rows),
+        )
+
+    # the registry.Converter protocol
+    to_song = url_to_song
+    to_url = song_to_url
+    to_songs = urls_to_songs
+    to_urls = songs_to_urls
+
+    def linked_urls(self, url: str) -> dict[str, tuple]:
+        """Get every other service's URL we already know for this song, from the db only.
+
+        Args:
+            url (str): Apple Music song URL.
+
+        Returns:
+            dict[str, tuple]: Maps service name to (platform ID, URL, fetched_at),
+                as recordings.resolve does; empty if nothing is linked yet.
+        """
+        return recordings.resolve(self.db.cursor(), "applemusic", self.parse_url(url))
+
+    @classmethod
+    def parse_url(cls, url: str) -> str:
+        """Strip the URL down to the songid."""
+        return cls.__trim_url(url).split("?i=")[-1]
 
     @staticmethod
     def __trim_url(url: str) -> str:
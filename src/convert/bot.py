@@ -16,30 +16,39 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import asyncio
 from os import environ
 from enum import Enum
 from dotenv import load_dotenv
+
+# before our own modules, which read their settings from the environment on import
+load_dotenv()
+# pylint: disable=wrong-import-position
 import discord
 from discord import app_commands
-import spotify
-import ytmusic
-import applemusic
+import cache
+import engine
+import metrics
+import services
+import warmer
+import workers
 import song as sng
+# pylint: enable=wrong-import-position
 
 # constants
-load_dotenv()
 DISCORD_TOKEN = environ.get("DISCORD_TOKEN")
 print(DISCORD_TOKEN)
 OWNER_ID = environ.get("OWNER_ID")
 MY_GUILD_ID = environ.get("MY_GUILD_ID")
 
-SP_CLIENT_ID = environ.get("SP_CLIENT_ID")
-SP_CLIENT_SCRT = environ.get("SP_CLIENT_SCRT")
-SP_REDIRECT_URI = environ.get("SP_REDIRECT_URI")
-
-AP_SECRET_KEY = environ.get("AP_SECRET_KEY")
-AP_KEY_ID = environ.get("AP_KEY_ID")
-AP_TEAM_ID = environ.get("AP_TEAM_ID")
+# after a /song, convert it to the other services too, so follow-ups are instant
+SPECULATE = environ.get("SPECULATE", "0") == "1"
+# serve Prometheus metrics on this port (0 for off), and/or print them every so
+# many seconds (0 for off)
+METRICS_PORT = int(environ.get("METRICS_PORT", 0))
+METRICS_DUMP = float(environ.get("METRICS_DUMP", 0))
+# run conversions in this many worker processes instead of threads in this one (0)
+WORKER_PROCESSES = int(environ.get("WORKER_PROCESSES", 0))
 
 MY_GUILD = discord.Object(id=MY_GUILD_ID)
 # endregion
@@ -52,33 +61,63 @@ class NoServiceMatchedError(Exception):
     pass
 
 
-SERVICES = Enum(
-    "Services",
-    [("Spotify", "spotify"), ("Apple Music", "applemusic"), ("YT Music", "ytmusic")],
-)
-
-
 class MyClient(discord.Client):
     """Client class"""
 
     def __init__(self, *, intents: discord.Intents):
         super().__init__(intents=intents)
         self.tree = app_commands.CommandTree(self)
+        self.background = set()  # long-running tasks, kept so they aren't collected
 
     async def setup_hook(self):
         # This copies the global commands over to your guild.
         self.tree.copy_global_to(guild=MY_GUILD)
         await self.tree.sync(guild=MY_GUILD)
         print(f"Copied globals to guild {MY_GUILD.id}")
+        # convert what's charting in quiet hours, at background priority
+        warming = warmer.CacheWarmer(conversions).start()
+        if warming is not None:
+            self.background.add(warming)
+        stats = metrics.shared()
+        stats.gauge("memo_entries", lambda: cache.shared().stats()["size"])
+        stats.gauge(
+            "memo_lookups",
+            lambda: {
+                (("result", result),): cache.shared().stats()[result + "s"]
+                for result in ("hit", "miss")
+            },
+        )
+        if METRICS_PORT:
+            self.background.add(asyncio.create_task(stats.serve(port=METRICS_PORT)))
+        if METRICS_DUMP:
+            self.background.add(asyncio.create_task(stats.dump_every(METRICS_DUMP)))
+
+    async def close(self):
+        # stop our own tasks and conversions first, so none of them is left
+        # talking to a closed gateway
+        for task in self.background:
+            task.cancel()
+        await asyncio.gather(*self.background, return_exceptions=True)
+        self.background.clear()
+        conversions.shutdown()
+        await super().close()
 
 
 # endregion
 
 
-# make API objs
-sp = spotify.SpotifyConverter(SP_CLIENT_ID, SP_CLIENT_SCRT)
-yt = ytmusic.YTMusicConverter()
-am = applemusic.AppleMusicConverter(AP_SECRET_KEY, AP_KEY_ID, AP_TEAM_ID)
+# region Converters
+converters = services.enabled()
+if WORKER_PROCESSES:
+    converters = workers.remote(converters, WORKER_PROCESSES)
+
+SERVICES = Enum("Services", [(converters.labels[name], name) for name in converters])
+
+# every converter call blocks on the network, so they're all awaited through the engine
+conversions = engine.ConversionEngine(
+    converters, max_workers=max(8, WORKER_PROCESSES), speculative=SPECULATE
+)
+# endregion
 
 # back to discord
 intents = discord.Intents.default()
@@ -94,19 +133,45 @@ async def on_ready():
 
 
 # region Song Command
+async def reply(interaction: discord.Interaction, *args, **kwargs):
+    """Send a followup, timing how long Discord takes to take it."""
+    with metrics.shared().timer("discord_followup_seconds"):
+        return await interaction.followup.send(*args, **kwargs)
+
+
+async def source_service(
+    interaction: discord.Interaction, service_from: SERVICES | None, url: str
+) -> str:
+    """Get the service a command converts from: the one picked, or else the one
+    the URL belongs to."""
+    if service_from is not None:
+        return service_from.value
+    source = converters.detect(url)
+    if source is None:
+        await reply(
+            interaction,
+            "Couldn't tell which service that URL is from; pick one with service_from.",
+            ephemeral=True,
+        )
+        raise NoServiceMatchedError("No service matched.")
+    return source
+
+
 @client.tree.command()
 @app_commands.describe(
-    service_from="Service we're converting the song from",
+    service_from="Service we're converting the song from (default: guess from the URL)",
     service_to="Service we're converting the song to",
     url="URL of the song",
     best_match="If we can't find an exact match, should we search for a best match",
+    refresh="Search again, even if this song wasn't found recently",
 )
 async def song(
     interaction: discord.Interaction,
-    service_from: SERVICES,
     service_to: SERVICES,
     url: str,
+    service_from: SERVICES = None,
     best_match: bool = False,
+    refresh: bool = False,
 ):
     """Find this song on another streaming platform."""
     # this can be a while with network calls, so defer completion to avoid a timeout.
@@ -114,68 +179,156 @@ async def song(
     # remove our follow-up message if we fail, and then raise the exception again.
     await interaction.response.defer(ephemeral=True)
     try:
-        # convert to song obj
         print("URL received :", url)
-        picked_service = service_from.value if service_from is not None else None
-        song_obj = None
+        source = await source_service(interaction, service_from, url)
+        target = service_to.value
+
+        # if both ends of this are already linked by isrc, we don't need a song obj
+        linked = await conversions.linked_url(source, target, url)
+        if linked is not None:
+            await reply(interaction, linked)
+            return
+
+        # convert to song obj, then song obj to new service
+        print(f"From: {converters.labels[source]}")
+        print(f"To: {converters.labels[target]}")
         try:
-            match picked_service:
-                case "spotify":
-                    print("From: Spotify")
-                    song_obj = sp.uri_to_song(url)
-                case "applemusic":
-                    print("From: Apple Music")
-                    song_obj = am.url_to_song(url)
-                case "ytmusic":
-                    print("From: YT Music")
-                    song_obj = yt.url_to_song(url)
-                case _:
-                    await interaction.followup.send(
-                        "No service matched. Contact the \
-                                                    bot owner about how you did this!",
-                        ephemeral=True,
-                    )
-                    raise NoServiceMatchedError("No service matched.")
+            song_obj = await conversions.to_song(source, url)
         except sng.NoMatchFoundError:
-            await interaction.followup.send(
+            await reply(
+                interaction,
                 "No match found for this URL!", ephemeral=True
             )
-
-        # convert song obj to new service
-        picked_service = service_to.value if service_to is not None else None
-        url = " "
+            return
         try:
-            match picked_service:
-                case "spotify":
-                    print("To: Spotify")
-                    url = sp.song_to_url(song_obj)
-                case "applemusic":
-                    print("To: Apple Music")
-                    url = am.song_to_url(song_obj, best_match=best_match)
-                case "ytmusic":
-                    print("To: YT Music")
-                    url = yt.song_to_url(song_obj, best_match=best_match)
-                case _:
-                    await interaction.followup.send(
-                        "No service matched. Contact the \
-                                                    bot owner about how you did this!",
-                        ephemeral=True,
-                    )
-                    raise NoServiceMatchedError("No service matched.")
-        except sng.NoMatchFoundError:
-            await interaction.followup.send(
-                "No match found for this URL!", ephemeral=True
+            url = await conversions.to_url(
+                target, song_obj, best_match=best_match, refresh=refresh
             )
+        except sng.NoMatchFoundError:
+            await reply(interaction, "No match found.", ephemeral=True)
+            return
 
         # send out what url we got
-        if url == " ":
-            await interaction.followup.send("No match found.", ephemeral=True)
-        await interaction.followup.send(url)
+        await reply(interaction, url)
+        conversions.speculate(song_obj, {source, target})
 
+    except NoServiceMatchedError:
+        return  # source_service has already said so
     # if we get a generic error, un-promise the followup, then continue raising
     except Exception as e:
         print(f"Error: {e} of class {e.__class__}")
-        await interaction.followup.send(
+        await reply(
+            interaction,
+            "An error occurred! Check your inputs.", ephemeral=True
+        )
+        raise e
+
+
+# endregion
+
+# region Album Command
+@client.tree.command()
+@app_commands.describe(
+    service_from="Service we're converting the album from (default: from the URL)",
+    service_to="Service we're converting the album to",
+    url="URL of the album",
+    best_match="If we can't find an exact match, should we search for a best match",
+)
+async def album(
+    interaction: discord.Interaction,
+    service_to: SERVICES,
+    url: str,
+    service_from: SERVICES = None,
+    best_match: bool = False,
+):
+    """Find this album on another streaming platform."""
+    await interaction.response.defer(ephemeral=True)
+    try:
+        print("Album received :", url)
+        source = await source_service(interaction, service_from, url)
+        # albums we've matched before are joined by upc, so no API calls needed
+        linked = await conversions.linked_album_url(source, service_to.value, url)
+        if linked is not None:
+            await reply(interaction, linked)
+            return
+
+        try:
+            album_obj = await conversions.to_album(source, url)
+            found = await conversions.album_to_url(
+                service_to.value, album_obj, best_match=best_match
+            )
+        except sng.NoMatchFoundError:
+            await reply(interaction, "No match found.", ephemeral=True)
+            return
+        await reply(interaction, found)
+
+    except NoServiceMatchedError:
+        return  # source_service has already said so
+    except Exception as e:
+        print(f"Error: {e} of class {e.__class__}")
+        await reply(
+            interaction,
+            "An error occurred! Check your inputs.", ephemeral=True
+        )
+        raise e
+
+
+# endregion
+
+# region Playlist Command
+MESSAGE_LIMIT = 2000  # most characters discord allows in one message
+
+
+def chunk_lines(lines: list[str]) -> list[str]:
+    """Pack lines into as few messages as fit under discord's message limit."""
+    messages = [""]
+    for line in lines:
+        if len(messages[-1]) + len(line) + 1 > MESSAGE_LIMIT:
+            messages.append("")
+        messages[-1] += line + "\n"
+    return [message for message in messages if message]
+
+
+@client.tree.command()
+@app_commands.describe(
+    service_from="Service we're converting the playlist from (default: from the URL)",
+    service_to="Service we're converting the songs to",
+    url="URL of the playlist",
+    best_match="If we can't find an exact match, should we search for a best match",
+)
+async def playlist(
+    interaction: discord.Interaction,
+    service_to: SERVICES,
+    url: str,
+    service_from: SERVICES = None,
+    best_match: bool = False,
+):
+    """Find every song on a playlist on another streaming platform."""
+    await interaction.response.defer(ephemeral=True)
+    try:
+        print("Playlist received :", url)
+        source = await source_service(interaction, service_from, url)
+        songs = await conversions.playlist_to_songs(source, url)
+        urls = await conversions.to_urls(
+            service_to.value, songs, best_match=best_match
+        )
+        # angle brackets keep discord from embedding a preview for every link
+        lines = [
+            f"<{found}>" if found is not None else f"No match: {a_song.title} - "
+            f"{a_song.first_artist}"
+            for a_song, found in zip(songs, urls)
+        ]
+        if not lines:
+            await reply(interaction, "That playlist is empty.", ephemeral=True)
+        for message in chunk_lines(lines):
+            await reply(interaction, message)
+
+    except NoServiceMatchedError:
+        return  # source_service has already said so
+    except Exception as e:
+        print(f"Error: {e} of class {e.__class__}")
+        await reply(
+            interaction,
             "An error occurred! Check your inputs.", ephemeral=True
         )
         raise e
@@ -191,23 +344,35 @@ async def song(
 )
 async def upc(
     interaction: discord.Interaction,
-    upc: int
+    upc: str
 ):
     """Gets the Spotify album corresponding to a UPC.
     This will accept any UPC, from a physical release for example,
     and go off and fetch the corresponding Spotify album."""
     await interaction.response.defer(ephemeral=True)
+    if "spotify" not in converters:
+        await reply(
+            interaction,
+            "Spotify isn't available on this bot.",
+            ephemeral=True
+        )
+        return
     try:
-        release = sp.get_release_for_barcode(upc)
-        digi = sp.get_digital_releases_from_title_and_artist(release['title'],
-                                                    release['artists'][0]['name'])
-        url = next(sp.find_sp_albums_from_upcs)
-        sp.find_sp_albums_from_upcs.close()
-        await interaction.followup.send(
+        url = await conversions.barcode_to_album(upc.strip())
+        if url is None:
+            await reply(
+                interaction,
+                "No Spotify album found for that barcode.",
+                ephemeral=True
+            )
+            return
+        await reply(
+            interaction,
             url
         )
     except Exception as e:
-        await interaction.followup.send(
+        await reply(
+            interaction,
             "An error occurred.",
             ephemeral=True
         )
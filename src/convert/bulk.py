@@ -0,0 +1,425 @@
+"""Bulk import and export of the song cache, without going through the APIs.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Run from src/convert:
+    python bulk.py export songs.jsonl.gz
+    python bulk.py import songs.jsonl.gz           # an export, from another node
+    python bulk.py import isrcs.csv --service spotify --map platform_id=track_id
+
+An export is gzipped JSON lines: a header, then chunks of up to CHUNK_SIZE rows of
+one table, stored column by column so similar values sit together and compress
+well. Mapping files (CSV, TSV, JSONL, optionally gzipped, or Parquet if pyarrow is
+installed) have a row per song with the columns in MAPPING_COLUMNS."""
+
+import argparse
+import contextlib
+import csv
+import gzip
+import json
+import sqlite3
+import sys
+import time
+import recordings
+import schema
+import song
+import storage
+
+FORMAT = "streamconverter-cache"
+CHUNK_SIZE = 50_000  # rows per executemany, and per chunk of an export
+# tables an export carries, and the key each is upserted on; misses are left out
+# as they're short-lived, and titles and title_keys as the triggers rebuild them
+# from the rest
+TABLES = {
+    "spotify": ("uid",),
+    "ytmusic": ("uid",),
+    "applemusic": ("songid", "albumid"),
+    "recordings": ("service", "platform_id"),
+    "albums": ("service", "album_id"),
+    "barcodes": ("barcode",),
+}
+# the uid and artist columns of each song table, to clear the misses an export's
+# songs answer
+EXPORT_SONGS = {
+    "spotify": ("uid", "first_artist"),
+    "ytmusic": ("uid", "first_artist"),
+    "applemusic": ("songid", "artist"),
+}
+# what a mapping file's columns mean; service and platform_id are required, and an
+# isrc or a title and artist to look the song up by. songs without an isrc are
+# cached, but not linked to other services
+MAPPING_COLUMNS = (
+    "service",  # spotify, applemusic or ytmusic
+    "platform_id",  # uid, videoId or songid
+    "isrc",
+    "title",
+    "artist",
+    "album_id",  # required for applemusic, whose URLs include it
+    "fetched_at",  # seconds since the epoch; empty means re-check on first use
+)
+SONG_URLS = {
+    "spotify": "https://open.spotify.com/track/{platform_id}",
+    "ytmusic": "https://music.youtube.com/watch?v={platform_id}",
+    "applemusic": "https://music.apple.com/us/album/{album_id}?i={platform_id}",
+}
+# mapped rows land in each service's table through these. a mapping has no say on
+# fields it leaves empty, so those keep whatever the cache already had
+SONG_UPSERTS = {
+    "spotify": "INSERT INTO spotify(uid, isrc, title, first_artist, fetched_at) \
+        VALUES (?, ?, ?, ?, ?) ON CONFLICT(uid) DO UPDATE SET \
+        isrc=coalesce(excluded.isrc, spotify.isrc), \
+        title=coalesce(excluded.title, spotify.title), \
+        first_artist=coalesce(excluded.first_artist, spotify.first_artist), \
+        fetched_at=coalesce(excluded.fetched_at, spotify.fetched_at)",
+    "ytmusic": "INSERT INTO ytmusic(uid, isrc, title, first_artist, fetched_at) \
+        VALUES (?, ?, ?, ?, ?) ON CONFLICT(uid) DO UPDATE SET \
+        isrc=coalesce(excluded.isrc, ytmusic.isrc), \
+        title=coalesce(excluded.title, ytmusic.title), \
+        first_artist=coalesce(excluded.first_artist, ytmusic.first_artist), \
+        fetched_at=coalesce(excluded.fetched_at, ytmusic.fetched_at)",
+    "applemusic": "INSERT INTO applemusic(songid, albumid, isrc, title, artist, \
+        fetched_at) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(songid, albumid) DO UPDATE \
+        SET isrc=coalesce(excluded.isrc, applemusic.isrc), \
+        title=coalesce(excluded.title, applemusic.title), \
+        artist=coalesce(excluded.artist, applemusic.artist), \
+        fetched_at=coalesce(excluded.fetched_at, applemusic.fetched_at)",
+}
+
+
+def connect(path: str = storage.DB_PATH) -> sqlite3.Connection:
+    """Open songs.db for a bulk load, bringing its schema up to date first."""
+    con = sqlite3.connect(path, isolation_level=None, timeout=60)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    schema.migrate(con)
+    return con
+
+
+def export(con: sqlite3.Connection, path: str, tables=TABLES) -> dict:
+    """Write the cache out in the export format.
+
+    Args:
+        con (sqlite3.Connection): Connection to the song cache.
+        path (str): File to write; gzipped whatever its name.
+        tables (Iterable[str], optional): Tables to export. Defaults to TABLES.
+
+    Returns:
+        dict: Rows written, by table.
+    """
+    counts = {}
+    # one read transaction, so the tables are a consistent snapshot of each other
+    con.execute("BEGIN")
+    try:
+        with gzip.open(path, "wt", encoding="utf-8") as out:
+            header = {"format": FORMAT, "schema": schema.version(con)}
+            out.write(json.dumps(header) + "\n")
+            for table in tables:
+                columns = _columns(con, table)
+                # in key order, so neighbouring IDs compress against each other
+                cur = con.execute(
+                    f"SELECT {', '.join(columns)} FROM {table} \
+                    ORDER BY {', '.join(TABLES[table])}"
+                )
+                counts[table] = 0
+                while rows := cur.fetchmany(CHUNK_SIZE):
+                    chunk = {
+                        "table": table,
+                        "columns": dict(zip(columns, map(list, zip(*rows)))),
+                    }
+                    out.write(json.dumps(chunk, separators=(",", ":")) + "\n")
+                    counts[table] += len(rows)
+    finally:
+        con.execute("COMMIT")
+    return counts
+
+
+def load_export(con: sqlite3.Connection, path: str, replace: bool = False) -> dict:
+    """Load an export into the cache, in one transaction.
+
+    Songs already cached are only replaced by fresher copies (by fetched_at); rows
+    of the other tables are only added, unless replace is set. Misses the imported
+    songs answer are cleared.
+
+    Args:
+        con (sqlite3.Connection): Connection to the song cache.
+        path (str): An export, as written by export().
+        replace (bool, optional): Let every imported row replace the cached one.
+            Defaults to False.
+
+    Raises:
+        ValueError: The file isn't an export.
+
+    Returns:
+        dict: Rows read, by table.
+    """
+    counts = {}
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        header = json.loads(file.readline() or "{}")
+        if header.get("format") != FORMAT:
+            raise ValueError(f"{path} isn't a songs.db export")
+        with _transaction(con):
+            statements = {}
+            for line in file:
+                chunk = json.loads(line)
+                table = chunk["table"]
+                if table not in TABLES:
+                    continue  # from a newer version; nothing here to put it in
+                if table not in statements:
+                    statements[table] = _upsert(con, table, replace)
+                sql, columns = statements[table]
+                values = [chunk["columns"].get(column) for column in columns]
+                present = [v for v in values if v is not None]
+                if not present:
+                    continue  # only columns we don't have, from a newer version
+                # a column the export didn't have comes through as None
+                length = len(present[0])
+                values = [v if v is not None else [None] * length for v in values]
+                rows = list(zip(*values))
+                con.executemany(sql, rows)
+                _forget_misses(con, _exported_songs(table, columns, rows))
+                counts[table] = counts.get(table, 0) + length
+    return counts
+
+
+def load_mappings(con: sqlite3.Connection, rows) -> dict:
+    """Load ISRC to platform ID mappings into the cache, in one transaction.
+
+    Each song lands in its service's table and, if it has an ISRC, is linked to
+    every other service's copy of it, just as if it had been converted.
+
+    Args:
+        con (sqlite3.Connection): Connection to the song cache.
+        rows (Iterable[dict]): Mappings keyed by MAPPING_COLUMNS.
+
+    Returns:
+        dict: Songs loaded by service, how many were skipped as not for a service
+            we know, and how many were rejected as having nothing to find them by.
+    """
+    counts = {"skipped": 0, "rejected": 0}
+    with _transaction(con):
+        batch = []
+        for row in rows:
+            service = (row.get("service") or "").strip().lower()
+            platform_id = (row.get("platform_id") or "").strip()
+            album_id = (row.get("album_id") or "").strip() or None
+            if (
+                service not in SONG_UPSERTS
+                or not platform_id
+                or (service == "applemusic" and album_id is None)
+            ):
+                counts["skipped"] += 1
+                continue
+            isrc = (row.get("isrc") or "").strip().lower() or None
+            title = row.get("title") or None
+            artist = row.get("artist") or None
+            if isrc is None and (title is None or artist is None):
+                counts["rejected"] += 1
+                continue
+            fetched_at = row.get("fetched_at")
+            fetched_at = float(fetched_at) if fetched_at not in (None, "") else None
+            batch.append(
+                (service, platform_id, album_id, isrc, title, artist, fetched_at)
+            )
+            counts[service] = counts.get(service, 0) + 1
+            if len(batch) >= CHUNK_SIZE:
+                _write_mappings(con, batch)
+                batch = []
+        _write_mappings(con, batch)
+    return counts
+
+
+def read_mappings(path: str, service: str = None, names: dict = None, delimiter=None):
+    """Read a mapping file a row at a time.
+
+    Args:
+        path (str): A .csv, .tsv, .jsonl or .parquet file; text files may be .gz.
+        service (str, optional): Service of every row, for files without a service
+            column. Defaults to None.
+        names (dict, optional): Maps our column names to the file's, for files
+            that call them something else. Defaults to None.
+        delimiter (str, optional): Field separator of a CSV. Defaults to a comma,
+            or a tab for .tsv.
+
+    Yields:
+        dict: A row keyed by MAPPING_COLUMNS.
+    """
+    names = names or {}
+    if path.endswith(".parquet"):
+        try:
+            from pyarrow import parquet  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            sys.exit("Reading Parquet needs pyarrow: pip install pyarrow")
+        records = (
+            record
+            for batch in parquet.ParquetFile(path).iter_batches(batch_size=CHUNK_SIZE)
+            for record in batch.to_pylist()
+        )
+        yield from _rename(records, service, names)
+        return
+
+    plain = path[:-3] if path.endswith(".gz") else path
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as file:
+        if plain.endswith((".jsonl", ".ndjson")):
+            records = (json.loads(line) for line in file if line.strip())
+        else:
+            if delimiter is None:
+                delimiter = "\t" if plain.endswith(".tsv") else ","
+            records = csv.DictReader(file, delimiter=delimiter)
+        yield from _rename(records, service, names)
+
+
+def _rename(records, service: str | None, names: dict):
+    for record in records:
+        row = {
+            column: record.get(names.get(column, column)) for column in MAPPING_COLUMNS
+        }
+        if service is not None and not row["service"]:
+            row["service"] = service
+        yield row
+
+
+def _write_mappings(con: sqlite3.Connection, batch: list):
+    """Write one chunk of mapped songs: their service tables, then recordings,
+    then clear any misses they answer."""
+    for service, sql in SONG_UPSERTS.items():
+        rows = [row for row in batch if row[0] == service]
+        if service == "applemusic":
+            con.executemany(sql, [(row[1], row[2], *row[3:]) for row in rows])
+        else:
+            con.executemany(sql, [(row[1], *row[3:]) for row in rows])
+    linked = [row for row in batch if row[3] is not None]
+    recordings.link_many(
+        con.cursor(),
+        (
+            (
+                service,
+                platform_id,
+                isrc,
+                SONG_URLS[service].format(platform_id=platform_id, album_id=album_id),
+            )
+            for service, platform_id, album_id, isrc, *_ in linked
+        ),
+    )
+    _forget_misses(con, (song.Song(row[0], row[1], *row[3:6]) for row in batch))
+
+
+def _exported_songs(table: str, columns: list, rows: list):
+    """The songs an export's rows of a table cache, as far as misses go."""
+    if table == "recordings":
+        for row in rows:
+            row = dict(zip(columns, row))
+            yield song.Song(row["service"], row["platform_id"], row["isrc"], None, None)
+    elif table in EXPORT_SONGS:
+        uid, artist = EXPORT_SONGS[table]
+        for row in rows:
+            row = dict(zip(columns, row))
+            yield song.Song(table, row[uid], row["isrc"], row["title"], row[artist])
+
+
+def _forget_misses(con: sqlite3.Connection, songs):
+    """Clear the misses on each song's own service that it now answers, in the
+    transaction that cached it (see misses.forget)."""
+    con.executemany(
+        "DELETE FROM misses WHERE lookup=? AND service=?",
+        ((key, a_song.source) for a_song in songs for key in a_song.lookup_keys()),
+    )
+
+
+def _columns(con: sqlite3.Connection, table: str) -> list[str]:
+    return [row[1] for row in con.execute(f"PRAGMA table_info({table})")]
+
+
+def _upsert(con: sqlite3.Connection, table: str, replace: bool) -> tuple:
+    """Build the INSERT an export's rows of a table go in through."""
+    columns = _columns(con, table)
+    keys = TABLES[table]
+    sql = f"INSERT INTO {table}({', '.join(columns)}) \
+        VALUES ({', '.join('?' * len(columns))}) ON CONFLICT({', '.join(keys)}) "
+    updates = ", ".join(
+        f"{column}=excluded.{column}" for column in columns if column not in keys
+    )
+    if replace and updates:
+        sql += f"DO UPDATE SET {updates}"
+    elif "fetched_at" in columns:
+        sql += f"DO UPDATE SET {updates} \
+            WHERE excluded.fetched_at > coalesce({table}.fetched_at, 0)"
+    else:
+        sql += "DO NOTHING"
+    return sql, columns
+
+
+@contextlib.contextmanager
+def _transaction(con: sqlite3.Connection):
+    """Run a block in one write transaction, rolled back if it fails."""
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
+
+
+def main():
+    """Run the import or export named on the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("action", choices=("import", "export"))
+    parser.add_argument("path", help="file to read or write")
+    parser.add_argument("--db", default=storage.DB_PATH, help="songs.db to use")
+    parser.add_argument("--service", help="service of every row in a mapping file")
+    parser.add_argument(
+        "--map",
+        action="append",
+        default=[],
+        metavar="OURS=THEIRS",
+        help="read one of MAPPING_COLUMNS from a differently named column",
+    )
+    parser.add_argument("--delimiter", help="CSV field separator")
+    parser.add_argument(
+        "--replace", action="store_true", help="imported rows win over cached ones"
+    )
+    args = parser.parse_args()
+
+    con = connect(args.db)
+    start = time.perf_counter()
+    if args.action == "export":
+        counts = export(con, args.path)
+    elif _is_export(args.path):
+        counts = load_export(con, args.path, replace=args.replace)
+    else:
+        names = dict(option.split("=", 1) for option in args.map)
+        rows = read_mappings(args.path, args.service, names, args.delimiter)
+        counts = load_mappings(con, rows)
+    # fold the import into the db file, so the WAL doesn't hold it all
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    con.close()
+    summary = ", ".join(f"{count} {name}" for name, count in counts.items())
+    elapsed = time.perf_counter() - start
+    print(f"{args.action.capitalize()}ed {summary} in {elapsed:.1f}s")
+
+
+def _is_export(path: str) -> bool:
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            return json.loads(file.readline()).get("format") == FORMAT
+    except (OSError, ValueError, AttributeError):
+        return False
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""In-memory cache in front of the song cache db.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+    """A bounded, thread-safe LRU cache whose entries also expire after a while.
+
+    The converters keep two kinds of keys in here:
+    * ("song", service, uid) -> song.Song, for url_to_song
+    * ("url", isrc, service) -> whatever song_to_url returns for that service
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 3600):
+        """Create a cache.
+
+        Args:
+            maxsize (int, optional): Most entries kept; the least recently used go
+                first. Defaults to 4096.
+            ttl (float, optional): Seconds an entry lives for. Defaults to 3600.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Get a live entry, or default if it's missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """Add or replace an entry, evicting the least recently used if we're full."""
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        """Drop entries, if present."""
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        """Drop every entry."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        """Get the size and hit/miss counters."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared() -> TTLCache:
+    """Get the process-wide TTLCache, creating it on first use."""
+    global _shared  # pylint: disable=global-statement
+    with _shared_lock:
+        if _shared is None:
+            _shared = TTLCache()
+        return _shared
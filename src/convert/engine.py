@@ -0,0 +1,390 @@
+"""Run conversions off the Discord event loop.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import album
+import freshness
+import metrics
+import scheduler
+import song
+
+
+class ConversionEngine:
+    """Awaitable front for the converters.
+
+    The converters are built on blocking clients (spotipy, ytmusicapi, applemusicpy,
+    requests), so every call is handed to a bounded thread pool. The event loop only
+    ever awaits, so many conversions can be in flight at once and the gateway
+    heartbeat keeps beating while a slow lookup is waiting on the network.
+
+    Identical conversions that overlap (everyone running /song on the link that was
+    just posted) share one upstream lookup: the later callers await the first one's
+    result instead of starting their own."""
+
+    def __init__(
+        self, converters: dict, max_workers: int = 8, speculative: bool = False
+    ):
+        """Create an engine.
+
+        Args:
+            converters (registry.Registry | dict): Maps a service name (spotify,
+                applemusic, ytmusic) to its converter object.
+            max_workers (int, optional): Most conversions run at once, per scheduler
+                priority. Defaults to 8.
+            speculative (bool, optional): Have speculate() convert songs to the
+                services nobody asked for yet. Defaults to False.
+        """
+        self.converters = converters
+        self.max_workers = max_workers
+        self.executors = {}  # scheduler priority -> its own pool, made on first use
+        self.in_flight = {}  # key -> future of the lookup everyone with that key awaits
+        self.speculative = speculative
+        self.background = set()  # tasks nothing awaits, kept so they aren't collected
+
+    async def run(self, func, *args, **kwargs):
+        """Run any blocking callable in the pool and await its result.
+
+        The call runs in a copy of the caller's context, so a scheduler.priority()
+        block around the await carries over to the requests it makes. Each priority
+        has a pool of its own, so background work waiting in the rate limiter never
+        holds the threads an interactive call needs."""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self.__executor(scheduler.current_priority.get()),
+            functools.partial(context.run, func, *args, **kwargs),
+        )
+
+    def __executor(self, level: int) -> ThreadPoolExecutor:
+        # only ever called on the event loop, so no lock
+        if level not in self.executors:
+            self.executors[level] = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix=f"convert-{level}"
+            )
+        return self.executors[level]
+
+    async def coalesce(self, key, func, *args, **kwargs):
+        """Run a blocking callable in the pool, unless an identical call (same key) is
+        already running, in which case await that one instead.
+
+        Callers are shielded from each other: cancelling one awaiter doesn't cancel
+        the lookup for the rest. Only calls at the same scheduler priority are
+        shared, so an interactive caller never ends up waiting behind a speculative
+        lookup's BACKGROUND place in the queue.
+        """
+        key = (scheduler.current_priority.get(), key)
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.run(func, *args, **kwargs))
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def first_of(self, calls: list):
+        """Run blocking callables side by side and return the first non-None result.
+
+        Whatever hasn't started yet is cancelled as soon as there's a winner.
+        Callables that raise are treated as a None result.
+
+        Args:
+            calls (list): Zero-argument callables, e.g. functools.partial objs.
+
+        Returns:
+            The first non-None result, or None if none of them had one.
+        """
+        pending = {asyncio.ensure_future(self.run(call)) for call in calls}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        print(f"Error: {task.exception()} in a fan-out lookup")
+                    elif task.result() is not None:
+                        return task.result()
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def barcode_to_album(self, barcode: str) -> str | None:
+        """Find the Spotify album for any barcode, e.g. from a physical release.
+
+        MusicBrainz turns the barcode into the UPCs of the album's digital releases,
+        then every UPC is searched on Spotify at once and the first hit wins. Every
+        step is cached, so a repeat of the same barcode needs no API calls.
+
+        Args:
+            barcode (str): UPC/EAN of any release of the album.
+
+        Returns:
+            str | None: Spotify album URL, or None if Spotify has none of them.
+        """
+        sp = self.converters["spotify"]
+        upcs = await self.run(sp.get_digital_upcs_for_barcode, barcode)
+        cached = await self.run(sp.cached_sp_album_for_upcs, upcs)
+        if cached is not None:
+            return cached
+        return await self.first_of(
+            [functools.partial(sp.find_sp_album_for_upc, upc) for upc in upcs]
+        )
+
+    async def linked_url(self, source: str, target: str, url: str) -> str | None:
+        """Answer a conversion straight from the recordings table, if we can.
+
+        Args:
+            source (str): Service the URL belongs to.
+            target (str): Service we want a URL for.
+            url (str): URL of the song.
+
+        Returns:
+            str | None: URL on the target service, or None if it isn't linked yet.
+                A stale one is still returned, and re-checked in the background.
+        """
+        with metrics.shared().timer(
+            "stage_seconds", stage="linked_url", service=source
+        ):
+            links = await self.run(self.converters[source].linked_urls, url)
+        if target not in links:
+            return None
+        platform_id, target_url, fetched_at = links[target]
+        if freshness.is_stale(fetched_at):
+            self.__in_background(self.__revalidate(target, platform_id))
+        return target_url
+
+    async def __revalidate(self, service: str, platform_id: str):
+        try:
+            await self.run(self.converters[service].revalidate_later, platform_id)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            print(f"Error revalidating on {service}: {e} of class {e.__class__}")
+
+    async def to_song(self, service: str, url: str) -> song.Song:
+        """Convert a service URL to a Song obj.
+
+        Args:
+            service (str): Service the URL belongs to.
+            url (str): URL of the song.
+
+        Raises:
+            song.NoMatchFoundError: No match was found for this URL.
+
+        Returns:
+            song.Song: Song obj from the URL.
+        """
+        converter = self.converters[service]
+        with metrics.shared().timer(
+            "stage_seconds", stage="parse_url", service=service
+        ):
+            key = ("song", service, converter.parse_url(url))
+        with metrics.shared().timer("stage_seconds", stage="to_song", service=service):
+            return await self.coalesce(key, converter.to_song, url)
+
+    async def to_url(
+        self,
+        service: str,
+        a_song: song.Song,
+        best_match: bool = False,
+        refresh: bool = False,
+    ) -> str:
+        """Convert a Song obj to a URL on a service.
+
+        Args:
+            service (str): Service we want a URL for.
+            a_song (song.Song): Song obj to match against.
+            best_match (bool, optional): Try and match a best fit? Defaults to False.
+            refresh (bool, optional): Search again even if this song recently came
+                up empty. Defaults to False.
+
+        Raises:
+            song.NoMatchFoundError: No match was found for this song.
+
+        Returns:
+            str: URL of the matching song.
+        """
+        key = ("url", service, a_song.lookup_key(), best_match, refresh)
+        with metrics.shared().timer("stage_seconds", stage="to_url", service=service):
+            return await self.coalesce(
+                key,
+                self.converters[service].to_url,
+                a_song,
+                best_match=best_match,
+                refresh=refresh,
+            )
+
+    def speculate(self, a_song: song.Song, skip: set[str]) -> list[asyncio.Task]:
+        """Convert a song to every other service in the background, so a follow-up
+        for any of them is a cache hit. Does nothing unless the engine is speculative.
+
+        Runs at BACKGROUND priority, and nothing awaits it; call this after the
+        reply has gone out.
+
+        Args:
+            a_song (song.Song): Song that was just converted.
+            skip (set[str]): Services it's already known on, e.g. source and target.
+
+        Returns:
+            list[asyncio.Task]: The background conversions started.
+        """
+        if not self.speculative or a_song is None:
+            return []
+        return [
+            self.__in_background(self.__speculate(service, a_song))
+            for service in self.converters
+            if service not in skip
+        ]
+
+    def __in_background(self, coro) -> asyncio.Task:
+        """Start a task nothing awaits, kept in self.background until it's done so
+        it isn't collected."""
+        task = asyncio.create_task(coro)
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+        return task
+
+    async def __speculate(self, service: str, a_song: song.Song):
+        with scheduler.priority(scheduler.BACKGROUND):
+            try:
+                await self.to_url(service, a_song)
+            except song.NoMatchFoundError:
+                pass  # recorded as a miss, which is worth caching too
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                print(f"Error speculating on {service}: {e} of class {e.__class__}")
+
+    async def to_songs(self, service: str, urls: list[str]) -> list[song.Song | None]:
+        """Convert many service URLs to Song objs at once.
+
+        Args:
+            service (str): Service the URLs belong to.
+            urls (list[str]): URLs of the songs.
+
+        Returns:
+            list[song.Song | None]: A Song obj per URL, in order; None for no match.
+        """
+        return await self.run(self.converters[service].to_songs, urls)
+
+    async def to_urls(
+        self,
+        service: str,
+        songs: list[song.Song | None],
+        best_match: bool = False,
+        refresh: bool = False,
+    ) -> list[str | None]:
+        """Convert many Song objs to URLs on a service at once.
+
+        Args:
+            service (str): Service we want URLs for.
+            songs (list[song.Song | None]): Song objs to match against.
+            best_match (bool, optional): Try and match a best fit? Defaults to False.
+            refresh (bool, optional): Search again even if a song recently came
+                up empty. Defaults to False.
+
+        Returns:
+            list[str | None]: URL per song, in order; None for no match.
+        """
+        return await self.run(
+            self.converters[service].to_urls,
+            songs,
+            best_match=best_match,
+            refresh=refresh,
+        )
+
+    async def playlist_to_songs(self, service: str, url: str) -> list[song.Song]:
+        """Get Song objs for every song on a playlist.
+
+        Args:
+            service (str): Service the playlist belongs to.
+            url (str): URL of the playlist.
+
+        Returns:
+            list[song.Song]: Songs on the playlist, in order.
+        """
+        return await self.run(self.converters[service].playlist_to_songs, url)
+
+    async def linked_album_url(self, source: str, target: str, url: str) -> str | None:
+        """Answer an album conversion straight from the albums table, if we can.
+
+        Args:
+            source (str): Service the URL belongs to.
+            target (str): Service we want a URL for.
+            url (str): URL of the album.
+
+        Returns:
+            str | None: URL on the target service, or None if it isn't linked yet.
+        """
+        links = await self.run(self.converters[source].linked_album_urls, url)
+        return links.get(target)
+
+    async def to_album(self, service: str, url: str) -> album.Album:
+        """Convert a service album URL to an Album obj.
+
+        Args:
+            service (str): Service the URL belongs to.
+            url (str): URL of the album.
+
+        Raises:
+            song.NoMatchFoundError: No match was found for this URL.
+
+        Returns:
+            album.Album: Album obj from the URL.
+        """
+        converter = self.converters[service]
+        key = ("album", service, converter.parse_album_url(url))
+        return await self.coalesce(key, converter.album_url_to_album, url)
+
+    async def album_to_url(
+        self, service: str, an_album: album.Album, best_match: bool = False
+    ) -> str:
+        """Convert an Album obj to a URL on a service.
+
+        Args:
+            service (str): Service we want a URL for.
+            an_album (album.Album): Album obj to match against.
+            best_match (bool, optional): Try and match a best fit? Defaults to False.
+
+        Raises:
+            song.NoMatchFoundError: No match was found for this album.
+
+        Returns:
+            str: URL of the matching album.
+        """
+        key = ("album_url", service, an_album.upc, an_album.title, best_match)
+        return await self.coalesce(
+            key, self.converters[service].album_to_url, an_album, best_match=best_match
+        )
+
+    async def trending_songs(self, service: str) -> list[song.Song]:
+        """Get Song objs for what's charting or newly released on a service.
+
+        Args:
+            service (str): Service to read the charts of.
+
+        Returns:
+            list[song.Song]: Songs on the service's charts.
+        """
+        return await self.run(self.converters[service].trending_songs)
+
+    def shutdown(self):
+        """Stop accepting work and let running conversions finish. Background tasks
+        (speculation, revalidation) that haven't finished are cancelled."""
+        for task in self.background:
+            task.cancel()
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,103 @@
+"""Serve cached songs straight away, and re-check the stale ones in the background.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+from os import environ
+import queue
+import threading
+import time
+import scheduler
+import storage
+
+# COLUMN fetched_at on spotify, ytmusic and applemusic; NULL is unknown, i.e. stale
+# how old a cached song can get before it's re-checked, in seconds
+MAX_AGE = float(environ.get("MAX_AGE", 30 * 24 * 60 * 60))
+# how long to wait before trying again for an ISRC we couldn't find
+ISRC_RETRY_AGE = float(environ.get("ISRC_RETRY_AGE", 24 * 60 * 60))
+
+
+def is_stale(fetched_at: float | None, max_age: float = MAX_AGE) -> bool:
+    """Check if a row fetched at fetched_at (seconds since the epoch) is due to be
+    checked again."""
+    return fetched_at is None or time.time() - fetched_at > max_age
+
+
+class Revalidator:
+    """Re-checks stale rows one at a time on a background thread.
+
+    The caller has already been answered from the cache, so nothing waits on
+    this; every check runs at BACKGROUND priority, and a row that's already
+    queued isn't queued again, nor once more until the check's writes are in."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, key, func, *args) -> bool:
+        """Queue func(*args) to re-check a row, unless key is already queued.
+
+        Args:
+            key: Identifies the row, e.g. ("spotify", uid).
+            func: Re-fetches the row and writes it back.
+
+        Returns:
+            bool: True if queued, False if it was already.
+        """
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.__work_loop, name="revalidate", daemon=True
+                )
+                self.thread.start()
+        self.queue.put((key, func, args))
+        return True
+
+    def __work_loop(self):
+        while True:
+            key, func, args = self.queue.get()
+            try:
+                with scheduler.priority(scheduler.BACKGROUND):
+                    func(*args)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # the stale row is still there; we'll try again next time it's used
+                print(f"Couldn't revalidate {key}: {e} of class {e.__class__}")
+                self.__release(key)
+            else:
+                # until then, a read still finds the stale row and would queue it
+                # all over again
+                storage.shared().after_commit(self.__release, key)
+
+    def __release(self, key):
+        with self.lock:
+            self.pending.discard(key)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared() -> Revalidator:
+    """Get the process-wide Revalidator, creating it on first use."""
+    global _shared  # pylint: disable=global-statement
+    with _shared_lock:
+        if _shared is None:
+            _shared = Revalidator()
+        return _shared
@@ -0,0 +1,132 @@
+"""Fuzzy title/artist matching, for when we have no ISRC to go on.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import re
+import unicodedata
+
+# lowest score() we'll accept as the same song
+THRESHOLD = 0.8
+TITLE_WEIGHT = 0.7  # the rest of the score is the artist
+
+# compiled once at import, not on every comparison.
+# bracketed tags that don't change which recording it is, e.g. (Official Video),
+# [Remastered 2011], (feat. Someone), (Radio Edit)
+_NOISE_TAG = re.compile(
+    r"[\(\[][^\)\]]*\b(official|music video|lyric video|lyrics|audio|visuali[sz]er|"
+    r"remaster(ed)?|feat\.?|ft\.?|featuring|with|prod\.?|explicit|clean|"
+    r"radio edit|single version|album version|mono|stereo)\b[^\)\]]*[\)\]]",
+    re.I,
+)
+# the same tags after a dash, e.g. "Song - Remastered 2011", "Song - Live at X"
+_NOISE_SUFFIX = re.compile(
+    r"\s+-\s+.*\b(remaster(ed)?|version|edit|mono|stereo|live)\b.*$", re.I
+)
+# feat. outside brackets, e.g. "Song feat. Someone" or "Artist ft. Someone"
+_FEATURING = re.compile(r"\s+(feat\.?|ft\.?|featuring)\s+.*$", re.I)
+# editions of an album that are still the same album to a listener, e.g.
+# (Deluxe Edition), [Expanded], "Album - 2009 Remaster"
+_EDITION = re.compile(
+    r"[\(\[][^\)\]]*\b(edition|deluxe|expanded|anniversary|bonus tracks?|"
+    r"remaster(ed)?)\b[^\)\]]*[\)\]]|\s+-\s+.*\b(edition|deluxe|remaster(ed)?)\b.*$",
+    re.I,
+)
+# a live recording is a different recording, so this is kept as a flag
+_LIVE = re.compile(r"\blive\b", re.I)
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_AND = re.compile(r"\s*&\s*|\s+\+\s+")
+
+
+def fold(text: str) -> str:
+    """Lowercase, strip accents and width variants, and drop punctuation."""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = _AND.sub(" and ", text.casefold())
+    return " ".join(_PUNCTUATION.sub(" ", text).split())
+
+
+def title_key(title: str) -> tuple[frozenset, bool]:
+    """Normalize a title into its set of tokens, and whether it's a live version."""
+    title = title or ""
+    live = bool(_LIVE.search(title))
+    stripped = _FEATURING.sub("", _NOISE_SUFFIX.sub("", _NOISE_TAG.sub(" ", title)))
+    tokens = frozenset(fold(stripped).split())
+    # a title that was nothing but a tag keeps its words
+    return (tokens or frozenset(fold(title).split())), live
+
+
+def album_title_key(title: str) -> tuple[frozenset, bool]:
+    """title_key for an album, which also drops edition tags like (Deluxe Edition)."""
+    return title_key(_EDITION.sub(" ", title or "") or title)
+
+
+def artist_key(artist: str) -> frozenset:
+    """Normalize an artist name into its set of tokens, minus anyone featured."""
+    artist = _FEATURING.sub("", artist or "")
+    tokens = fold(artist).split()
+    # "The Beatles" and "Beatles" are the same band
+    if len(tokens) > 1 and tokens[0] == "the":
+        tokens = tokens[1:]
+    return frozenset(tokens)
+
+
+def token_set_similarity(ours: frozenset, theirs: frozenset) -> float:
+    """Dice coefficient of two token sets: 1.0 is identical, 0.0 shares nothing."""
+    if not ours or not theirs:
+        return 1.0 if ours == theirs else 0.0
+    return 2 * len(ours & theirs) / (len(ours) + len(theirs))
+
+
+def score(ours: tuple, theirs: tuple) -> float:
+    """Score how alike two songs are, from their Song.match_key.
+
+    Args:
+        ours (tuple): (title tokens, live?, artist tokens) of the song we want.
+        theirs (tuple): The same for a candidate.
+
+    Returns:
+        float: 0.0 to 1.0; THRESHOLD or more is a match.
+    """
+    our_title, our_live, our_artist = ours
+    their_title, their_live, their_artist = theirs
+    if our_live != their_live:
+        return 0.0
+    artist = token_set_similarity(our_artist, their_artist)
+    if artist == 0.0:
+        return 0.0
+    title = token_set_similarity(our_title, their_title)
+    return TITLE_WEIGHT * title + (1 - TITLE_WEIGHT) * artist
+
+
+def best(a_song, candidates: list):
+    """Pick the candidate most like a song, if any is close enough.
+
+    Args:
+        a_song (song.Song): Song we're looking for.
+        candidates (list[song.Song]): Search results, in the order they came back.
+
+    Returns:
+        song.Song | None: The highest scoring candidate at or over THRESHOLD, the
+            earliest on a tie; None if none of them are.
+    """
+    top, top_score = None, THRESHOLD
+    for candidate in candidates:
+        candidate_score = score(a_song.match_key, candidate.match_key)
+        if candidate_score > top_score or (
+            top is None and candidate_score >= top_score
+        ):
+            top, top_score = candidate, candidate_score
+    return top
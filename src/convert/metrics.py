@@ -0,0 +1,226 @@
+"""Counters and latency histograms for the hot path, in Prometheus text format.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import asyncio
+import bisect
+import contextlib
+import threading
+import time
+
+# histogram bucket upper bounds, in seconds: sub-millisecond db reads up to
+# musicfetch's multi-second lookups
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Counts of observations at or under each bucket, plus their sum."""
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """Record one observation."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, counts: list, total: float, count: int):
+        """Add in another histogram's observations, as (counts, sum, count), e.g.
+        from Metrics.drain() in another process. Its buckets must be the same."""
+        self.counts = [ours + theirs for ours, theirs in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+
+
+class Metrics:
+    """Every counter and histogram in the process, by name and labels.
+
+    Labels are passed as keyword arguments, e.g.
+    inc("upstream_errors_total", service="spotify", status="429"). Keep their
+    values to a small, fixed set (services, tables, endpoints; never IDs), since
+    every combination is its own series."""
+
+    def __init__(self):
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}  # name -> callable returning {labels: value}
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        """Add to a counter."""
+        key = (name, _key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        """Record how long something took."""
+        key = (name, _key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """Time the block into a histogram. Works around an await, too."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def drain(self) -> tuple[dict, dict]:
+        """Take every counter and histogram recorded so far, and start again from
+        zero, e.g. in a worker process that hands them back to its parent.
+
+        Returns:
+            tuple[dict, dict]: Counter values and histograms as (counts, sum, count),
+                both by (name, labels); plain data, so they pickle.
+        """
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            histograms, self.histograms = self.histograms, {}
+        return counters, {
+            key: (h.counts, h.sum, h.count) for key, h in histograms.items()
+        }
+
+    def merge(self, drained: tuple[dict, dict]):
+        """Add in what another Metrics' drain() returned."""
+        counters, histograms = drained
+        with self.lock:
+            for key, amount in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + amount
+            for key, observed in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.merge(*observed)
+
+    def gauge(self, name: str, func):
+        """Report func()'s value whenever metrics are read. func returns a number,
+        or a dict of label tuples (as from sorted(labels.items())) to numbers."""
+        with self.lock:
+            self.gauges[name] = func
+
+    def render(self) -> str:
+        """Everything recorded so far, in the Prometheus text exposition format."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, (list(h.counts), h.sum, h.count, h.buckets))
+                for key, h in self.histograms.items()
+            )
+            gauges = sorted(self.gauges.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labels(labels)} {value:g}")
+        for (name, labels), (counts, total, count, buckets) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip((*buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = labels + (("le", f"{bound:g}" if bound != "+Inf" else bound),)
+                lines.append(f"{name}_bucket{_labels(le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for name, func in gauges:
+            lines.append(f"# TYPE {name} gauge")
+            values = func()
+            if not isinstance(values, dict):
+                values = {(): values}
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 9464):
+        """Answer every HTTP request on host:port with render(), for Prometheus to
+        scrape; runs until cancelled."""
+
+        async def answer(reader, writer):
+            try:
+                # we only serve the one page, so the request itself doesn't matter
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                body = self.render().encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4\r\n"
+                    b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                    b"Connection: close\r\n\r\n" + body
+                )
+                await writer.drain()
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(answer, host, port)
+        print(f"Serving metrics on http://{host}:{port}/metrics")
+        async with server:
+            await server.serve_forever()
+
+    async def dump_every(self, seconds: float):
+        """Print render() every so many seconds; runs until cancelled."""
+        while True:
+            await asyncio.sleep(seconds)
+            print(self.render(), end="")
+
+
+def endpoint(url: str) -> str:
+    """Cut an API request URL down to the kind of call it is, for a label, e.g.
+    "https://api.music.apple.com/v1/catalog/us/songs/123" -> "songs"."""
+    parts = url.split("?")[0].split("/v1/")[-1].strip("/").split("/")
+    if parts[0] == "catalog" and len(parts) > 2:
+        parts = parts[2:]  # skip the storefront
+    return parts[0] or "other"
+
+
+def _key(labels: dict) -> tuple:
+    # values are stringified so 429 and "unknown" can sit in the same sorted series
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared() -> Metrics:
+    """Get the process-wide Metrics, creating it on first use."""
+    global _shared  # pylint: disable=global-statement
+    with _shared_lock:
+        if _shared is None:
+            _shared = Metrics()
+        return _shared
@@ -0,0 +1,55 @@
+"""Remember lookups that found nothing, so retries fail fast.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+from os import environ
+import time
+import song
+import storage
+
+# TABLE misses(lookup, service, expires_at)
+# how long a miss is trusted before we go and ask the APIs again, in seconds
+MISS_TTL = float(environ.get("MISS_TTL", 24 * 60 * 60))
+
+
+def is_known_miss(db: storage.Storage, a_song: song.Song, service: str) -> bool:
+    """Check if this song was recently not found on a service."""
+    row = db.query_one(
+        "SELECT expires_at FROM misses WHERE lookup=? AND service=?",
+        [a_song.lookup_key(), service],
+    )
+    return row is not None and row[0] > time.time()
+
+
+def record(db: storage.Storage, a_song: song.Song, service: str, ttl: float = MISS_TTL):
+    """Remember that this song couldn't be found on a service, for ttl seconds."""
+    print(f"Recorded a miss on {service}: {a_song.lookup_key()}")
+    db.execute(
+        "INSERT INTO misses(lookup, service, expires_at) VALUES (?, ?, ?) \
+        ON CONFLICT(lookup, service) DO UPDATE SET expires_at=excluded.expires_at",
+        [a_song.lookup_key(), service, time.time() + ttl],
+    )
+
+
+def forget(db: storage.Storage, a_song: song.Song, service: str):
+    """Drop any miss for a song on a service, now that we've found it there, under
+    any key it may have been searched by (see Song.lookup_keys)."""
+    keys = a_song.lookup_keys()
+    db.execute(
+        f"DELETE FROM misses WHERE lookup IN ({', '.join('?' * len(keys))}) \
+        AND service=?",
+        [*keys, service],
+    )
@@ -0,0 +1,152 @@
+"""Cross-platform links between recordings, keyed by ISRC.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import sqlite3
+
+# TABLE recordings(service, platform_id, isrc, url)
+# One row per platform ID; every row sharing an ISRC is the same recording, so a
+# self-join on isrc turns any known platform ID into every other known URL.
+# fetched_at stays on the service tables; resolve() looks it up by platform ID.
+# TABLE albums(service, album_id, upc, title, artist, url)
+# The same again for albums, joined on UPC.
+
+_LINK = "INSERT INTO recordings(service, platform_id, isrc, url) VALUES (?, ?, ?, ?) \
+    ON CONFLICT(service, platform_id) DO UPDATE SET isrc=excluded.isrc, \
+    url=excluded.url"
+
+
+def link(cur: sqlite3.Cursor, service: str, platform_id: str, isrc: str, url: str):
+    """Record that a platform ID is a given recording. Does not commit.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor on the song cache.
+        service (str): Service the ID belongs to.
+        platform_id (str): ID of the song on that service.
+        isrc (str): ISRC of the recording. Nothing is recorded if this is None.
+        url (str): URL to play the song from.
+    """
+    if isrc is None:
+        return
+    cur.execute(_LINK, [service, platform_id, isrc.lower(), url])
+
+
+def link_many(cur: sqlite3.Cursor, rows):
+    """link() for many platform IDs in one executemany, e.g. for a bulk import.
+    Does not commit.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor on the song cache.
+        rows (Iterable[tuple]): (service, platform_id, isrc, url) tuples; the ISRC
+            must already be lowercased and not None.
+    """
+    cur.executemany(_LINK, rows)
+
+
+def unlink(cur: sqlite3.Cursor, service: str, platform_id: str):
+    """Forget a platform ID, e.g. once the song is pulled. Does not commit.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor on the song cache.
+        service (str): Service the ID belongs to.
+        platform_id (str): ID of the song on that service.
+    """
+    cur.execute(
+        "DELETE FROM recordings WHERE service=? AND platform_id=?",
+        [service, platform_id],
+    )
+
+
+def resolve(cur: sqlite3.Cursor, service: str, platform_id: str) -> dict[str, tuple]:
+    """Find every known URL for the recording behind a platform ID, in one query,
+    along with how old each one is.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor on the song cache.
+        service (str): Service the ID belongs to.
+        platform_id (str): ID of the song on that service.
+
+    Returns:
+        dict[str, tuple]: Maps other services to (platform ID, URL, fetched_at) for
+            this recording, where fetched_at is when the service's own row was last
+            fetched (None if unknown); empty if the ID or its ISRC is unknown.
+    """
+    # the oldest of apple's rows, since the song can be cached under several albums
+    cur.execute(
+        "SELECT target.service, target.platform_id, target.url, \
+        CASE target.service \
+        WHEN 'spotify' THEN (SELECT fetched_at FROM spotify \
+        WHERE uid = target.platform_id) \
+        WHEN 'ytmusic' THEN (SELECT fetched_at FROM ytmusic \
+        WHERE uid = target.platform_id) \
+        WHEN 'applemusic' THEN (SELECT min(fetched_at) FROM applemusic \
+        WHERE songid = target.platform_id) END \
+        FROM recordings AS source \
+        JOIN recordings AS target ON target.isrc = source.isrc \
+        WHERE source.service = ? AND source.platform_id = ? AND target.service != ?",
+        [service, platform_id, service],
+    )
+    return {row[0]: tuple(row[1:]) for row in cur.fetchall()}
+
+
+def link_album(
+    cur: sqlite3.Cursor,
+    service: str,
+    album_id: str,
+    upc: str,
+    title: str,
+    artist: str,
+    url: str,
+):
+    """Record an album and, if we know it, its UPC. Does not commit.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor on the song cache.
+        service (str): Service the ID belongs to.
+        album_id (str): ID of the album on that service.
+        upc (str): UPC without leading zeros (see album.Album), or None.
+        title (str): Album title.
+        artist (str): First artist on the album.
+        url (str): URL to play the album from.
+    """
+    cur.execute(
+        "INSERT INTO albums(service, album_id, upc, title, artist, url) VALUES \
+        (?, ?, ?, ?, ?, ?) ON CONFLICT(service, album_id) DO UPDATE SET \
+        upc=coalesce(excluded.upc, albums.upc), title=coalesce(excluded.title, \
+        albums.title), artist=coalesce(excluded.artist, albums.artist), url=excluded.url",
+        [service, album_id, upc, title, artist, url],
+    )
+
+
+def resolve_album(cur: sqlite3.Cursor, service: str, album_id: str) -> dict[str, str]:
+    """Find every known URL for the album behind an album ID, in one query.
+
+    Args:
+        cur (sqlite3.Cursor): Cursor on the song cache.
+        service (str): Service the ID belongs to.
+        album_id (str): ID of the album on that service.
+
+    Returns:
+        dict[str, str]: Maps other services to their URL for this album; empty if
+            the ID or its UPC is unknown.
+    """
+    cur.execute(
+        "SELECT target.service, target.url FROM albums AS source \
+        JOIN albums AS target ON target.upc = source.upc \
+        WHERE source.service = ? AND source.album_id = ? AND target.service != ?",
+        [service, album_id, service],
+    )
+    return dict(cur.fetchall())
@@ -0,0 +1,114 @@
+"""Every service we can convert between, built the first time it's used.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import re
+import threading
+from typing import Callable, Protocol
+import song
+
+
+class Converter(Protocol):
+    """What the engine needs from a service's converter."""
+
+    def parse_url(self, url: str) -> str:
+        """Strip a song URL down to the service's ID for it."""
+
+    def to_song(self, url: str) -> song.Song:
+        """Make a Song obj from a song URL."""
+
+    def to_url(
+        self,
+        a_song: song.Song,
+        best_match: bool = False,
+        refresh: bool = False,
+        deadline: float = None,
+    ) -> str:
+        """Find a Song obj on the service, and return its URL."""
+
+    def to_songs(self, urls: list[str]) -> list[song.Song | None]:
+        """to_song for many URLs at once; None for no match."""
+
+    def to_urls(
+        self,
+        songs: list[song.Song | None],
+        best_match: bool = False,
+        refresh: bool = False,
+    ) -> list[str | None]:
+        """to_url for many songs at once; None for no match."""
+
+    def playlist_to_songs(self, url: str) -> list[song.Song]:
+        """Make Song objs for every song on a playlist."""
+
+    def linked_urls(self, url: str) -> dict[str, str]:
+        """Every other service's URL the db already has for a song URL."""
+
+
+class Registry:
+    """Maps service names to converters, and reads like a dict of them.
+
+    Nothing is built until it's first looked up, so a bot that never converts to
+    Apple Music never signs its JWT, and one that only serves some services can
+    leave the rest out entirely."""
+
+    def __init__(self):
+        self.factories = {}  # name -> callable that builds the converter
+        self.labels = {}  # name -> name to show people, e.g. "Apple Music"
+        self.patterns = {}  # name -> compiled pattern its URLs match
+        self.built = {}
+        self.lock = threading.Lock()
+
+    def register(
+        self, name: str, label: str, factory: Callable[[], Converter], pattern: str
+    ):
+        """Add a service.
+
+        Args:
+            name (str): Name it's known by everywhere else, e.g. "applemusic".
+            label (str): Name to show people, e.g. "Apple Music".
+            factory (Callable[[], Converter]): Builds the converter, on first use.
+            pattern (str): Regex that any of the service's URLs match.
+        """
+        self.factories[name] = factory
+        self.labels[name] = label
+        self.patterns[name] = re.compile(pattern, re.I)
+
+    def detect(self, url: str) -> str | None:
+        """Work out which service a URL belongs to; None if it's none of ours."""
+        for name, pattern in self.patterns.items():
+            if pattern.search(url):
+                return name
+        return None
+
+    def __getitem__(self, name: str) -> Converter:
+        converter = self.built.get(name)
+        if converter is None:
+            with self.lock:
+                # someone may have built it while we waited
+                if name not in self.built:
+                    print(f"Starting the {self.labels[name]} converter")
+                    self.built[name] = self.factories[name]()
+                converter = self.built[name]
+        return converter
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.factories
+
+    def __iter__(self):
+        return iter(self.factories)
+
+    def __len__(self) -> int:
+        return len(self.factories)
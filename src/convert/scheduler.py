@@ -0,0 +1,197 @@
+"""Share one rate budget per upstream API across every conversion.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import contextlib
+import contextvars
+from email.utils import parsedate_to_datetime
+import heapq
+import itertools
+from os import environ
+import threading
+import time
+
+INTERACTIVE = 0  # someone is waiting on a /song reply
+BACKGROUND = 10  # warmers, refreshes and other work nobody is waiting on
+
+# service -> (requests per second, burst); musicbrainz asks for no more than 1/s
+DEFAULT_LIMITS = {
+    "spotify": (10, 20),
+    "applemusic": (20, 40),
+    "ytmusic": (5, 10),
+    "musicbrainz": (1, 1),
+    "musicfetch": (1, 2),
+}
+# overrides for any of those, as "service=rate/burst,...", e.g. "spotify=5/10"
+RATE_LIMITS = environ.get("RATE_LIMITS", "")
+
+current_priority = contextvars.ContextVar("current_priority", default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(level: int):
+    """Run the calls inside this block at a given priority."""
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+def carry(func):
+    """Wrap func so it runs at the caller's priority on another thread, e.g. in a
+    ThreadPoolExecutor, where contextvars don't follow on their own."""
+    context = contextvars.copy_context()
+    # a context can't be entered by two threads at once, so each call gets a copy
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+def parse_limits(setting: str, defaults: dict = None) -> dict:
+    """Read a RATE_LIMITS setting over the defaults.
+
+    Args:
+        setting (str): Comma-separated "service=rate/burst"; the burst may be left
+            off, for one second's worth of requests.
+        defaults (dict, optional): Limits it overrides. Defaults to DEFAULT_LIMITS.
+
+    Returns:
+        dict: Maps service to (requests per second, burst).
+    """
+    limits = dict(DEFAULT_LIMITS if defaults is None else defaults)
+    for option in filter(None, (part.strip() for part in setting.split(","))):
+        service, _, rate = option.partition("=")
+        rate, _, burst = rate.partition("/")
+        limits[service.strip()] = (float(rate), float(burst or max(float(rate), 1)))
+    return limits
+
+
+def retry_after(headers, default: float = 1.0) -> float:
+    """Read a Retry-After header (seconds or an HTTP date) as seconds from now."""
+    value = (headers or {}).get("Retry-After")
+    if value is None:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBucket:
+    """Tokens refill at rate per second, up to burst. One token is one request."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # set from Retry-After
+        self.waiters = []  # heap of (priority, ticket)
+
+    def wait_time(self) -> float:
+        """Seconds until a token can be taken; 0 if one can be taken now."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class Scheduler:
+    """Hands out requests to upstream APIs, one token bucket per service.
+
+    When a bucket is empty, callers queue by priority and then arrival, so
+    interactive lookups go ahead of background ones. Every upstream client is a
+    blocking one, so callers are converter code on the engine's thread pools, never
+    the event loop; they wait on a condition, which wakes them as soon as their
+    turn comes, rather than sleeping for a guess at it."""
+
+    def __init__(self, limits: dict = None):
+        """Create a scheduler.
+
+        Args:
+            limits (dict, optional): Maps service to (requests per second, burst).
+                Defaults to DEFAULT_LIMITS, with the RATE_LIMITS setting over them.
+        """
+        if limits is None:
+            limits = parse_limits(RATE_LIMITS)
+        self.buckets = {
+            service: TokenBucket(rate, burst)
+            for service, (rate, burst) in limits.items()
+        }
+        self.condition = threading.Condition()
+        self.tickets = itertools.count()
+
+    def acquire(self, service: str, level: int = None):
+        """Block this thread until a request to service is allowed.
+
+        Args:
+            service (str): Upstream API about to be called.
+            level (int, optional): Priority; lower goes first. Defaults to the
+                current priority() block, or INTERACTIVE.
+        """
+        ticket = self.__enqueue(service, level)
+        with self.condition:
+            while (delay := self.__try_take(service, ticket)) > 0:
+                self.condition.wait(delay)
+
+    def back_off(self, service: str, seconds: float):
+        """Stop all requests to a service for a while, e.g. after a 429."""
+        print(f"Backing off {service} for {seconds:.1f}s")
+        with self.condition:
+            bucket = self.buckets[service]
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + seconds)
+            bucket.tokens = 0
+
+    def __enqueue(self, service: str, level: int | None) -> tuple:
+        ticket = (current_priority.get() if level is None else level, next(self.tickets))
+        with self.condition:
+            heapq.heappush(self.buckets[service].waiters, ticket)
+        return ticket
+
+    def __try_take(self, service: str, ticket: tuple) -> float:
+        """Take a token if ticket is first in line and one is free; return 0 if
+        taken, else how long to wait before trying again. Hold the condition."""
+        bucket = self.buckets[service]
+        delay = bucket.wait_time()
+        if bucket.waiters[0] != ticket:
+            # someone ahead of us; they'll notify when they're through
+            return max(delay, 0.05)
+        if delay > 0:
+            return delay
+        bucket.tokens -= 1
+        heapq.heappop(bucket.waiters)
+        self.condition.notify_all()
+        return 0.0
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared() -> Scheduler:
+    """Get the process-wide Scheduler, creating it on first use."""
+    global _shared  # pylint: disable=global-statement
+    with _shared_lock:
+        if _shared is None:
+            _shared = Scheduler()
+        return _shared
@@ -0,0 +1,192 @@
+"""Versioned schema for the song cache.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import sqlite3
+
+
+def _index_titles(table: str, key: str, uid: str, artist: str, url: str) -> list:
+    """Statements that copy a song table into the titles index and keep it there.
+
+    Each song gets a titles rowid of its own in title_keys, under its key, so a
+    trigger can find the row it wrote without a scan; the song table's own rowids
+    aren't stable, as VACUUM may renumber them. key and url are SQL expressions
+    with {row} before each column, filled in with new. or old. for the triggers and
+    the table's own name for the backfill."""
+    row = f"'{table}', {{row}}{uid}, {{row}}isrc, {url}, {{row}}title, {{row}}{artist}"
+    insert = "INSERT INTO titles(rowid, service, platform_id, isrc, url, title, artist)"
+    new_key = key.format(row="new.")
+    old_key = key.format(row="old.")
+    insert_new = (
+        f"INSERT OR IGNORE INTO title_keys(service, song_key) "
+        f"VALUES ('{table}', {new_key}); "
+        f"{insert} SELECT id, {row.format(row='new.')} FROM title_keys "
+        f"WHERE service = '{table}' AND song_key = {new_key};"
+    )
+    delete_old = (
+        f"DELETE FROM titles WHERE rowid = (SELECT id FROM title_keys "
+        f"WHERE service = '{table}' AND song_key = {old_key}); "
+        f"DELETE FROM title_keys WHERE service = '{table}' AND song_key = {old_key};"
+    )
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_titles_insert AFTER INSERT ON {table} "
+        f"BEGIN {insert_new} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_titles_update AFTER UPDATE ON {table} "
+        f"BEGIN {delete_old} {insert_new} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_titles_delete AFTER DELETE ON {table} "
+        f"BEGIN {delete_old} END",
+        f"INSERT OR IGNORE INTO title_keys(service, song_key) "
+        f"SELECT '{table}', {key.format(row='')} FROM {table}",
+        f"{insert} SELECT title_keys.id, {row.format(row=f'{table}.')} "
+        f"FROM {table} JOIN title_keys ON title_keys.service = '{table}' "
+        f"AND title_keys.song_key = {key.format(row=f'{table}.')}",
+    ]
+
+
+# Each entry is one schema version; the db records the last one it applied in
+# PRAGMA user_version. Only ever append here -- never edit a shipped migration.
+MIGRATIONS = [
+    # 1: the original cache tables
+    [
+        "CREATE TABLE IF NOT EXISTS spotify (uid TEXT PRIMARY KEY, isrc TEXT, "
+        "title TEXT, first_artist TEXT)",
+        "CREATE TABLE IF NOT EXISTS ytmusic (uid TEXT PRIMARY KEY, isrc TEXT, "
+        "title TEXT, first_artist TEXT)",
+        "CREATE TABLE IF NOT EXISTS applemusic (songid TEXT, albumid TEXT, isrc TEXT, "
+        "title TEXT, artist TEXT, PRIMARY KEY (songid, albumid))",
+    ],
+    # 2: covering indexes for the `WHERE isrc=?` lookups in song_to_url
+    [
+        "CREATE INDEX IF NOT EXISTS spotify_isrc ON spotify (isrc, uid)",
+        "CREATE INDEX IF NOT EXISTS ytmusic_isrc ON ytmusic (isrc, uid)",
+        "CREATE INDEX IF NOT EXISTS applemusic_isrc ON applemusic (isrc, songid, albumid)",
+    ],
+    # 3: one row per platform ID, joined on isrc, so a cache hit answers any pair
+    [
+        "CREATE TABLE IF NOT EXISTS recordings (service TEXT, platform_id TEXT, "
+        "isrc TEXT NOT NULL, url TEXT NOT NULL, PRIMARY KEY (service, platform_id))",
+        "CREATE INDEX IF NOT EXISTS recordings_isrc ON recordings (isrc, service, url)",
+        "INSERT OR IGNORE INTO recordings SELECT 'spotify', uid, isrc, "
+        "'https://open.spotify.com/track/' || uid FROM spotify WHERE isrc IS NOT NULL",
+        "INSERT OR IGNORE INTO recordings SELECT 'ytmusic', uid, isrc, "
+        "'https://music.youtube.com/watch?v=' || uid FROM ytmusic WHERE isrc IS NOT NULL",
+        "INSERT OR IGNORE INTO recordings SELECT 'applemusic', songid, isrc, "
+        "'https://music.apple.com/us/album/' || albumid || '?i=' || songid "
+        "FROM applemusic WHERE isrc IS NOT NULL",
+    ],
+    # 4: lookups that found nothing, by isrc or title+artist, until they expire
+    [
+        "CREATE TABLE IF NOT EXISTS misses (lookup TEXT, service TEXT, "
+        "expires_at REAL NOT NULL, PRIMARY KEY (lookup, service))",
+    ],
+    # 5: the /upc chain -- musicbrainz releases by barcode, and albums on every
+    # service, joined on upc (kept without leading zeros)
+    [
+        "CREATE TABLE IF NOT EXISTS barcodes (barcode TEXT PRIMARY KEY, mbid TEXT, "
+        "title TEXT, artist TEXT, digital_upcs TEXT)",
+        "CREATE TABLE IF NOT EXISTS albums (service TEXT, album_id TEXT, upc TEXT, "
+        "title TEXT, artist TEXT, url TEXT NOT NULL, PRIMARY KEY (service, album_id))",
+        "CREATE INDEX IF NOT EXISTS albums_upc ON albums (upc, service, url)",
+    ],
+    # 6: full-text index over every cached title and artist, kept in step by triggers
+    [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS titles USING fts5(service UNINDEXED, "
+        "platform_id UNINDEXED, isrc UNINDEXED, url UNINDEXED, title, artist, "
+        "tokenize='unicode61 remove_diacritics 2')",
+        # the titles rowid of each song, by service and primary key
+        "CREATE TABLE IF NOT EXISTS title_keys (id INTEGER PRIMARY KEY, "
+        "service TEXT NOT NULL, song_key TEXT NOT NULL, UNIQUE (service, song_key))",
+        *_index_titles(
+            "spotify",
+            "{row}uid",
+            "uid",
+            "first_artist",
+            "'https://open.spotify.com/track/' || {row}uid",
+        ),
+        *_index_titles(
+            "ytmusic",
+            "{row}uid",
+            "uid",
+            "first_artist",
+            "'https://music.youtube.com/watch?v=' || {row}uid",
+        ),
+        *_index_titles(
+            "applemusic",
+            "{row}songid || ' ' || ifnull({row}albumid, '')",
+            "songid",
+            "artist",
+            "'https://music.apple.com/us/album/' || {row}albumid || '?i=' || {row}songid",
+        ),
+    ],
+    # 7: when each cached song was last fetched, so stale rows get re-checked.
+    # existing rows are left NULL, i.e. of unknown age, and re-checked on next use
+    [
+        "ALTER TABLE spotify ADD COLUMN fetched_at REAL",
+        "ALTER TABLE ytmusic ADD COLUMN fetched_at REAL",
+        "ALTER TABLE applemusic ADD COLUMN fetched_at REAL",
+    ],
+    # 8: the isrc indexes again, now covering fetched_at too, so a cache hit's
+    # freshness check is still answered from the index alone
+    [
+        "DROP INDEX IF EXISTS spotify_isrc",
+        "CREATE INDEX spotify_isrc ON spotify (isrc, uid, fetched_at)",
+        "DROP INDEX IF EXISTS ytmusic_isrc",
+        "CREATE INDEX ytmusic_isrc ON ytmusic (isrc, uid, fetched_at)",
+        "DROP INDEX IF EXISTS applemusic_isrc",
+        "CREATE INDEX applemusic_isrc ON applemusic "
+        "(isrc, songid, albumid, fetched_at)",
+    ],
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def version(con: sqlite3.Connection) -> int:
+    """Get the schema version a database is at."""
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(con: sqlite3.Connection) -> int:
+    """Bring a database up to the current schema.
+
+    Every pending migration runs in its own transaction along with the version bump,
+    so a failure leaves the db at the last version that applied cleanly.
+
+    Args:
+        con (sqlite3.Connection): Connection to the song cache.
+
+    Returns:
+        int: Schema version the database is now at.
+    """
+    current = version(con)
+    for number in range(current + 1, SCHEMA_VERSION + 1):
+        try:
+            # IMMEDIATE takes the write lock up front, so of several processes
+            # opening the db at once, only the first applies each migration
+            con.execute("BEGIN IMMEDIATE")
+            if version(con) >= number:
+                con.rollback()
+                current = number
+                continue
+            for statement in MIGRATIONS[number - 1]:
+                con.execute(statement)
+            con.execute(f"PRAGMA user_version = {number}")
+            con.commit()
+        except sqlite3.Error:
+            con.rollback()
+            raise
+        print(f"Migrated songs.db to schema version {number}")
+        current = number
+    return current
@@ -0,0 +1,386 @@
+"""A headless HTTP/JSON API over the converters, for front-ends besides Discord.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Endpoints:
+    GET  /convert?url=...&to=applemusic[&from=spotify][&best_match=1][&refresh=1]
+    POST /convert with {"to": "applemusic", "urls": [...]}, or per-URL targets as
+         {"items": [{"url": ..., "to": ..., "from": ...}, ...]}
+    GET  /health
+    GET  /metrics
+"""
+
+import asyncio
+from http import HTTPStatus
+import json
+from os import environ
+from urllib.parse import parse_qs, urlsplit
+from dotenv import load_dotenv
+
+# before our own modules, which read their settings from the environment on import
+load_dotenv()
+# pylint: disable=wrong-import-position
+import engine
+import metrics
+import services
+import song
+import workers
+# pylint: enable=wrong-import-position
+
+# constants
+HOST = environ.get("HTTP_HOST", "127.0.0.1")
+PORT = int(environ.get("HTTP_PORT", 8080))
+WORKERS = int(environ.get("HTTP_WORKERS", 8))  # conversions run at once, per priority
+# run conversions in this many worker processes instead of threads in this one (0)
+WORKER_PROCESSES = int(environ.get("WORKER_PROCESSES", 0))
+MAX_BATCH = int(environ.get("HTTP_MAX_BATCH", 100))  # most URLs per POST
+MAX_BODY = 1024 * 1024  # bytes
+IDLE_TIMEOUT = 30  # seconds a kept-alive connection may sit idle
+ROUTES = ("/convert", "/health", "/metrics")  # anything else is labelled "other"
+
+
+class HTTPError(Exception):
+    """Exception for a request we can't serve; becomes a JSON error response."""
+
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class ConversionServer:
+    """Serves conversions over HTTP, through the same engine, converters and songs.db
+    as the bot.
+
+    Nothing about a request is kept between requests, so several of these can run
+    behind a load balancer; they share what they've learned through songs.db."""
+
+    def __init__(self, conversions: engine.ConversionEngine):
+        """Create a server.
+
+        Args:
+            conversions (engine.ConversionEngine): Engine to convert through.
+        """
+        self.conversions = conversions
+        self.converters = conversions.converters
+
+    async def convert(self, query: dict) -> dict:
+        """Convert one song URL, as GET /convert does.
+
+        Args:
+            query (dict): Parsed query string: url, to, and optionally from,
+                best_match and refresh.
+
+        Raises:
+            HTTPError: The request was bad, or no match was found.
+
+        Returns:
+            dict: The URL on the target service, and the song it was matched as.
+        """
+        url = self.__param(query, "url")
+        target = self.__service(self.__param(query, "to"))
+        source = self.__source(url, self.__param(query, "from", None))
+        best_match = self.__param(query, "best_match", "0") == "1"
+        refresh = self.__param(query, "refresh", "0") == "1"
+
+        # if both ends of this are already linked by isrc, we don't need a song obj
+        linked = await self.conversions.linked_url(source, target, url)
+        if linked is not None:
+            return {"url": linked, "from": source, "to": target}
+
+        try:
+            a_song = await self.conversions.to_song(source, url)
+        except song.NoMatchFoundError as e:
+            raise HTTPError(HTTPStatus.NOT_FOUND, "No match found for this URL.") from e
+        try:
+            found = await self.conversions.to_url(
+                target, a_song, best_match=best_match, refresh=refresh
+            )
+        except song.LookupTimeoutError as e:
+            raise HTTPError(HTTPStatus.GATEWAY_TIMEOUT, "Timed out searching.") from e
+        except song.NoMatchFoundError as e:
+            raise HTTPError(HTTPStatus.NOT_FOUND, "No match found.") from e
+        return {
+            "url": found,
+            "from": source,
+            "to": target,
+            "song": {
+                "title": a_song.title,
+                "artist": a_song.first_artist,
+                "isrc": a_song.isrc,
+            },
+        }
+
+    async def convert_batch(self, request: dict) -> dict:
+        """Convert many song URLs at once, as POST /convert does.
+
+        URLs from the same service are read in one batch, and songs headed to the
+        same service are searched in one batch, the same as /playlist.
+
+        Args:
+            request (dict): Parsed JSON body; see the module docstring.
+
+        Raises:
+            HTTPError: The request was bad.
+
+        Returns:
+            dict: {"results": [...]}, one per URL in order, each with a url (None
+                for no match) or an error.
+        """
+        if not isinstance(request, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Expected a JSON object.")
+        items = request.get("items")
+        if items is None:
+            items = [{"url": url} for url in request.get("urls") or []]
+        if not isinstance(items, list) or not items:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Nothing to convert.")
+        if len(items) > MAX_BATCH:
+            raise HTTPError(
+                HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"At most {MAX_BATCH} URLs."
+            )
+        best_match = bool(request.get("best_match"))
+        refresh = bool(request.get("refresh"))
+
+        results = []
+        by_source = {}  # source -> indexes of its URLs
+        for i, item in enumerate(items):
+            if isinstance(item, str):
+                item = {"url": item}
+            url = item.get("url") if isinstance(item, dict) else None
+            result = {"input": url}
+            results.append(result)
+            try:
+                if not isinstance(url, str):
+                    raise HTTPError(HTTPStatus.BAD_REQUEST, "Missing url.")
+                result["to"] = self.__service(item.get("to") or request.get("to"))
+                result["from"] = self.__source(
+                    url, item.get("from") or request.get("from")
+                )
+            except HTTPError as e:
+                result["error"] = e.message
+                continue
+            by_source.setdefault(result["from"], []).append(i)
+
+        # read every service's URLs side by side
+        sources = list(by_source)
+        read = await asyncio.gather(
+            *(
+                self.conversions.to_songs(
+                    source, [results[i]["input"] for i in by_source[source]]
+                )
+                for source in sources
+            ),
+            return_exceptions=True,
+        )
+        songs = {}  # index -> Song obj
+        for source, found in zip(sources, read):
+            self.__fill(results, by_source[source], found, songs)
+
+        by_target = {}
+        for i in songs:
+            by_target.setdefault(results[i]["to"], []).append(i)
+        targets = list(by_target)
+        searched = await asyncio.gather(
+            *(
+                self.conversions.to_urls(
+                    target,
+                    [songs[i] for i in by_target[target]],
+                    best_match=best_match,
+                    refresh=refresh,
+                )
+                for target in targets
+            ),
+            return_exceptions=True,
+        )
+        for target, found in zip(targets, searched):
+            urls = {}
+            self.__fill(results, by_target[target], found, urls)
+            for i, url in urls.items():
+                results[i]["url"] = url
+        return {"results": results}
+
+    async def handle(self, method: str, target: str, body: bytes) -> tuple:
+        """Answer one request.
+
+        Args:
+            method (str): HTTP method.
+            target (str): Path and query string.
+            body (bytes): Request body; empty if there was none.
+
+        Returns:
+            tuple[int, bytes, str]: Status, response body, and its content type.
+        """
+        parts = urlsplit(target)
+        path = parts.path.rstrip("/") or "/"
+        route = path if path in ROUTES else "other"
+        stats = metrics.shared()
+        with stats.timer("http_request_seconds", route=route):
+            try:
+                if path == "/metrics":
+                    status, payload = HTTPStatus.OK, None
+                elif path == "/health":
+                    status, payload = HTTPStatus.OK, {"ok": True}
+                elif path == "/convert" and method == "GET":
+                    query = parse_qs(parts.query)
+                    status, payload = HTTPStatus.OK, await self.convert(query)
+                elif path == "/convert" and method == "POST":
+                    request = self.__json(body)
+                    status, payload = HTTPStatus.OK, await self.convert_batch(request)
+                elif path == "/convert":
+                    raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, "Use GET or POST.")
+                else:
+                    raise HTTPError(HTTPStatus.NOT_FOUND, "No such endpoint.")
+            except HTTPError as e:
+                status, payload = e.status, {"error": e.message}
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                print(f"Error: {e} of class {e.__class__} serving {method} {path}")
+                status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {
+                    "error": "An error occurred!"
+                }
+        stats.inc("http_responses_total", route=route, status=int(status))
+        if payload is None:
+            return status, stats.render().encode(), "text/plain; version=0.0.4"
+        return status, json.dumps(payload).encode(), "application/json"
+
+    async def serve(self, host: str = HOST, port: int = PORT):
+        """Serve HTTP on host:port until cancelled."""
+        server = await asyncio.start_server(self.__connection, host, port)
+        print(f"Serving conversions on http://{host}:{port}/convert")
+        async with server:
+            await server.serve_forever()
+
+    async def __connection(self, reader, writer):
+        """Serve every request on one connection, keeping it alive between them."""
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode("latin-1").split()
+                except ValueError:
+                    await self.__send(writer, HTTPStatus.BAD_REQUEST, b"", "", False)
+                    break
+
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get("content-length", 0) or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self.__send(writer, HTTPStatus.BAD_REQUEST, b"", "", False)
+                    break
+                if length > MAX_BODY:
+                    await self.__send(
+                        writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, b"", "", False
+                    )
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                keep_alive = (
+                    version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                )
+                status, content, content_type = await self.handle(method, target, body)
+                await self.__send(writer, status, content, content_type, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass  # the client went away, or sent something we can't read
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def __send(writer, status: int, body: bytes, content_type: str, keep_alive):
+        status = HTTPStatus(status)
+        head = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        if content_type:
+            head.append(f"Content-Type: {content_type}")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    @staticmethod
+    def __fill(results: list, indexes: list, found, into: dict):
+        """Spread one batch's results back over the items they came from: hits into
+        `into`, misses and failures as errors."""
+        if isinstance(found, Exception):
+            print(f"Error: {found} of class {found.__class__} in a batch conversion")
+            for i in indexes:
+                results[i]["error"] = "An error occurred!"
+            return
+        for i, value in zip(indexes, found):
+            if value is None:
+                results[i]["url"] = None
+                results[i]["error"] = "No match found."
+            else:
+                into[i] = value
+
+    @staticmethod
+    def __json(body: bytes):
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Body isn't valid JSON.") from e
+
+    @staticmethod
+    def __param(query: dict, name: str, default: str = ...) -> str:
+        values = query.get(name)
+        if values:
+            return values[0]
+        if default is ...:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Missing {name}.")
+        return default
+
+    def __service(self, name: str | None) -> str:
+        # anything but a string, e.g. a list in a JSON body, can't name one
+        if not isinstance(name, str) or name not in self.converters:
+            raise HTTPError(
+                HTTPStatus.BAD_REQUEST,
+                f"Unknown service {name!r}; pick one of {', '.join(self.converters)}.",
+            )
+        return name
+
+    def __source(self, url: str, name: str | None) -> str:
+        """The service a URL is from: the one named, or else the one it belongs to."""
+        if name is not None:
+            return self.__service(name)
+        source = self.converters.detect(url)
+        if source is None:
+            raise HTTPError(
+                HTTPStatus.BAD_REQUEST,
+                "Couldn't tell which service that URL is from; pass from.",
+            )
+        return source
+
+
+if __name__ == "__main__":
+    converters = services.enabled()
+    if WORKER_PROCESSES:
+        converters = workers.remote(converters, WORKER_PROCESSES)
+    conversions = engine.ConversionEngine(
+        converters, max_workers=max(WORKERS, WORKER_PROCESSES)
+    )
+    asyncio.run(ConversionServer(conversions).serve())
@@ -0,0 +1,90 @@
+"""The services we can convert between, for every front-end to build converters from.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import importlib
+from os import environ
+import registry
+
+
+# each API obj is only made the first time it's needed; the imports wait too, since
+# the client libraries are slow to load. keys are read from the environment then,
+# so load the .env before the first conversion, not before importing this
+def make_spotify():
+    """Make the Spotify converter."""
+    import spotify  # pylint: disable=import-outside-toplevel
+
+    return spotify.SpotifyConverter(
+        environ.get("SP_CLIENT_ID"), environ.get("SP_CLIENT_SCRT")
+    )
+
+
+def make_applemusic():
+    """Make the Apple Music converter."""
+    import applemusic  # pylint: disable=import-outside-toplevel
+
+    return applemusic.AppleMusicConverter(
+        environ.get("AP_SECRET_KEY"),
+        environ.get("AP_KEY_ID"),
+        environ.get("AP_TEAM_ID"),
+    )
+
+
+def make_ytmusic():
+    """Make the YT Music converter."""
+    import ytmusic  # pylint: disable=import-outside-toplevel
+
+    return ytmusic.YTMusicConverter()
+
+
+AVAILABLE = {
+    "spotify": ("Spotify", make_spotify, r"open\.spotify\.com/|^spotify:"),
+    "applemusic": ("Apple Music", make_applemusic, r"music\.apple\.com/"),
+    "ytmusic": ("YT Music", make_ytmusic, r"youtube\.com/|youtu\.be/"),
+}
+
+# name -> (module, class) of each converter
+CLASSES = {
+    "spotify": ("spotify", "SpotifyConverter"),
+    "applemusic": ("applemusic", "AppleMusicConverter"),
+    "ytmusic": ("ytmusic", "YTMusicConverter"),
+}
+
+
+def converter_class(name: str) -> type:
+    """Get a service's converter class, without making a converter (or its API
+    client), e.g. for its static URL parsing."""
+    module, cls = CLASSES[name]
+    return getattr(importlib.import_module(module), cls)
+
+
+def enabled(names: str = None) -> registry.Registry:
+    """Register the services a front-end should serve.
+
+    Args:
+        names (str, optional): Comma-separated service names. Defaults to the
+            ENABLED_SERVICES setting, or every service if that's unset.
+
+    Returns:
+        registry.Registry: A registry of them; nothing is built yet.
+    """
+    if names is None:
+        names = environ.get("ENABLED_SERVICES", ",".join(AVAILABLE))
+    converters = registry.Registry()
+    for name in names.split(","):
+        label, factory, pattern = AVAILABLE[name.strip()]
+        converters.register(name.strip(), label, factory, pattern)
+    return converters
@@ -0,0 +1,74 @@
+"""Pooled, keep-alive HTTP sessions for the APIs we call with plain requests.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# musicbrainz throttles anonymous clients hardest; it asks for app/version (contact)
+USER_AGENT = (
+    "StreamConverter/2024.12.20 ( https://github.com/JayToTheAy/StreamConverter )"
+)
+DEFAULT_TIMEOUT = 5  # seconds
+POOL_SIZE = 16  # most open connections kept per host
+
+
+class PooledSession(requests.Session):
+    """A requests.Session that always has a timeout and retries failed connections.
+
+    Connections are kept alive and reused, so a chain of calls to the same API
+    only pays for the TCP and TLS handshakes once. Error statuses are never retried
+    here, only handed back: a retry of a 5xx would skip the scheduler's rate limit,
+    and one of a 429 or 503 would sleep through what should back off every caller
+    at once. Callers retry those themselves, through the scheduler."""
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+        self.headers["User-Agent"] = USER_AGENT
+        retries = Retry(
+            total=3,
+            read=0,
+            status=0,
+            backoff_factor=0.5,
+            allowed_methods=("GET", "HEAD"),
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=retries
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(*args, **kwargs)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get(name: str) -> PooledSession:
+    """Get the shared session for an upstream (e.g. musicbrainz, musicfetch),
+    creating it on first use."""
+    with _sessions_lock:
+        if name not in _sessions:
+            _sessions[name] = PooledSession()
+        return _sessions[name]
@@ -15,7 +15,7 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>."""
 
-import re
+import match
 
 
 class NoMatchFoundError(Exception):
@@ -24,8 +24,29 @@ class NoMatchFoundError(Exception):
     pass
 
 
+class LookupTimeoutError(NoMatchFoundError):
+    """Exception for when a lookup runs out of time before it finds a match. Unlike
+    a plain NoMatchFoundError, this isn't remembered as a miss."""
+
+    pass
+
+
 class Song:
-    """A song."""
+    """A song.
+
+    Songs are small value objects, kept by the thousand in the cache, so they have
+    no __dict__. The raw upstream payload isn't kept at all: pass attributes as a
+    callable and it's only fetched if something reads Song.attributes."""
+
+    __slots__ = (
+        "source",
+        "uid",
+        "isrc",
+        "title",
+        "first_artist",
+        "_attributes",
+        "_match_key",
+    )
 
     def __init__(
         self,
@@ -41,19 +62,73 @@ class Song:
         self.isrc = isrc.lower() if isinstance(isrc, str) else isrc
         self.title = title
         self.first_artist = first_artist
-        self.attributes = attributes
+        self._attributes = attributes  # a dict, a callable returning one, or None
+        self._match_key = None
+
+    @property
+    def attributes(self) -> dict | None:
+        """Raw data from the service this came from, loaded on first use."""
+        if callable(self._attributes):
+            self._attributes = self._attributes()
+        return self._attributes
 
     def __eq__(self, other):
         if not isinstance(other, Song):
             return False
 
-        return self.isrc.lower() == other.isrc.lower()
+        if self.isrc is not None and other.isrc is not None:
+            return self.isrc == other.isrc
+        return self.lookup_key() == other.lookup_key()
 
-    def is_similar(self, other):
-        """Returns true if the songs are similar."""
-        our_filter = (
-            r"\({0,1}(official){0,1}( ){0,1}(music|lyric){1}( ){0,1}(video)\){0,1}"
+    def __hash__(self):
+        # isrc is lowercased once in __init__, so it hashes as-is
+        if self.isrc is not None:
+            return hash(self.isrc)
+        return hash(self.lookup_key())
+
+    def __repr__(self):
+        return (
+            f"Song({self.source!r}, {self.uid!r}, {self.isrc!r}, {self.title!r}, "
+            f"{self.first_artist!r})"
         )
-        self_title = re.sub(our_filter, "", self.title, flags=re.I)
-        other_title = re.sub(our_filter, "", other.title, flags=re.I)
-        return self_title == other_title and self.first_artist == other.first_artist
+
+    def __getstate__(self):
+        # a lazy attributes loader is bound to its converter's API client, which
+        # can't cross to another process; the other side fetches its own if needed
+        state = {name: getattr(self, name) for name in self.__slots__}
+        if callable(state["_attributes"]):
+            state["_attributes"] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def lookup_key(self) -> str:
+        """A key for everything we'd search on: the ISRC if we have one, else title
+        and artist, else (a song we know nothing about yet) its ID."""
+        return self.lookup_keys()[0]
+
+    def lookup_keys(self) -> list[str]:
+        """Every key a search for this song may have been made under: the ISRC, and
+        title and artist, whichever we have; the ID if we have neither."""
+        keys = []
+        if self.isrc is not None:
+            keys.append(f"isrc:{self.isrc}")
+        if self.title is not None:
+            artist = (self.first_artist or "").lower()
+            keys.append(f"title:{self.title.lower()}\x1f{artist}")
+        return keys or [f"id:{self.source}:{self.uid}"]
+
+    @property
+    def match_key(self) -> tuple:
+        """Title tokens, live flag and artist tokens, normalized once per song."""
+        if self._match_key is None:
+            title, live = match.title_key(self.title)
+            self._match_key = title, live, match.artist_key(self.first_artist)
+        return self._match_key
+
+    def is_similar(self, other):
+        """Returns true if the songs are similar, ignoring things like
+        (Official Video), featured artists, case, accents and punctuation."""
+        return match.score(self.match_key, other.match_key) >= match.THRESHOLD
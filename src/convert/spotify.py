@@ -16,19 +16,38 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>."""
 
 from collections.abc import Iterable
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import urllib.parse
-import sqlite3
 import requests
 import spotipy
-import ratelimit
+import album
+import cache
+import freshness
+import match
+import metrics
+import misses
+import recordings
+import scheduler
+import sessions
 import song
+import storage
+import strategy
+import titles
 
 
 class SpotifyConverter(spotipy.Spotify):
     """Converts between songs and URLs."""
 
-    con = sqlite3.connect("../db/songs.db")  # this is relative to the convert pkg
-    cur = con.cursor()
+    db = storage.shared()
+    memo = cache.shared()
+    limiter = scheduler.shared()
+    revalidator = freshness.shared()
+    BATCH_SIZE = 50  # most IDs the tracks endpoint takes at once
+    BATCH_WORKERS = 8  # searches run side by side in a batch
+    MUSICBRAINZ_TRIES = 3  # most times a musicbrainz query is sent, if it fails
 
     """A converter for Spotify."""
 
@@ -36,7 +55,16 @@ class SpotifyConverter(spotipy.Spotify):
         auth_manager = spotipy.SpotifyClientCredentials(
             client_id=client_id, client_secret=client_secret
         )
-        super().__init__(auth_manager=auth_manager)
+        super().__init__(auth_manager=auth_manager, retries=0, status_retries=0)
+
+    def _build_session(self):
+        """spotipy's session, minus its retries. Those sleep through a 429 in the
+        calling thread and then raise it without its Retry-After (429 is on their
+        status list even with no retries left), so the scheduler never saw it."""
+        super()._build_session()
+        adapter = requests.adapters.HTTPAdapter(max_retries=0)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
 
     def uri_to_song(self, url: str) -> song.Song:
         """Generate a Song obj from a Spotify track URI.
@@ -50,123 +78,577 @@ class SpotifyConverter(spotipy.Spotify):
             song.Song: Song object containing data on that song.
         """
 
-        # check the db first
-        uri = self.__uid_strip(url)
-        self.cur.execute("SELECT * FROM spotify WHERE uid=?", [uri])
-        track = self.cur.fetchone()
+        # check memory, then the db
+        uri = self.parse_url(url)
+        result_song = self.memo.get(("song", "spotify", uri))
+        if result_song is not None:
+            return result_song
+
+        track = self.db.query_one("SELECT * FROM spotify WHERE uid=?", [uri])
         if track is not None:
-            return song.Song(
-                source="spotify",
-                uid=track[0],
-                isrc=track[1],
-                title=track[2],
-                first_artist=track[3],
-            )
+            self.__check_fresh(track[0], track[4])
+            result_song = self.__row_to_song(track)
+            self.memo.put(("song", "spotify", uri), result_song)
+            return result_song
 
         # if db came up empty:
         track = self.track(url)
         if track is not None:
+            result_song = self.__track_to_song(track)
             self.__commit_song(
-                track["id"],
-                track["external_ids"]["isrc"],
-                track["name"],
-                track["artists"][0]["name"],
-            )
-
-            result_song = song.Song(
-                source="spotify",
-                uid=track["id"],
-                isrc=track["external_ids"]["isrc"],
-                title=track["name"],
-                first_artist=track["artists"][0]["name"],
-                attributes=track,
+                result_song.uid,
+                result_song.isrc,
+                result_song.title,
+                result_song.first_artist,
             )
+            self.memo.put(("song", "spotify", uri), result_song)
             return result_song
 
         raise song.NoMatchFoundError("No match found for this URL.")
 
-    def song_to_url(self, a_song: song.Song) -> tuple[str, str]:
+    def song_to_url(
+        self, a_song: song.Song, refresh: bool = False, deadline: float = None
+    ) -> tuple[str, str]:
         """Convert a song to its spotify ID and URL.
 
         Args:
             a_song (song.Song): A song object to search for.
+            refresh (bool, optional): Search again even if this song recently came up
+                empty. Defaults to False.
+            deadline (float, optional): time.monotonic() to give up at. Defaults to
+                strategy.LOOKUP_BUDGET from now.
 
         Raises:
             NoMatchFoundError: No match found for this song.
+            LookupTimeoutError: Ran out of time before finding a match.
 
         Returns:
             tuple[str, str]: Tuple of the Spotify URI and the URL to play the song from.
         """
 
-        # first, check the database for the isrc if we have an isrc
+        # first, check memory and then the database for the isrc if we have an isrc
         if a_song.isrc is not None:
-            self.cur.execute(
-                "SELECT uid FROM spotify WHERE isrc=? limit 1", [a_song.isrc]
+            found = self.memo.get(("url", a_song.isrc, "spotify"))
+            if found is not None:
+                return found
+
+            track = self.db.query_one(
+                "SELECT uid, fetched_at FROM spotify WHERE isrc=? limit 1",
+                [a_song.isrc],
             )
-            track = self.cur.fetchone()
             if track is not None:
-                uid = (track[0],)
+                uid = track[0]
+                self.__check_fresh(uid, track[1])
                 url = f"https://open.spotify.com/track/{uid}"
+                self.memo.put(("url", a_song.isrc, "spotify"), (uid, url))
                 return uid, url
 
-            # if nothing was returned from the DB, search Spotify by isrc
-            track = self.search(q=f"isrc:{a_song.isrc}", limit=1, type="track")
-            if track is not None:
-                uid = track["tracks"]["items"][0]["id"]
-                url = track["tracks"]["items"][0]["external_urls"]["spotify"]
-                title = track["tracks"]["items"][0]["name"]
-                first_artist = track["tracks"]["items"][0]["artists"][0]["name"]
+        # fail fast if we recently came up empty on this one; only now, so a cache
+        # hit never pays for the check
+        if not refresh and misses.is_known_miss(self.db, a_song, "spotify"):
+            raise song.NoMatchFoundError("No match found for this song.")
 
-                # add the track to the database
-                self.__commit_song(uid, a_song.isrc, title, first_artist)
-                return uid, url
+        # then go to Spotify: by isrc first, with the title search started
+        # alongside it if that drags on
+        strategies = [functools.partial(self.__search_by_title, a_song)]
+        if a_song.isrc is not None:
+            strategies.insert(0, functools.partial(self.__search_by_isrc, a_song))
+        found = strategy.first(strategies, deadline or strategy.deadline_in())
+        if found is not None:
+            return found
+
+        # if we never got a match -- remember that, and raise an exception
+        misses.record(self.db, a_song, "spotify")
+        raise song.NoMatchFoundError("No match found for this song.")
+
+    def __search_by_isrc(self, a_song: song.Song, _cancel) -> tuple[str, str] | None:
+        """Search Spotify for a song by ISRC."""
+        track = self.search(q=f"isrc:{a_song.isrc}", limit=1, type="track")
+        if track is None or not track["tracks"]["items"]:
+            return None
+        uid = track["tracks"]["items"][0]["id"]
+        url = track["tracks"]["items"][0]["external_urls"]["spotify"]
+        title = track["tracks"]["items"][0]["name"]
+        first_artist = track["tracks"]["items"][0]["artists"][0]["name"]
+
+        # add the track to the database
+        self.__commit_song(uid, a_song.isrc, title, first_artist)
+        self.memo.put(("url", a_song.isrc, "spotify"), (uid, url))
+        return uid, url
+
+    def __search_by_title(self, a_song: song.Song, cancel) -> tuple[str, str] | None:
+        """Find a song by title and artist, in the cache and then on Spotify."""
+        # a title we've cached on any service may already answer it
+        found = titles.find(self.db, a_song, "spotify")
+        if found is not None:
+            return found
+        if cancel.is_set():
+            return None
 
-        # if we failed to find a match, search by name and artist
         track = self.search(
             q=f"track:{a_song.title} artist:{a_song.first_artist}",
-            limit=1,
+            limit=5,
             type="track",
         )
-        if track is not None:
-            uid = track["tracks"]["items"][0]["id"]
-            url = track["tracks"]["items"][0]["external_urls"]["spotify"]
-            title = track["tracks"]["items"][0]["name"]
-            isrc = track["tracks"]["items"][0]["external_ids"]["isrc"]
-            first_artist = track["tracks"]["items"][0]["artists"][0]["name"]
-
-            # only commit exact matches
-            if a_song["title"] == title and first_artist == a_song["first_artist"]:
-                self.__commit_song(uid, isrc, title, first_artist)
-                return uid, url
+        if track is None or not track["tracks"]["items"]:
+            return None
+        # rank every result and only commit one that's close enough
+        found_song = match.best(
+            a_song, [self.__track_to_song(item) for item in track["tracks"]["items"]]
+        )
+        if found_song is None:
+            return None
+        self.__commit_song(
+            found_song.uid, found_song.isrc, found_song.title, found_song.first_artist
+        )
+        return found_song.uid, f"https://open.spotify.com/track/{found_song.uid}"
 
-        # if we never got a match -- raise an exception
-        raise song.NoMatchFoundError("No match found for this song.")
+    def urls_to_songs(self, urls: list[str]) -> list[song.Song | None]:
+        """Generate Song objs for many Spotify track URIs at once.
+
+        Cached tracks come from memory or a single db query; the rest are fetched
+        BATCH_SIZE at a time from the tracks endpoint.
+
+        Args:
+            urls (list[str]): Any valid spotify track URIs.
+
+        Returns:
+            list[song.Song | None]: A Song obj per URL, in order; None for no match.
+        """
+        uids = [self.parse_url(url) for url in urls]
+        found = {}
+        for uid in uids:
+            cached = self.memo.get(("song", "spotify", uid))
+            if cached is not None:
+                found[uid] = cached
+
+        missing = list(dict.fromkeys(uid for uid in uids if uid not in found))
+        for track in self.db.query_in(
+            "SELECT * FROM spotify WHERE uid IN ({marks})", missing
+        ):
+            self.__check_fresh(track[0], track[4])
+            found[track[0]] = self.__row_to_song(track)
+            self.memo.put(("song", "spotify", track[0]), found[track[0]])
+
+        missing = [uid for uid in missing if uid not in found]
+        for start in range(0, len(missing), self.BATCH_SIZE):
+            batch = missing[start : start + self.BATCH_SIZE]
+            for track in self.tracks(batch)["tracks"]:
+                if track is None:
+                    continue
+                result_song = self.__track_to_song(track)
+                self.__commit_song(
+                    result_song.uid,
+                    result_song.isrc,
+                    result_song.title,
+                    result_song.first_artist,
+                )
+                self.memo.put(("song", "spotify", result_song.uid), result_song)
+                found[result_song.uid] = result_song
+
+        return [found.get(uid) for uid in uids]
+
+    def songs_to_urls(
+        self, songs: list[song.Song | None], refresh: bool = False
+    ) -> list[tuple[str, str] | None]:
+        """Convert many songs to their spotify IDs and URLs at once.
+
+        Cached ISRCs come from memory or a single db query. Spotify can only search
+        one ISRC at a time, so the rest go through song_to_url side by side.
+
+        Args:
+            songs (list[song.Song | None]): Song objs to search for; None is skipped.
+            refresh (bool, optional): Search again even if a song recently came up
+                empty. Defaults to False.
+
+        Returns:
+            list[tuple[str, str] | None]: (URI, URL) per song, in order; None for no
+                match.
+        """
+        results = [None] * len(songs)
+        pending = []
+        for i, a_song in enumerate(songs):
+            if a_song is None:
+                continue
+            if a_song.isrc is not None:
+                results[i] = self.memo.get(("url", a_song.isrc, "spotify"))
+            if results[i] is None:
+                pending.append(i)
+
+        isrcs = {songs[i].isrc for i in pending if songs[i].isrc is not None}
+        uids = {}
+        for isrc, uid, fetched_at in self.db.query_in(
+            "SELECT isrc, uid, fetched_at FROM spotify WHERE isrc IN ({marks})", isrcs
+        ):
+            self.__check_fresh(uid, fetched_at)
+            uids[isrc] = uid
+        rest = []
+        for i in pending:
+            uid = uids.get(songs[i].isrc)
+            if uid is None:
+                rest.append(i)
+                continue
+            results[i] = uid, f"https://open.spotify.com/track/{uid}"
+            self.memo.put(("url", songs[i].isrc, "spotify"), results[i])
+
+        with ThreadPoolExecutor(self.BATCH_WORKERS) as pool:
+            found = pool.map(
+                scheduler.carry(lambda a_song: self.__try_song_to_url(a_song, refresh)),
+                [songs[i] for i in rest],
+            )
+            for i, result in zip(rest, found):
+                results[i] = result
+        return results
+
+    def playlist_to_songs(self, url: str) -> list[song.Song]:
+        """Generate Song objs for every track on a Spotify playlist.
+
+        The playlist listing already carries each track's ISRC, so no further
+        lookups are needed; tracks we haven't seen before are added to the db.
+
+        Args:
+            url (str): Any valid spotify playlist URI.
+
+        Returns:
+            list[song.Song]: Songs on the playlist, in order.
+        """
+        playlist_id = url.split(":")[-1].split("/")[-1].split("?")[0]
+        tracks = []
+        results = self.playlist_items(playlist_id, additional_types=("track",))
+        while results is not None:
+            for item in results["items"]:
+                # local files and removed tracks have no id
+                track = item.get("track")
+                if track is not None and track.get("id") is not None:
+                    tracks.append(track)
+            results = self.next(results) if results.get("next") else None
+
+        known = {
+            row[0]
+            for row in self.db.query_in(
+                "SELECT uid FROM spotify WHERE uid IN ({marks})",
+                {track["id"] for track in tracks},
+            )
+        }
+        songs = []
+        for track in tracks:
+            result_song = self.__track_to_song(track)
+            if result_song.uid not in known:
+                known.add(result_song.uid)
+                self.__commit_song(
+                    result_song.uid,
+                    result_song.isrc,
+                    result_song.title,
+                    result_song.first_artist,
+                )
+            songs.append(result_song)
+        return songs
+
+    def trending_songs(self, limit: int = 20) -> list[song.Song]:
+        """Generate Song objs for every track on Spotify's newest releases.
+
+        Args:
+            limit (int, optional): How many new albums to take, up to 50. Defaults
+                to 20.
+
+        Returns:
+            list[song.Song]: Tracks on the new releases, album by album.
+        """
+        albums = self.new_releases(limit=limit)["albums"]["items"]
+        uids = []
+        for batch in range(0, len(albums), 20):  # the albums endpoint takes 20 at once
+            found = self.albums([item["id"] for item in albums[batch : batch + 20]])
+            for item in found["albums"]:
+                if item is not None:
+                    uids.extend(track["id"] for track in item["tracks"]["items"])
+        # album listings leave out ISRCs, so the tracks themselves are fetched
+        return [a_song for a_song in self.urls_to_songs(uids) if a_song is not None]
+
+    def album_url_to_album(self, url: str) -> album.Album:
+        """Generate an Album obj from a Spotify album URI.
+
+        Args:
+            url (str): Any valid spotify album URI.
+
+        Raises:
+            NoMatchFoundError: No match was found for this URL.
+
+        Returns:
+            album.Album: Album obj containing data on that album.
+        """
+        album_id = self.parse_album_url(url)
+        row = self.db.query_one(
+            "SELECT upc, title, artist FROM albums \
+            WHERE service='spotify' AND album_id=?",
+            [album_id],
+        )
+        if row is not None and None not in row:
+            return album.Album("spotify", album_id, row[0], row[1], row[2])
+
+        found = self.album(album_id)
+        if found is None:
+            raise song.NoMatchFoundError("No match found for this URL.")
+        result = album.Album(
+            source="spotify",
+            uid=found["id"],
+            upc=found.get("external_ids", {}).get("upc"),
+            title=found["name"],
+            first_artist=found["artists"][0]["name"],
+        )
+        self.__commit_album(result)
+        return result
+
+    def album_to_url(self, an_album: album.Album, best_match: bool = False) -> str:
+        """Convert an album to its Spotify URL.
+
+        Args:
+            an_album (album.Album): Album obj to search for.
+            best_match (bool, optional): Take the top title/artist result even if it
+                doesn't match exactly. Defaults to False.
+
+        Raises:
+            NoMatchFoundError: No match found for this album.
+
+        Returns:
+            str: URL to play the album from.
+        """
+        # the db and a upc search come first, as with songs and isrcs
+        if an_album.upc is not None:
+            url = self.find_sp_album_for_upc(an_album.padded(12))
+            if url is not None:
+                return url
+
+        response = self.search(
+            q=f"album:{an_album.title} artist:{an_album.first_artist}",
+            type="album",
+            limit=5,
+        )
+        items = response.get("albums").get("items")
+        for found in items:
+            candidate = album.Album(
+                "spotify", found["id"], None, found["name"], found["artists"][0]["name"]
+            )
+            if an_album.is_similar(candidate):
+                # we only matched by name; looking it up caches it along with its upc
+                self.album_url_to_album(found["id"])
+                return f"https://open.spotify.com/album/{found['id']}"
+        if best_match and items:
+            return f"https://open.spotify.com/album/{items[0]['id']}"
+
+        raise song.NoMatchFoundError("No match found for this album.")
+
+    def linked_album_urls(self, url: str) -> dict[str, str]:
+        """Get every other service's URL we already know for this album, from the db.
+
+        Args:
+            url (str): Any valid spotify album URI.
+
+        Returns:
+            dict[str, str]: Maps service name to URL; empty if nothing is linked yet.
+        """
+        return recordings.resolve_album(
+            self.db.cursor(), "spotify", self.parse_album_url(url)
+        )
+
+    @staticmethod
+    def parse_album_url(uid: str) -> str:
+        """Strip the Spotify album URI to just the ID."""
+        if "spotify:album:" in uid:
+            return uid.split(":")[-1]
+        if "album/" in uid:
+            return uid.split("/")[-1].split("?")[0]
+
+        return uid  # assume it's already just the ID
+
+    # the registry.Converter protocol
+    def to_song(self, url: str) -> song.Song:
+        """uri_to_song, under the name every converter shares."""
+        return self.uri_to_song(url)
+
+    def to_url(
+        self,
+        a_song: song.Song,
+        best_match: bool = False,  # pylint: disable=unused-argument
+        refresh: bool = False,
+        deadline: float = None,
+    ) -> str:
+        """song_to_url, but just the URL. Spotify only takes real matches, so
+        best_match makes no difference."""
+        return self.song_to_url(a_song, refresh=refresh, deadline=deadline)[1]
+
+    def to_songs(self, urls: list[str]) -> list[song.Song | None]:
+        """urls_to_songs, under the name every converter shares."""
+        return self.urls_to_songs(urls)
+
+    def to_urls(
+        self,
+        songs: list[song.Song | None],
+        best_match: bool = False,  # pylint: disable=unused-argument
+        refresh: bool = False,
+    ) -> list[str | None]:
+        """songs_to_urls, but just the URLs."""
+        found = self.songs_to_urls(songs, refresh=refresh)
+        return [result[1] if result is not None else None for result in found]
+
+    def linked_urls(self, url: str) -> dict[str, tuple]:
+        """Get every other service's URL we already know for this track, from the db only.
+
+        Args:
+            url (str): Any valid spotify track URI.
+
+        Returns:
+            dict[str, tuple]: Maps service name to (platform ID, URL, fetched_at),
+                as recordings.resolve does; empty if nothing is linked yet.
+        """
+        return recordings.resolve(self.db.cursor(), "spotify", self.parse_url(url))
 
     @staticmethod
-    def __uid_strip(uid: str) -> str:
+    def parse_url(uid: str) -> str:
         """Strip the Spotify URI to just the ID."""
         if "spotify:track:" in uid:
             return uid.split(":")[-1]
         if "track/" in uid:
-            uid = uid.split("/")[-1]
-            if "?" in uid:
-                return uid.split("?")[0]
+            return uid.split("/")[-1].split("?")[0]
 
         return uid  # assume it's already just the ID
 
+    def revalidate(self, uid: str):
+        """Fetch a cached track again, and update or drop its row.
+
+        Args:
+            uid (str): Spotify ID of the track.
+        """
+        try:
+            track = self.track(uid)
+        except spotipy.SpotifyException as e:
+            if e.http_status not in (400, 404):
+                raise
+            track = None
+        if track is None:
+            self.__forget_song(uid)
+            return
+        result_song = self.__track_to_song(track)
+        self.__commit_song(
+            result_song.uid,
+            result_song.isrc,
+            result_song.title,
+            result_song.first_artist,
+        )
+
+    def revalidate_later(self, uid: str):
+        """Queue a re-check of a cached song on the revalidator's thread, e.g. once
+        it's been served stale from the recordings table."""
+        self.revalidator.submit(("spotify", uid), self.revalidate, uid)
+
+    def __check_fresh(self, uid: str, fetched_at: float | None):
+        """Queue a re-check of a cached track if it's stale; it's served either way."""
+        if freshness.is_stale(fetched_at):
+            self.revalidate_later(uid)
+
+    def __try_song_to_url(self, a_song: song.Song, refresh: bool):
+        """song_to_url, but None instead of raising when there's no match."""
+        try:
+            return self.song_to_url(a_song, refresh=refresh)
+        except song.NoMatchFoundError:
+            return None
+
+    @staticmethod
+    def __row_to_song(row) -> song.Song:
+        """Make a Song obj from a spotify table row."""
+        return song.Song(
+            source="spotify",
+            uid=row[0],
+            isrc=row[1],
+            title=row[2],
+            first_artist=row[3],
+        )
+
+    def __track_to_song(self, track: dict) -> song.Song:
+        """Make a Song obj from a Spotify track object. The track object isn't kept
+        (it carries the whole album and market list); it's fetched again if the
+        Song's attributes are ever read."""
+        return song.Song(
+            source="spotify",
+            uid=track["id"],
+            isrc=track.get("external_ids", {}).get("isrc"),
+            title=track["name"],
+            first_artist=track["artists"][0]["name"],
+            attributes=functools.partial(self.track, track["id"]),
+        )
+
+    @classmethod
+    def __commit_album(cls, an_album: album.Album) -> str:
+        """Add an album to the database, and return its URL."""
+        print(f"Made an album commit to spotify: {an_album.upc}")
+        url = f"https://open.spotify.com/album/{an_album.uid}"
+        cls.db.write(
+            recordings.link_album,
+            "spotify",
+            an_album.uid,
+            an_album.upc,
+            an_album.title,
+            an_album.first_artist,
+            url,
+        )
+        return url
+
     @classmethod
     def __commit_song(cls, spotify_uid: str, isrc: str, title: str, first_artist: str):
         """Add a song to the database."""
         print(f"Made a commit to spotify: {isrc}")
-        cls.cur.execute(
-            "INSERT INTO spotify VALUES (?, ?, ?, ?)",
-            [spotify_uid, isrc.lower(), title, first_artist],
+        isrc = isrc.lower() if isrc is not None else None  # local files have none
+        found = song.Song("spotify", spotify_uid, isrc, title, first_artist)
+        misses.forget(cls.db, found, "spotify")
+        # an upsert, so two conversions racing to cache the same track don't collide
+        cls.db.execute(
+            "INSERT INTO spotify(uid, isrc, title, first_artist, fetched_at) \
+            VALUES (?, ?, ?, ?, ?) ON CONFLICT(uid) DO UPDATE SET isrc=excluded.isrc, \
+            title=excluded.title, first_artist=excluded.first_artist, \
+            fetched_at=excluded.fetched_at",
+            [spotify_uid, isrc, title, first_artist, time.time()],
+        )
+        cls.db.write(
+            recordings.link,
+            "spotify",
+            spotify_uid,
+            isrc,
+            f"https://open.spotify.com/track/{spotify_uid}",
+        )
+        # not before the upsert lands, or a read in between memoizes the old row
+        cls.db.after_commit(
+            cls.memo.invalidate,
+            ("song", "spotify", spotify_uid),
+            ("url", isrc, "spotify"),
+        )
+
+    @classmethod
+    def __forget_song(cls, spotify_uid: str):
+        """Drop a track that's gone from Spotify from the database."""
+        print(f"Dropped a pulled track from spotify: {spotify_uid}")
+        row = cls.db.query_one("SELECT isrc FROM spotify WHERE uid=?", [spotify_uid])
+        cls.db.execute("DELETE FROM spotify WHERE uid=?", [spotify_uid])
+        cls.db.write(recordings.unlink, "spotify", spotify_uid)
+        cls.db.after_commit(
+            cls.memo.invalidate,
+            ("song", "spotify", spotify_uid),
+            ("url", row[0] if row is not None else None, "spotify"),
         )
-        cls.con.commit()
 
     @classmethod
     def get_release_for_barcode(cls, barcode, timeout:int=3):
-        """Gets release data from MusicBrainz for a given UPC."""
+        """Gets release data from MusicBrainz for a given UPC.
+        Releases we've looked up before come from the db."""
+        barcode = str(barcode)
+        row = cls.db.query_one('SELECT mbid, title, artist FROM barcodes WHERE barcode=?',
+                               [barcode])
+        if row is not None:
+            return {
+                'title': row[1],
+                'artists': [{'name': row[2]}],
+                'mbid': row[0],
+                'barcode': barcode
+            }
+
         response = cls.__query_musicbrainz('release?fmt=json&query=barcode:'
                                            + barcode,
                                            timeout=timeout)
@@ -182,10 +664,15 @@ class SpotifyConverter(spotipy.Spotify):
             'mbid': release['id'],
             'barcode': release['barcode']
         }
+        cls.db.execute('INSERT INTO barcodes(barcode, mbid, title, artist) VALUES \
+                       (?, ?, ?, ?) ON CONFLICT(barcode) DO UPDATE SET mbid=excluded.mbid, \
+                       title=excluded.title, artist=excluded.artist',
+                       [barcode, release['id'], release['title'],
+                        release['artist-credit'][0]['name']])
         return release_attributes
 
     @classmethod
-    def get_digital_releases_from_title_and_artist(cls, title: str, artist: str, timeout:int=3) -> list[int]:
+    def get_digital_releases_from_title_and_artist(cls, title: str, artist: str, timeout:int=3) -> set[str]:
         """Gets digital releases given title and artist"""
         response = cls.__query_musicbrainz('release?fmt=json&query='
                                 + urllib.parse.quote(title + ' AND ')
@@ -195,14 +682,60 @@ class SpotifyConverter(spotipy.Spotify):
         if not response.ok:
             raise response.raise_for_status()
 
+        # barcodes stay strings; plenty of them start with a 0
         upcs = set()
         for release in response.json()['releases']:
-            if release != '':
-                upcs.add(int(release['barcode']))
+            if release.get('barcode'):
+                upcs.add(release['barcode'])
 
         return upcs
 
-    def find_sp_albums_from_upcs(self, upcs: Iterable[int]):
+    @classmethod
+    def get_digital_upcs_for_barcode(cls, barcode, timeout:int=3) -> list[str]:
+        """Gets the UPCs of every digital release of the same album as a barcode,
+        with the barcode itself first. Cached in the db after the first lookup."""
+        barcode = str(barcode)
+        row = cls.db.query_one('SELECT digital_upcs FROM barcodes WHERE barcode=?',
+                               [barcode])
+        if row is not None and row[0] is not None:
+            return json.loads(row[0])
+
+        release = cls.get_release_for_barcode(barcode, timeout=timeout)
+        digital = cls.get_digital_releases_from_title_and_artist(
+            release['title'], release['artists'][0]['name'], timeout=timeout)
+        upcs = [barcode] + sorted(digital - {barcode})
+        cls.db.execute('UPDATE barcodes SET digital_upcs=? WHERE barcode=?',
+                       [json.dumps(upcs), barcode])
+        return upcs
+
+    def cached_sp_album_for_upcs(self, upcs: Iterable[str]) -> str | None:
+        """Get the first Spotify album URL we already know for any of a list of UPCs,
+        in one query; None if we know none of them."""
+        upcs = [str(upc).lstrip('0') for upc in upcs]
+        known = dict(self.db.query_in("SELECT upc, url FROM albums \
+                                      WHERE service='spotify' AND upc IN ({marks})",
+                                      upcs))
+        for upc in upcs:
+            if upc in known:
+                return known[upc]
+        return None
+
+    def find_sp_album_for_upc(self, upc) -> str | None:
+        """Get the Spotify album URL for a UPC, or None if Spotify doesn't have it."""
+        cached = self.cached_sp_album_for_upcs([upc])
+        if cached is not None:
+            return cached
+
+        response = self.search(q=f'upc:{upc}', type='album', limit=1)
+        for found in response.get('albums').get('items'):
+            url = f"https://open.spotify.com/album/{found['id']}"
+            self.db.write(recordings.link_album, 'spotify', found['id'],
+                          str(upc).lstrip('0'), found['name'],
+                          found['artists'][0]['name'], url)
+            return url
+        return None
+
+    def find_sp_albums_from_upcs(self, upcs: Iterable[str]):
         """A generator. Get the spotify albums that correspond to a list of UPCs.
         If you only want the first UPC, simply do next(generator), and .close() it.
 
@@ -212,22 +745,53 @@ class SpotifyConverter(spotipy.Spotify):
             from different digital releases, corresponding Spotify albums.'
 
         Args:
-            upcs (list[int]): list of UPCs
+            upcs (list[str]): list of UPCs
 
         Yields:
             string: spotify album ID corresponding to a UPC from the list.
         """
         for upc in upcs:
-            response = self.search(q=f'upc:{upc}', type='album', limit=1)
-            for album in response.get('albums').get('items'):
-                yield f'https://open.spotify.com/album/{album['id']}'
+            url = self.find_sp_album_for_upc(upc)
+            if url is not None:
+                yield url
+
+    def _internal_call(self, method, url, *args, **kwargs):
+        """Every spotipy request goes through here; wait our turn, and back off
+        everybody if Spotify tells us to slow down."""
+        self.limiter.acquire("spotify")
+        try:
+            with metrics.shared().timer(
+                "upstream_seconds", service="spotify", call=metrics.endpoint(url)
+            ):
+                return super()._internal_call(method, url, *args, **kwargs)
+        except spotipy.SpotifyException as e:
+            metrics.shared().inc(
+                "upstream_errors_total", service="spotify", status=e.http_status
+            )
+            if e.http_status == 429:
+                self.limiter.back_off("spotify", scheduler.retry_after(e.headers))
+            raise
 
-    @staticmethod
-    @ratelimit.sleep_and_retry
-    @ratelimit.limits(calls=1, period=1)
-    def __query_musicbrainz(query: str, timeout: int = 3):
+    @classmethod
+    def __query_musicbrainz(cls, query: str, timeout: int = 3):
         root = 'https://musicbrainz.org/ws/2/'
-        response = requests.get(root+query, timeout=timeout)
-        return response
+        # the session won't retry a status; we do, so each try waits its turn
+        tries_left = cls.MUSICBRAINZ_TRIES
+        while True:
+            tries_left -= 1
+            cls.limiter.acquire("musicbrainz")
+            with metrics.shared().timer("upstream_seconds", service="musicbrainz",
+                                        call=query.split("/")[0].split("?")[0]):
+                response = sessions.get("musicbrainz").get(root+query,
+                                                           timeout=timeout)
+            if not response.ok:
+                metrics.shared().inc("upstream_errors_total", service="musicbrainz",
+                                     status=response.status_code)
+            # musicbrainz answers 503 when we're over its rate limit
+            if response.status_code in (429, 503):
+                cls.limiter.back_off("musicbrainz",
+                                     scheduler.retry_after(response.headers))
+            if tries_left <= 0 or response.status_code not in (429, 500, 502, 503, 504):
+                return response
 
 # cur.execute("CREATE TABLE spotify(uid, isrc, title, first_artist)")
@@ -0,0 +1,232 @@
+"""Shared access to the song cache.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import atexit
+import functools
+import queue
+import re
+import sqlite3
+import threading
+import time
+import metrics
+import schema
+
+DB_PATH = "../db/songs.db"  # this is relative to the convert pkg
+_TABLE = re.compile(r"\bFROM\s+(\w+)", re.I)
+
+
+class Storage:
+    """The song cache, shared by every converter.
+
+    Reads go through a connection per thread, so conversions running on different
+    threads never share a cursor. Writes are queued and applied by a single writer
+    thread, which groups them into one transaction per batch instead of fsyncing
+    per row. The db runs in WAL mode, so readers never wait on that writer.
+    Several processes can open the same db; their writers take turns on its lock.
+
+    Note: writes are behind by up to flush_interval seconds; call flush() if a read
+    must see them, or after_commit() to act once they've landed."""
+
+    def __init__(
+        self, path: str = DB_PATH, batch_size: int = 64, flush_interval: float = 0.5
+    ):
+        """Open the cache and start the writer.
+
+        Args:
+            path (str, optional): Path to songs.db. Defaults to DB_PATH.
+            batch_size (int, optional): Most writes per transaction. Defaults to 64.
+            flush_interval (float, optional): Longest a write waits to be committed,
+                in seconds. Defaults to 0.5.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.local = threading.local()
+        self.pending = queue.Queue()
+
+        # bring the schema up to date before anybody reads
+        con = self.__connect()
+        schema.migrate(con)
+        con.close()
+
+        self.writer = threading.Thread(
+            target=self.__write_loop, name="songs.db writer", daemon=True
+        )
+        self.writer.start()
+        atexit.register(self.flush)
+
+    def connection(self) -> sqlite3.Connection:
+        """Get this thread's connection, opening it on first use."""
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = self.local.con = self.__connect()
+        return con
+
+    def cursor(self) -> sqlite3.Cursor:
+        """Get a fresh cursor on this thread's connection."""
+        return self.connection().cursor()
+
+    def query(self, sql: str, params=()) -> list:
+        """Run a read and return every row."""
+        table = table_of(sql)
+        with metrics.shared().timer("db_query_seconds", table=table):
+            rows = self.connection().execute(sql, params).fetchall()
+        metrics.shared().inc(
+            "db_lookups_total", table=table, result="hit" if rows else "miss"
+        )
+        return rows
+
+    def query_one(self, sql: str, params=()):
+        """Run a read and return the first row, or None."""
+        table = table_of(sql)
+        with metrics.shared().timer("db_query_seconds", table=table):
+            row = self.connection().execute(sql, params).fetchone()
+        metrics.shared().inc(
+            "db_lookups_total", table=table, result="miss" if row is None else "hit"
+        )
+        return row
+
+    def query_in(self, sql: str, values, chunk_size: int = 500) -> list:
+        """Run a read with an `IN ({marks})` clause over many values, and return every
+        row. Values are sent in chunks to stay under SQLite's bound-variable limit.
+
+        Args:
+            sql (str): Query with a {marks} placeholder where the ?s should go.
+            values (Iterable): Values to match.
+            chunk_size (int, optional): Most values per query. Defaults to 500.
+
+        Returns:
+            list: Every matching row.
+        """
+        values = list(values)
+        rows = []
+        for start in range(0, len(values), chunk_size):
+            chunk = values[start : start + chunk_size]
+            marks = ", ".join("?" * len(chunk))
+            rows.extend(self.query(sql.format(marks=marks), chunk))
+        return rows
+
+    def execute(self, sql: str, params=()):
+        """Queue a single write statement."""
+        self.write(lambda cur: cur.execute(sql, params))
+
+    def write(self, func, *args):
+        """Queue a write. func is called as func(cursor, *args) on the writer thread,
+        inside a transaction, so it can run several statements that land together."""
+        self.pending.put((func, args, False))
+
+    def after_commit(self, func, *args):
+        """Queue func(*args) to be called on the writer thread once every write
+        queued before it has been committed, e.g. to drop in-memory copies of the
+        rows they change. Dropped any sooner, a read in between could copy the old
+        row straight back."""
+        self.pending.put((func, args, True))
+
+    def flush(self, timeout: float | None = None):
+        """Block until every queued write has been committed.
+
+        Args:
+            timeout (float | None, optional): Give up after this many seconds.
+                Defaults to None (wait forever).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.pending.all_tasks_done:
+            while self.pending.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return
+                self.pending.all_tasks_done.wait(remaining)
+
+    def __connect(self) -> sqlite3.Connection:
+        # autocommit; the writer opens its own transactions, and reads shouldn't
+        # hold one open between queries
+        con = sqlite3.connect(self.path, isolation_level=None, timeout=10)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")  # WAL is still crash-safe at NORMAL
+        return con
+
+    def __write_loop(self):
+        con = self.__connect()
+        cur = con.cursor()
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            writes = [(func, args) for func, args, after in batch if not after]
+            if writes:
+                with metrics.shared().timer("db_write_batch_seconds"):
+                    self.__commit(con, cur, writes)
+                metrics.shared().inc("db_writes_total", len(writes))
+            for func, args, after in batch:
+                if after:
+                    try:
+                        func(*args)
+                    except Exception as e:  # pylint: disable=broad-except
+                        print(f"Error after a write to songs.db: {e}")
+            for _ in batch:
+                self.pending.task_done()
+
+    @staticmethod
+    def __commit(con: sqlite3.Connection, cur: sqlite3.Cursor, batch: list):
+        """Apply a batch in one transaction; if any of it fails, replay it one write
+        at a time so a single bad row doesn't lose the rest."""
+        try:
+            # take the write lock before any of the batch reads, so a writer in
+            # another process can't turn this into a deadlock halfway through
+            cur.execute("BEGIN IMMEDIATE")
+            for func, args in batch:
+                func(cur, *args)
+            cur.execute("COMMIT")
+            return
+        except Exception as e:  # pylint: disable=broad-except
+            # the writer thread must outlive any one bad write
+            con.rollback()
+            if len(batch) == 1:
+                print(f"Dropped a write to songs.db: {e}")
+                return
+
+        for item in batch:
+            Storage.__commit(con, cur, [item])
+
+
+@functools.lru_cache(maxsize=256)
+def table_of(sql: str) -> str:
+    """Name the table a read is against, for labelling its metrics. Our SQL is all
+    string constants, so this only runs the regex once per statement."""
+    found = _TABLE.search(sql)
+    return found.group(1) if found else "other"
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared() -> Storage:
+    """Get the process-wide Storage, opening it on first use."""
+    global _shared  # pylint: disable=global-statement
+    with _shared_lock:
+        if _shared is None:
+            _shared = Storage()
+        return _shared
@@ -0,0 +1,113 @@
+"""Race the ways of finding a song against each other, within a deadline.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os import environ
+import threading
+import time
+import scheduler
+import song
+
+# seconds a lookup can run before the next one is started alongside it
+HEDGE_AFTER = float(environ.get("HEDGE_AFTER", 1.5))
+# seconds a whole song_to_url gets, unless the caller gives a deadline
+LOOKUP_BUDGET = float(environ.get("LOOKUP_BUDGET", 10))
+
+# strategies run here, not on the caller's pool, so a hedge never waits on itself.
+# one pool per priority, so background lookups queued in the rate limiter can't
+# hold every thread while an interactive one waits for a turn to start
+POOL_SIZE = 16  # most strategies running at once, per priority
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _pool() -> ThreadPoolExecutor:
+    """Get the pool for the current scheduler priority, creating it on first use."""
+    level = scheduler.current_priority.get()
+    with _pools_lock:
+        if level not in _pools:
+            _pools[level] = ThreadPoolExecutor(
+                max_workers=POOL_SIZE, thread_name_prefix=f"hedge-{level}"
+            )
+        return _pools[level]
+
+
+def deadline_in(seconds: float = LOOKUP_BUDGET) -> float:
+    """A deadline some seconds from now, on the time.monotonic() clock."""
+    return time.monotonic() + seconds
+
+
+def first(strategies: list, deadline: float = None, hedge_after: float = HEDGE_AFTER):
+    """Run lookups, best first, and return the first one to find something.
+
+    Each strategy is called with a threading.Event, and returns its result or None
+    if it found nothing. The next strategy starts as soon as the ones running have
+    all come up empty, or once hedge_after seconds pass without an answer. When one
+    wins, the event is set so the others can stop at their next step, and any that
+    haven't started never will.
+
+    Args:
+        strategies (list): Callables taking the cancel event, best first.
+        deadline (float, optional): time.monotonic() to give up at. Defaults to none.
+        hedge_after (float, optional): Seconds to wait before hedging. Defaults to
+            HEDGE_AFTER.
+
+    Raises:
+        song.LookupTimeoutError: The deadline passed with no answer.
+
+    Returns:
+        The first result that isn't None, or None if every strategy came up empty.
+        If a strategy raised and none found anything, that error is raised instead.
+    """
+    cancel = threading.Event()
+    remaining = list(strategies)
+    running = set()
+    error = None
+    pool = _pool()
+
+    def start_next():
+        running.add(pool.submit(scheduler.carry(remaining.pop(0)), cancel))
+
+    try:
+        start_next()
+        while running or remaining:
+            if not running:
+                start_next()
+            timeout = hedge_after if remaining else None
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise song.LookupTimeoutError("Ran out of time to find this song.")
+                timeout = left if timeout is None else min(timeout, left)
+
+            done, running = wait(running, timeout, FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = error or future.exception()
+                elif future.result() is not None:
+                    return future.result()
+            # either everything so far came up empty, or it's taking too long
+            if remaining:
+                start_next()
+    finally:
+        cancel.set()
+        for future in running:
+            future.cancel()
+
+    if error is not None:
+        raise error
+    return None
@@ -0,0 +1,84 @@
+"""Search the titles and artists we've already cached, before asking an API.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import match
+import song
+import storage
+
+# VIRTUAL TABLE titles(service, platform_id, isrc, url, title, artist), fts5
+# Every row of spotify, ytmusic and applemusic, copied in by triggers (see schema).
+CANDIDATES = 10  # most index hits we score per lookup
+
+
+def phrase(tokens) -> str:
+    """Quote tokens so the FTS5 query syntax can't see operators in them."""
+    return " ".join('"' + token.replace('"', '""') + '"' for token in sorted(tokens))
+
+
+def find(
+    db: storage.Storage, a_song: song.Song, service: str
+) -> tuple[str, str] | None:
+    """Find a song on a service from the cache alone, by title and artist.
+
+    A cached row on the service itself is used if one is close enough. Failing
+    that, a close row on any other service with an ISRC is followed through the
+    recordings table to the service we want.
+
+    Args:
+        db (storage.Storage): The song cache.
+        a_song (song.Song): Song to look for.
+        service (str): Service we want it on.
+
+    Returns:
+        tuple[str, str] | None: (platform ID, URL) on service, or None if the cache
+            doesn't know it.
+    """
+    title, _, artist = a_song.match_key
+    # fold spells "&" as "and", but the index holds the raw text, where unicode61
+    # drops "&"; the scoring below still weighs "and" against every candidate
+    title, artist = title - {"and"}, artist - {"and"}
+    if not title or not artist:
+        return None
+    rows = db.query(
+        "SELECT service, platform_id, isrc, url, title, artist FROM titles \
+        WHERE titles MATCH ? ORDER BY rank LIMIT ?",
+        [f"title : ({phrase(title)}) AND artist : ({phrase(artist)})", CANDIDATES],
+    )
+    candidates = [
+        (row, song.Song(row[0], row[1], row[2], row[4], row[5]))
+        for row in rows
+        if row[4] is not None and row[5] is not None
+    ]
+
+    # a song that's already on the service we want
+    found = match.best(
+        a_song, [candidate for row, candidate in candidates if row[0] == service]
+    )
+    if found is not None:
+        return found.uid, next(row[3] for row, _ in candidates if row[1] == found.uid)
+
+    # the same recording on another service, linked to the one we want by isrc
+    found = match.best(
+        a_song, [candidate for _, candidate in candidates if candidate.isrc is not None]
+    )
+    if found is not None:
+        return db.query_one(
+            "SELECT platform_id, url FROM recordings WHERE isrc=? AND service=? \
+            limit 1",
+            [found.isrc, service],
+        )
+    return None
@@ -0,0 +1,112 @@
+"""Convert what's charting ahead of time, so the first /song for it is a cache hit.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import asyncio
+from datetime import datetime
+from os import environ
+import engine
+import scheduler
+
+# seconds between warm-ups; 0 turns the warmer off
+WARM_INTERVAL = float(environ.get("WARM_INTERVAL", 6 * 60 * 60))
+# local hours the warmer may start in, as "start-end"; empty for any time
+WARM_HOURS = environ.get("WARM_HOURS", "2-6")
+CHECK_INTERVAL = 10 * 60  # how often to look at the clock outside those hours
+
+
+def in_hours(hours: str, now: datetime = None) -> bool:
+    """Check if it's within a "start-end" range of hours (inclusive, may wrap
+    past midnight, e.g. "22-4"). An empty range is always true."""
+    if not hours:
+        return True
+    start, end = (int(hour) for hour in hours.split("-"))
+    hour = (now or datetime.now()).hour
+    if start <= end:
+        return start <= hour <= end
+    return hour >= start or hour <= end
+
+
+class CacheWarmer:
+    """Pulls each service's charts and converts every song to the other services.
+
+    Everything runs at BACKGROUND priority, so it only uses rate budget that
+    interactive conversions leave free."""
+
+    def __init__(
+        self,
+        conversions: engine.ConversionEngine,
+        interval: float = WARM_INTERVAL,
+        hours: str = WARM_HOURS,
+    ):
+        """Create a warmer.
+
+        Args:
+            conversions (engine.ConversionEngine): Engine to convert through.
+            interval (float, optional): Seconds between warm-ups. Defaults to
+                WARM_INTERVAL.
+            hours (str, optional): Hours warm-ups may start in. Defaults to WARM_HOURS.
+        """
+        self.conversions = conversions
+        self.interval = interval
+        self.hours = hours
+        self.task = None
+
+    async def warm(self) -> int:
+        """Convert every charting song on every service, once.
+
+        Returns:
+            int: How many charting songs were converted.
+        """
+        services = list(self.conversions.converters)
+        warmed = 0
+        with scheduler.priority(scheduler.BACKGROUND):
+            for service in services:
+                try:
+                    songs = await self.conversions.trending_songs(service)
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    # one service's charts being down shouldn't stop the rest
+                    print(f"Couldn't read the {service} charts: {e}")
+                    continue
+                for target in services:
+                    if target == service:
+                        continue
+                    try:
+                        await self.conversions.to_urls(target, songs)
+                    except Exception as e:  # pylint: disable=broad-exception-caught
+                        # nor should one target failing stop the others
+                        print(f"Couldn't warm {service} songs on {target}: {e}")
+                warmed += len(songs)
+                print(f"Warmed {len(songs)} charting songs from {service}")
+        return warmed
+
+    async def run(self):
+        """Warm the cache every interval, waiting for the warm hours to start."""
+        while True:
+            while not in_hours(self.hours):
+                await asyncio.sleep(CHECK_INTERVAL)
+            try:
+                await self.warm()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                print(f"Error warming the cache: {e} of class {e.__class__}")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> asyncio.Task | None:
+        """Start warming in the background on the running event loop, unless the
+        interval is 0."""
+        if self.interval > 0 and self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return self.task
@@ -0,0 +1,222 @@
+"""Run the converters in a pool of worker processes, for more than one core.
+
+Copyright (C) 2024  Jacob Humble
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+from concurrent.futures import ProcessPoolExecutor
+import functools
+from multiprocessing import get_context
+from multiprocessing.managers import BaseManager
+import threading
+import cache
+import metrics
+import registry
+import scheduler
+import services
+import song
+
+
+class WorkerError(Exception):
+    """Exception for an error raised in a worker, passed back as its message.
+
+    The API clients' own exceptions don't all survive being pickled, and one that
+    fails to unpickle would break the whole pool."""
+
+
+class LimiterManager(BaseManager):
+    """Serves one Scheduler from its own process, so every worker shares one rate
+    budget (and one queue by priority) per upstream API."""
+
+
+_limiter = None
+
+
+def _shared_limiter() -> scheduler.Scheduler:
+    # runs in the manager's process, so every worker gets the same one
+    global _limiter  # pylint: disable=global-statement
+    if _limiter is None:
+        _limiter = scheduler.Scheduler()
+    return _limiter
+
+
+LimiterManager.register(
+    "limiter", callable=_shared_limiter, exposed=("acquire", "back_off")
+)
+
+
+class RemoteLimiter:
+    """Stands in for scheduler.shared() in a worker, asking the manager's Scheduler
+    instead. The caller's priority is read here, since the manager can't see it."""
+
+    def __init__(self, remote):
+        self.remote = remote
+
+    def acquire(self, service: str, level: int = None):
+        """Block until a request to service is allowed. See Scheduler.acquire."""
+        if level is None:
+            level = scheduler.current_priority.get()
+        self.remote.acquire(service, level)
+
+    def back_off(self, service: str, seconds: float):
+        """Stop every worker's requests to a service for a while."""
+        self.remote.back_off(service, seconds)
+
+
+# this worker process's converters, built by _start_worker
+_converters = None
+
+
+def _start_worker(address, names: str):
+    global _converters  # pylint: disable=global-statement
+    manager = LimiterManager(address=address)
+    manager.connect()
+    # the converters bind scheduler.shared() when they're imported, which is on
+    # first use, after this
+    scheduler._shared = RemoteLimiter(manager.limiter())  # pylint: disable=W0212
+    # no in-memory cache: a write in one worker couldn't drop another's stale copy,
+    # so every worker reads songs.db, which they all see the same
+    cache._shared = cache.TTLCache(maxsize=0)  # pylint: disable=W0212
+    _converters = services.enabled(names)
+
+
+def _call(service: str, method: str, level: int, args: tuple, kwargs: dict):
+    """Run a converter method, and return (result, error, metrics) so the parent
+    gets the metrics it recorded whether it raised or not."""
+    result = error = None
+    with scheduler.priority(level):
+        try:
+            result = getattr(_converters[service], method)(*args, **kwargs)
+        except song.NoMatchFoundError as e:
+            error = e  # ours, so it pickles
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            error = WorkerError(f"{e.__class__.__name__}: {e}")
+    # includes whatever this worker's background threads recorded since last time
+    return result, error, metrics.shared().drain()
+
+
+class WorkerPool:
+    """A pool of processes, each with its own converters and API clients.
+
+    They share songs.db (each has its own connections and writer, and SQLite's
+    locks take turns between them) and one rate budget, through a LimiterManager.
+    songs.db is also what they learn from each other through: workers keep no
+    in-memory cache, since nothing would tell one that another changed a row.
+    Metrics recorded in a worker come back with each call's result and are added
+    to this process's, so they're served from here as usual.
+
+    Nothing starts until the first call, so importing a module that makes one (as
+    every worker process does, under spawn) doesn't start another pool."""
+
+    def __init__(self, names: str, processes: int):
+        """Create a pool.
+
+        Args:
+            names (str): Comma-separated services the workers should serve.
+            processes (int): How many worker processes to run.
+        """
+        self.names = names
+        self.processes = processes
+        self.manager = None
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def call(self, service: str, method: str, *args, **kwargs):
+        """Call a converter method in a worker, and block until it returns.
+
+        Runs at the caller's scheduler.priority().
+
+        Raises:
+            song.NoMatchFoundError: As the method raised it.
+            WorkerError: The method raised anything else.
+        """
+        future = self.__started().submit(
+            _call, service, method, scheduler.current_priority.get(), args, kwargs
+        )
+        result, error, recorded = future.result()
+        metrics.shared().merge(recorded)
+        if error is not None:
+            raise error
+        return result
+
+    def shutdown(self):
+        """Stop the workers and the shared limiter."""
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.manager.shutdown()
+                self.executor = self.manager = None
+
+    def __started(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                # spawn, not fork: the parent has threads (the event loop's, the
+                # db writer's) that a forked child would inherit mid-flight
+                context = get_context("spawn")
+                self.manager = LimiterManager(ctx=context)
+                self.manager.start()
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=context,
+                    initializer=_start_worker,
+                    initargs=(self.manager.address, self.names),
+                )
+                print(f"Started {self.processes} conversion worker processes")
+            return self.executor
+
+
+class RemoteConverter:
+    """Stands in for a converter that lives in the worker processes.
+
+    Every method call is sent to a worker, except URL parsing, which the engine
+    does on the event loop and needs no API client, so it's done here."""
+
+    def __init__(self, pool: WorkerPool, service: str):
+        self.pool = pool
+        self.service = service
+        self.cls = services.converter_class(service)
+
+    def parse_url(self, url: str) -> str:
+        """Strip a song URL down to the service's ID for it."""
+        return self.cls.parse_url(url)
+
+    def parse_album_url(self, url: str) -> str:
+        """Strip an album URL down to the service's ID for it."""
+        return self.cls.parse_album_url(url)
+
+    def __getattr__(self, name: str):
+        return functools.partial(self.pool.call, self.service, name)
+
+
+def remote(converters: registry.Registry, processes: int) -> registry.Registry:
+    """Move a registry's converters into worker processes.
+
+    Args:
+        converters (registry.Registry): Services to serve, as services.enabled()
+            registers them.
+        processes (int): How many worker processes to run.
+
+    Returns:
+        registry.Registry: The same services, backed by RemoteConverters.
+    """
+    pool = WorkerPool(",".join(converters), processes)
+    moved = registry.Registry()
+    for name in converters:
+        moved.register(
+            name,
+            converters.labels[name],
+            functools.partial(RemoteConverter, pool, name),
+            converters.patterns[name].pattern,
+        )
+    return moved
@@ -15,10 +15,23 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>."""
 
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import time
 from ytmusicapi import YTMusic
 import musicfetch
+import album
+import cache
+import freshness
+import match
+import metrics
+import misses
+import recordings
+import scheduler
 import song
+import storage
+import strategy
+import titles
 
 
 class YTMusicConverter(YTMusic):
@@ -35,8 +48,11 @@ class YTMusicConverter(YTMusic):
     Nonetheless, people do want to convert from YTMusic, so..."""
 
     # TABLE ytmusic(uid, isrc, title, first_artist)
-    con = sqlite3.connect("../db/songs.db")  # this is relative to the convert pkg
-    cur = con.cursor()
+    db = storage.shared()
+    memo = cache.shared()
+    limiter = scheduler.shared()
+    revalidator = freshness.shared()
+    BATCH_WORKERS = 8  # lookups run side by side in a batch
 
     def __init__(self):
         super().__init__()
@@ -53,146 +69,607 @@ class YTMusicConverter(YTMusic):
         Returns:
             song.Song: Song obj from the URL
         """
-        # check the db first
-        uri = self.__strip_url(url)
-        self.cur.execute("SELECT * FROM ytmusic WHERE uid=?", [uri])
-        track = self.cur.fetchone()
+        # check memory, then the db
+        uri = self.parse_url(url)
+        result_song = self.memo.get(("song", "ytmusic", uri))
+        if result_song is not None:
+            return result_song
+
+        track = self.db.query_one("SELECT * FROM ytmusic WHERE uid=?", [uri])
         if track is not None:
-            return song.Song(
-                source="spotify",
-                uid=track[0],
-                isrc=track[1],
-                title=track[2],
-                first_artist=track[3],
-            )
+            self.__check_fresh(track[0], track[1], track[4])
+            result_song = self.__row_to_song(track)
+            self.memo.put(("song", "ytmusic", uri), result_song)
+            return result_song
 
         # if db came up empty, query for data on the uri:
         tracks = self.search(uri, limit=1)
-        isrc = musicfetch.fetch_isrc(url)  # note: this can miss; if so, returns None
+        isrc = self.__fetch_isrc(url)  # note: this can miss; if so, returns None
         for track in tracks:
             if track is not None:
                 self.__commit_song(
                     track["videoId"], isrc, track["title"], track["artists"][0]["name"]
                 )
 
-                return song.Song(
+                result_song = song.Song(
                     source="ytmusic",
                     uid=track["videoId"],
                     isrc=isrc,
                     title=track["title"],
                     first_artist=track["artists"][0]["name"],
-                    attributes=track,
+                    attributes=functools.partial(self.get_song, track["videoId"]),
                 )
+                self.memo.put(("song", "ytmusic", uri), result_song)
+                return result_song
 
         raise song.NoMatchFoundError("No match found for this URL.")
 
-    def song_to_url(self, a_song: song.Song, best_match: bool = False) -> str:
+    def song_to_url(
+        self,
+        a_song: song.Song,
+        best_match: bool = False,
+        refresh: bool = False,
+        deadline: float = None,
+    ) -> str:
         """Match a song obj to a YouTube Music URL.
 
         Args:
             a_song (song.Song): Song obj to match against
             best_match (bool, optional): If true, return the best match. Defaults to False.
+            refresh (bool, optional): Search again even if this song recently came up
+                empty. Defaults to False.
+            deadline (float, optional): time.monotonic() to give up at. Defaults to
+                strategy.LOOKUP_BUDGET from now.
 
         Raises:
             song.NoMatchFoundError: No match found for this song.
+            song.LookupTimeoutError: Ran out of time before finding a match.
 
         Returns:
             str: url to the song we matched with
         """
-        # first, check the database for the isrc if we have an isrc
+        # first, check memory and then the database for the isrc if we have an isrc
         if a_song.isrc is not None:
-            self.cur.execute(
-                "SELECT uid FROM ytmusic WHERE isrc=? limit 1", [a_song.isrc]
+            url = self.memo.get(("url", a_song.isrc, "ytmusic"))
+            if url is not None:
+                return url
+
+            track = self.db.query_one(
+                "SELECT uid, fetched_at FROM ytmusic WHERE isrc=? limit 1",
+                [a_song.isrc],
             )
-            track = self.cur.fetchone()
             if track is not None:
+                self.__check_fresh(track[0], a_song.isrc, track[1])
                 url = f"https://music.youtube.com/watch?v={track[0]}"
+                self.memo.put(("url", a_song.isrc, "ytmusic"), url)
                 return url
 
-            # if nothing was returned from the DB, search YTMusic by isrc
-            tracks = self.search(f"{a_song.isrc}", filter="songs", limit=1)
-            for track in tracks:
-                if track is not None:
-                    # now, false friends exist, so we need to confirm the isrcs match
-                    found_isrc = musicfetch.fetch_isrc(
-                        f"https://music.youtube.com/watch?v={track['videoId']}"
-                    )
-                    if found_isrc is not None:
-                        if found_isrc.lower() == a_song.isrc.lower():
-                            self.__commit_song(
-                                track["videoId"],
-                                a_song.isrc,
-                                track["title"],
-                                track["artists"][0]["name"],
-                            )
-                            return (
-                                f"https://music.youtube.com/watch?v={track['videoId']}"
-                            )
-
-        # if we don't have an isrc, search by title and artist
-        tracks = self.search(
-            f"{a_song.title} {a_song.first_artist}", filter="songs", limit=5
-        )
+        # fail fast if we recently came up empty on this one; only now, so a cache
+        # hit never pays for the check. a best match might still turn something up,
+        # so that always searches
+        if not (refresh or best_match) and misses.is_known_miss(
+            self.db, a_song, "ytmusic"
+        ):
+            raise song.NoMatchFoundError("No match found for this song.")
+
+        # then go to YTMusic. the isrc search is exact but slow (every hit has to be
+        # checked with musicfetch), so if it drags on, the title search starts too
+        candidates = []
+        strategies = [functools.partial(self.__search_by_title, a_song, candidates)]
+        if a_song.isrc is not None:
+            strategies.insert(0, functools.partial(self.__search_by_isrc, a_song))
+        try:
+            url = strategy.first(strategies, deadline or strategy.deadline_in())
+        except song.LookupTimeoutError:
+            # out of time, but a best match can make do with what the title search
+            # has found so far
+            if best_match and len(candidates) > 0:
+                return f"https://music.youtube.com/watch?v={candidates[0]['videoId']}"
+            raise
+        if url is not None:
+            return url
+        if best_match and len(candidates) > 0:
+            return f"https://music.youtube.com/watch?v={candidates[0]['videoId']}"
+
+        # we never found a match, so remember that and
+        misses.record(self.db, a_song, "ytmusic")
+        raise song.NoMatchFoundError("No match found for this song.")
+
+    def __search_by_isrc(self, a_song: song.Song, cancel) -> str | None:
+        """Search YTMusic for a song by ISRC, and confirm the hit with musicfetch."""
+        tracks = self.search(f"{a_song.isrc}", filter="songs", limit=1)
         for track in tracks:
-            if track is not None:
-                uid = track["videoId"]
-                isrc = None
-                title = track["title"]
-                first_artist = track["artists"][0]["name"]
-                # check if they're similar, stripping out some stuff like (OFFICIAL VIDEO)
-                found_song = song.Song(
+            # now, false friends exist, so we need to confirm the isrcs match
+            if track is None or cancel.is_set():
+                continue
+            url = f"https://music.youtube.com/watch?v={track['videoId']}"
+            found_isrc = self.__fetch_isrc(url)
+            if found_isrc is not None and found_isrc.lower() == a_song.isrc:
+                self.__commit_song(
+                    track["videoId"],
+                    a_song.isrc,
+                    track["title"],
+                    track["artists"][0]["name"],
+                )
+                self.memo.put(("url", a_song.isrc, "ytmusic"), url)
+                return url
+        return None
+
+    def __search_by_title(
+        self, a_song: song.Song, candidates: list, cancel
+    ) -> str | None:
+        """Find a song by title and artist, in the cache and then on YTMusic. Every
+        search result is added to candidates, for a best match."""
+        # a title we've cached on any service may already answer it
+        found = titles.find(self.db, a_song, "ytmusic")
+        if found is not None:
+            return found[1]
+        if cancel.is_set():
+            return None
+
+        tracks = [
+            track
+            for track in self.search(
+                f"{a_song.title} {a_song.first_artist}", filter="songs", limit=5
+            )
+            if track is not None
+        ]
+        candidates.extend(tracks)
+        # rank every result, since the closest one often isn't the first
+        found_song = match.best(
+            a_song,
+            [
+                song.Song(
                     source="ytmusic",
-                    uid=uid,
-                    isrc=isrc,
-                    title=title,
-                    first_artist=first_artist,
+                    uid=track["videoId"],
+                    isrc=None,
+                    title=track["title"],
+                    first_artist=track["artists"][0]["name"],
                 )
-                if a_song.is_similar(found_song):
-                    isrc = musicfetch.fetch_isrc(
-                        f"https://music.youtube.com/watch?v={uid}"
+                for track in tracks
+                if track.get("artists")
+            ],
+        )
+        if found_song is None:
+            return None
+        uid = found_song.uid
+        # don't make the caller wait on musicfetch for the isrc; it's filled in later
+        self.__commit_song(uid, None, found_song.title, found_song.first_artist)
+        # once the row's in; a re-check that ran sooner would find nothing to check
+        self.db.after_commit(self.revalidate_later, uid)
+        return f"https://music.youtube.com/watch?v={uid}"
+
+    def urls_to_songs(self, urls: list[str]) -> list[song.Song | None]:
+        """Turn many YouTube Music URLs into Song objects at once.
+
+        Cached songs come from memory or a single db query. YTMusic has no batch
+        lookup, so the rest go through url_to_song side by side.
+
+        Args:
+            urls (list[str]): YTMusic URLs
+
+        Returns:
+            list[song.Song | None]: A Song obj per URL, in order; None for no match.
+        """
+        uids = [self.parse_url(url) for url in urls]
+        found = {}
+        for uid in uids:
+            cached = self.memo.get(("song", "ytmusic", uid))
+            if cached is not None:
+                found[uid] = cached
+
+        missing = list(dict.fromkeys(uid for uid in uids if uid not in found))
+        for track in self.db.query_in(
+            "SELECT * FROM ytmusic WHERE uid IN ({marks})", missing
+        ):
+            self.__check_fresh(track[0], track[1], track[4])
+            found[track[0]] = self.__row_to_song(track)
+            self.memo.put(("song", "ytmusic", track[0]), found[track[0]])
+
+        missing = [uid for uid in missing if uid not in found]
+        with ThreadPoolExecutor(self.BATCH_WORKERS) as pool:
+            results = pool.map(
+                scheduler.carry(self.__try_url_to_song),
+                [f"https://music.youtube.com/watch?v={uid}" for uid in missing],
+            )
+            for uid, result_song in zip(missing, results):
+                found[uid] = result_song
+
+        return [found.get(uid) for uid in uids]
+
+    def songs_to_urls(
+        self,
+        songs: list[song.Song | None],
+        best_match: bool = False,
+        refresh: bool = False,
+    ) -> list[str | None]:
+        """Match many song objs to YouTube Music URLs at once.
+
+        Cached ISRCs come from memory or a single db query; the rest go through
+        song_to_url side by side.
+
+        Args:
+            songs (list[song.Song | None]): Song objs to match; None is skipped.
+            best_match (bool, optional): If true, return the best match. Defaults to False.
+            refresh (bool, optional): Search again even if a song recently came up
+                empty. Defaults to False.
+
+        Returns:
+            list[str | None]: URL per song, in order; None for no match.
+        """
+        results = [None] * len(songs)
+        pending = []
+        for i, a_song in enumerate(songs):
+            if a_song is None:
+                continue
+            if a_song.isrc is not None:
+                results[i] = self.memo.get(("url", a_song.isrc, "ytmusic"))
+            if results[i] is None:
+                pending.append(i)
+
+        isrcs = {songs[i].isrc for i in pending if songs[i].isrc is not None}
+        uids = {}
+        for isrc, uid, fetched_at in self.db.query_in(
+            "SELECT isrc, uid, fetched_at FROM ytmusic WHERE isrc IN ({marks})", isrcs
+        ):
+            self.__check_fresh(uid, isrc, fetched_at)
+            uids[isrc] = uid
+        rest = []
+        for i in pending:
+            uid = uids.get(songs[i].isrc)
+            if uid is None:
+                rest.append(i)
+                continue
+            results[i] = f"https://music.youtube.com/watch?v={uid}"
+            self.memo.put(("url", songs[i].isrc, "ytmusic"), results[i])
+
+        with ThreadPoolExecutor(self.BATCH_WORKERS) as pool:
+            found = pool.map(
+                scheduler.carry(
+                    lambda a_song: self.__try_song_to_url(a_song, best_match, refresh)
+                ),
+                [songs[i] for i in rest],
+            )
+            for i, result in zip(rest, found):
+                results[i] = result
+        return results
+
+    def playlist_to_songs(self, url: str) -> list[song.Song]:
+        """Turn every song on a YouTube Music playlist into a Song object.
+
+        Playlist entries carry no ISRC, so this goes through urls_to_songs.
+
+        Args:
+            url (str): YTMusic playlist URL
+
+        Returns:
+            list[song.Song]: Songs on the playlist we could match, in order.
+        """
+        playlist_id = url.split("list=")[-1].split("&")[0]
+        tracks = self.get_playlist(playlist_id, limit=None)["tracks"]
+        urls = [
+            f"https://music.youtube.com/watch?v={track['videoId']}"
+            for track in tracks
+            if track.get("videoId") is not None
+        ]
+        return [a_song for a_song in self.urls_to_songs(urls) if a_song is not None]
+
+    def trending_songs(self, country: str = "ZZ") -> list[song.Song]:
+        """Turn every song on the YouTube Music charts into a Song object.
+
+        Args:
+            country (str, optional): ISO 3166-1 code of the charts to read. Defaults
+                to "ZZ", the global charts.
+
+        Returns:
+            list[song.Song]: Charting songs we could match, chart by chart.
+        """
+        videos = self.get_charts(country).get("videos") or []
+        # older ytmusicapi gives one chart as {"playlist": id}, newer a list of them
+        if isinstance(videos, dict):
+            playlist_ids = [videos.get("playlist")]
+        else:
+            playlist_ids = [chart.get("playlistId") for chart in videos]
+
+        songs = []
+        for playlist_id in playlist_ids:
+            if playlist_id is not None:
+                songs.extend(
+                    self.playlist_to_songs(
+                        f"https://music.youtube.com/playlist?list={playlist_id}"
                     )
-                    self.__commit_song(uid, isrc, title, first_artist)
-                    return f"https://music.youtube.com/watch?v={uid}"
-        else:  # pylint: disable=w0120
-            if best_match and len(tracks) > 0:
-                return f"https://music.youtube.com/watch?v={tracks[0]['videoId']}"
+                )
+        return songs
 
-        # we never found a match, so
-        raise song.NoMatchFoundError("No match found for this song.")
+    def revalidate(self, uid: str):
+        """Check a cached song is still up, and try again for its ISRC if we never
+        found one; update or drop its row.
+
+        Args:
+            uid (str): YTMusic video ID of the song.
+        """
+        row = self.db.query_one(
+            "SELECT isrc, title, first_artist FROM ytmusic WHERE uid=?", [uid]
+        )
+        if row is None:
+            return
+        status = self.get_song(uid).get("playabilityStatus", {}).get("status")
+        if status == "ERROR":  # removed; other statuses can just be region locks
+            self.__forget_song(uid)
+            return
+        isrc = row[0]
+        if isrc is None:
+            isrc = self.__fetch_isrc(f"https://music.youtube.com/watch?v={uid}")
+        self.__commit_song(uid, isrc, row[1], row[2])
+
+    def revalidate_later(self, uid: str):
+        """Queue a re-check of a cached song on the revalidator's thread, e.g. once
+        it's been served stale from the recordings table."""
+        self.revalidator.submit(("ytmusic", uid), self.revalidate, uid)
+
+    def __check_fresh(self, uid: str, isrc: str | None, fetched_at: float | None):
+        """Queue a re-check of a cached song if it's stale, sooner if it has no ISRC;
+        it's served either way."""
+        max_age = freshness.MAX_AGE if isrc is not None else freshness.ISRC_RETRY_AGE
+        if freshness.is_stale(fetched_at, max_age):
+            self.revalidate_later(uid)
+
+    def __try_url_to_song(self, url: str):
+        """url_to_song, but None instead of raising when there's no match."""
+        try:
+            return self.url_to_song(url)
+        except song.NoMatchFoundError:
+            return None
+
+    def __try_song_to_url(self, a_song: song.Song, best_match: bool, refresh: bool):
+        """song_to_url, but None instead of raising when there's no match."""
+        try:
+            return self.song_to_url(a_song, best_match=best_match, refresh=refresh)
+        except song.NoMatchFoundError:
+            return None
+
+    def album_url_to_album(self, url: str) -> album.Album:
+        """Turn a YouTube Music album URL into an Album object.
+
+        YTMusic doesn't expose UPCs, so the album only has one if we've matched it
+        against another service before.
+
+        Args:
+            url (str): YTMusic album URL, either a /browse/ or an album /playlist? link
+
+        Raises:
+            song.NoMatchFoundError: No match found for this URL
+
+        Returns:
+            album.Album: Album obj from the URL
+        """
+        browse_id = self.parse_album_url(url)
+        if not browse_id.startswith("MPRE"):
+            # album playlists (OLAK5uy_...) have to be swapped for the album's browseId
+            browse_id = self.get_album_browse_id(browse_id)
+            if browse_id is None:
+                raise song.NoMatchFoundError("No match found for this URL.")
+
+        row = self.db.query_one(
+            "SELECT upc, title, artist FROM albums WHERE service='ytmusic' \
+            AND album_id=?",
+            [browse_id],
+        )
+        if row is not None and row[1] is not None:
+            return album.Album("ytmusic", browse_id, row[0], row[1], row[2])
+
+        found = self.get_album(browse_id)
+        result = album.Album(
+            source="ytmusic",
+            uid=browse_id,
+            upc=None,
+            title=found["title"],
+            first_artist=found["artists"][0]["name"],
+        )
+        self.__commit_album(result)
+        return result
+
+    def album_to_url(self, an_album: album.Album, best_match: bool = False) -> str:
+        """Match an album obj to a YouTube Music URL.
+
+        Args:
+            an_album (album.Album): Album obj to match against
+            best_match (bool, optional): If true, return the best match. Defaults to False.
+
+        Raises:
+            song.NoMatchFoundError: No match found for this album.
+
+        Returns:
+            str: url to the album we matched with
+        """
+        # we can't search YTMusic by upc, but we may have matched this upc before
+        if an_album.upc is not None:
+            row = self.db.query_one(
+                "SELECT url FROM albums WHERE service='ytmusic' AND upc=? limit 1",
+                [an_album.upc],
+            )
+            if row is not None:
+                return row[0]
+
+        albums = self.search(
+            f"{an_album.title} {an_album.first_artist}", filter="albums", limit=5
+        )
+        for found in albums:
+            if not found.get("artists"):
+                continue
+            candidate = album.Album(
+                "ytmusic",
+                found["browseId"],
+                an_album.upc,  # only kept if it matches, and then it's the same album
+                found["title"],
+                found["artists"][0]["name"],
+            )
+            if an_album.is_similar(candidate):
+                return self.__commit_album(candidate)
+        if best_match and len(albums) > 0:
+            return f"https://music.youtube.com/browse/{albums[0]['browseId']}"
+
+        raise song.NoMatchFoundError("No match found for this album.")
+
+    def linked_album_urls(self, url: str) -> dict[str, str]:
+        """Get every other service's URL we already know for this album, from the db.
+
+        Args:
+            url (str): YTMusic album URL
+
+        Returns:
+            dict[str, str]: Maps service name to URL; empty if nothing is linked yet.
+        """
+        return recordings.resolve_album(
+            self.db.cursor(), "ytmusic", self.parse_album_url(url)
+        )
+
+    @staticmethod
+    def parse_album_url(url: str) -> str:
+        """Strip an album URL down to its browseId (or album playlist ID).
+
+        Args:
+            url (str): A YTMusic album URL.
+
+        Returns:
+            str: browseId or playlist ID
+        """
+        if "list=" in url:
+            return url.split("list=")[1].split("&")[0]
+        return url.split("?")[0].rstrip("/").split("/")[-1]
+
+    def _send_request(self, url, *args, **kwargs):
+        """Every ytmusicapi request goes through here; wait our turn first."""
+        self.limiter.acquire("ytmusic")
+        try:
+            with metrics.shared().timer(
+                "upstream_seconds", service="ytmusic", call=metrics.endpoint(url)
+            ):
+                return super()._send_request(url, *args, **kwargs)
+        except Exception as e:
+            metrics.shared().inc(
+                "upstream_errors_total",
+                service="ytmusic",
+                status=getattr(getattr(e, "response", None), "status_code", "unknown"),
+            )
+            raise
+
+    def __fetch_isrc(self, url: str):
+        """Ask musicfetch for a YTMusic URL's ISRC, within musicfetch's rate budget."""
+        self.limiter.acquire("musicfetch")
+        with metrics.shared().timer(
+            "upstream_seconds", service="musicfetch", call="isrc"
+        ):
+            return musicfetch.fetch_isrc(url)
+
+    @staticmethod
+    def __row_to_song(row) -> song.Song:
+        """Make a Song obj from a ytmusic table row."""
+        return song.Song(
+            source="ytmusic",
+            uid=row[0],
+            isrc=row[1],
+            title=row[2],
+            first_artist=row[3],
+        )
+
+    @classmethod
+    def __commit_album(cls, an_album: album.Album) -> str:
+        """Commit an album to the database, and return its URL."""
+        print(f"Made an album commit to ytmusic: {an_album.upc}")
+        url = f"https://music.youtube.com/browse/{an_album.uid}"
+        cls.db.write(
+            recordings.link_album,
+            "ytmusic",
+            an_album.uid,
+            an_album.upc,
+            an_album.title,
+            an_album.first_artist,
+            url,
+        )
+        return url
 
     @classmethod
     def __commit_song(cls, uid: str, isrc: str, title: str, first_artist: str):
         """Commit a song to the database."""
         data = {
             "uid": uid,
-            "isrc": isrc.lower(),
+            "isrc": isrc.lower() if isrc is not None else None,
             "title": title,
             "first_artist": first_artist,
+            "fetched_at": time.time(),
         }
 
         print(f"Made a commit to ytmusic: {isrc}")
+        found = song.Song("ytmusic", uid, isrc, title, first_artist)
+        misses.forget(cls.db, found, "ytmusic")
         # this is an upsert; sometimes an isrc won't be found so we'll have a null, but later,
-        # it gets found as we keep querying musicfetch, so we want to update the record
-        cls.cur.execute(
-            "INSERT INTO ytmusic(uid, isrc, title, first_artist) VALUES (:uid, :isrc, \
-                        :title, :first_artist) ON CONFLICT(uid) DO UPDATE SET isrc=:isrc, \
-                        title=:title, first_artist=:first_artist",
+        # it gets found as we keep querying musicfetch, so we want to update the record.
+        # a lookup that misses this time mustn't wipe an isrc we found before, though
+        cls.db.execute(
+            "INSERT INTO ytmusic(uid, isrc, title, first_artist, fetched_at) \
+                        VALUES (:uid, :isrc, :title, :first_artist, :fetched_at) \
+                        ON CONFLICT(uid) DO UPDATE SET \
+                        isrc=coalesce(:isrc, ytmusic.isrc), title=:title, \
+                        first_artist=:first_artist, fetched_at=:fetched_at",
             data,
         )
-        cls.con.commit()
+        cls.db.write(
+            recordings.link, "ytmusic", uid, isrc, f"https://music.youtube.com/watch?v={uid}"
+        )
+        # not before the upsert lands, or a read in between memoizes the old row
+        cls.db.after_commit(
+            cls.memo.invalidate,
+            ("song", "ytmusic", uid),
+            ("url", data["isrc"], "ytmusic"),
+        )
+
+    @classmethod
+    def __forget_song(cls, uid: str):
+        """Drop a song that's gone from YouTube Music from the database."""
+        print(f"Dropped a pulled song from ytmusic: {uid}")
+        row = cls.db.query_one("SELECT isrc FROM ytmusic WHERE uid=?", [uid])
+        cls.db.execute("DELETE FROM ytmusic WHERE uid=?", [uid])
+        cls.db.write(recordings.unlink, "ytmusic", uid)
+        cls.db.after_commit(
+            cls.memo.invalidate,
+            ("song", "ytmusic", uid),
+            ("url", row[0] if row is not None else None, "ytmusic"),
+        )
+
+    # the registry.Converter protocol
+    to_song = url_to_song
+    to_url = song_to_url
+    to_songs = urls_to_songs
+    to_urls = songs_to_urls
+
+    def linked_urls(self, url: str) -> dict[str, tuple]:
+        """Get every other service's URL we already know for this song, from the db only.
+
+        Args:
+            url (str): YTMusic URL
+
+        Returns:
+            dict[str, tuple]: Maps service name to (platform ID, URL, fetched_at),
+                as recordings.resolve does; empty if nothing is linked yet.
+        """
+        return recordings.resolve(self.db.cursor(), "ytmusic", self.parse_url(url))
 
     @staticmethod
-    def __strip_url(url: str) -> str:
+    def parse_url(url: str) -> str:
         """Strip a URL down to the videoID.
 
         Args:
-            url (str): A YouTube URL.
+            url (str): A YouTube URL, as /watch?v= or a youtu.be/ share link.
 
         Returns:
             str: videoID
         """
         if "/watch?v=" in url:
             url = url.split("/watch?v=")[1]
+        elif "youtu.be/" in url:
+            # share links carry their tracking after a ?, e.g. ?si=...
+            url = url.split("youtu.be/")[1].split("?")[0]
         if "&" in url:
             url = url.split("&")[0]
         return url
@@ -0,0 +1,7 @@
+"""Make the modules in src/convert importable the way they import each other."""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src", "convert"))
@@ -0,0 +1,35 @@
+"""Telling whether albums from two services are the same one."""
+
+import pytest
+
+import album
+
+
+def an_album(title, artist):
+    return album.Album("spotify", "1", None, title, artist)
+
+
+@pytest.mark.parametrize(
+    "ours, theirs",
+    [
+        (("Rumours", "Fleetwood Mac"), ("Rumours (Deluxe Edition)", "Fleetwood Mac")),
+        (("Abbey Road", "The Beatles"), ("Abbey Road - Remastered 2019", "Beatles")),
+        (
+            ("Bridge Over Troubled Water", "Simon & Garfunkel"),
+            ("Bridge over Troubled Water", "Simon and Garfunkel"),
+        ),
+    ],
+)
+def test_similar_across_services(ours, theirs):
+    assert an_album(*ours).is_similar(an_album(*theirs))
+
+
+@pytest.mark.parametrize(
+    "ours, theirs",
+    [
+        (("Views", "Drake"), ("Scorpion", "Drake")),
+        (("Unplugged (Live)", "Nirvana"), ("Unplugged", "Nirvana")),
+    ],
+)
+def test_not_similar(ours, theirs):
+    assert not an_album(*ours).is_similar(an_album(*theirs))
@@ -0,0 +1,66 @@
+"""Run bench.py against the fixtures in fixtures/, as a check that conversions still
+work end to end offline.
+
+The converters bind songs.db and the rate limits when they're imported, so each
+benchmark runs in a process of its own."""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# what conversions.txt expects: the songs that one service or another doesn't have
+EXPECTED_ERRORS = {"NoMatchFoundError"}
+
+
+def run_bench(tmp_path, *args) -> dict:
+    """Run a benchmark and return the results it saved."""
+    path = tmp_path / "results.json"
+    subprocess.run(
+        [sys.executable, "bench.py", *args, "--json", str(path)],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        timeout=300,
+    )
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+@pytest.fixture(name="clients")
+def fixture_clients():
+    """Skip unless every API client the converters import is installed."""
+    for name in ("spotipy", "applemusicpy", "ytmusicapi", "musicfetch"):
+        pytest.importorskip(name)
+
+
+def test_match(tmp_path):
+    results = run_bench(tmp_path, "match", "--requests", "200")
+    assert results["title_key"]["requests"] == 200
+    assert results["best_of_10"]["requests"] == 200
+
+
+@pytest.mark.usefixtures("clients")
+def test_replay(tmp_path):
+    results = run_bench(tmp_path, "replay", "--workers", "4", "--concurrency", "8")
+    with open(os.path.join(ROOT, "fixtures", "conversions.txt"), encoding="utf-8") as f:
+        jobs = sum(1 for line in f if line.strip())
+    for name in ("cold", "warm"):
+        assert results[name]["requests"] == jobs
+        assert set(results[name]["errors"]) <= EXPECTED_ERRORS
+    # a song one service doesn't have is still missing once it's cached
+    assert results["warm"]["errors"] == results["cold"]["errors"]
+    # and the second pass is answered by songs.db
+    warm = results["warm"]["db_lookups"]
+    assert sum(count for key, count in warm.items() if key.endswith(" hit")) > 0
+
+
+@pytest.mark.usefixtures("clients")
+def test_cached(tmp_path):
+    results = run_bench(
+        tmp_path, "cached", "--rows", "200", "--requests", "500", "--workers", "4"
+    )
+    assert results["cached"]["requests"] == 500
+    assert not results["cached"]["errors"]
@@ -0,0 +1,55 @@
+"""The titles index, and finding cached songs in it by title and artist."""
+
+import pytest
+
+import song
+import storage
+import titles
+
+
+@pytest.fixture(name="db")
+def fixture_db(tmp_path):
+    db = storage.Storage(str(tmp_path / "songs.db"))
+    yield db
+    db.flush()
+
+
+def cache_spotify(db, uid, isrc, title, artist):
+    db.execute(
+        "INSERT INTO spotify(uid, isrc, title, first_artist) VALUES (?, ?, ?, ?) \
+        ON CONFLICT(uid) DO UPDATE SET isrc=excluded.isrc, title=excluded.title, \
+        first_artist=excluded.first_artist",
+        [uid, isrc, title, artist],
+    )
+    db.flush()
+
+
+def indexed(db, uid):
+    return db.query(
+        "SELECT title, artist FROM titles WHERE service='spotify' AND platform_id=?",
+        [uid],
+    )
+
+
+def test_find_title_with_ampersand(db):
+    cache_spotify(db, "sp1", "USAAA0000001", "Cecilia", "Simon & Garfunkel")
+    wanted = song.Song("ytmusic", "yt1", None, "Cecilia", "Simon & Garfunkel")
+    found = titles.find(db, wanted, "spotify")
+    assert found == ("sp1", "https://open.spotify.com/track/sp1")
+
+
+def test_index_follows_updates_after_vacuum(db):
+    for i in range(3):
+        cache_spotify(db, f"sp{i}", f"USAAA000000{i}", f"Song {i}", "Someone")
+    db.execute("DELETE FROM spotify WHERE uid='sp0'")
+    db.flush()
+    # VACUUM may renumber a table's implicit rowids
+    db.connection().execute("VACUUM")
+    cache_spotify(db, "sp2", "USAAA0000002", "Renamed", "Someone")
+    db.execute("DELETE FROM spotify WHERE uid='sp1'")
+    db.flush()
+
+    assert indexed(db, "sp0") == []
+    assert indexed(db, "sp1") == []
+    assert indexed(db, "sp2") == [("Renamed", "Someone")]
+    assert db.query_one("SELECT count(*) FROM titles")[0] == 1